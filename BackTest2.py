@@ -4,15 +4,12 @@ import pandas as pd
 import numpy as np
 import dolphindb as ddb
 import tqdm
-import matplotlib.pyplot as plt
 from basic import *
 import warnings
 sys.path.append(r"E:\苗欣奕的东西\行研宝\func\future_cn_func")
 from future_cn_basic import *
 # warnings.filterwarnings("ignore")
 pd.set_option("display.max_columns",None)
-plt.rcParams['font.sans-serif']=['KaiTi'] # 显示中文
-plt.rcParams['axes.unicode_minus']=False # 显示负号
 
 """
 如何设计仓位
@@ -741,14 +738,25 @@ class CTA_backtest:
                 else:   # 说明当天option_settle数据缺失
                     pass
 
-    def run(self):
-        """运行策略+可视化"""
+    def run(self,plot=True):
+        """
+        运行策略+可视化
+        plot=False:无界面批量运行,不导入matplotlib
+        return: {'cash':Series,'profit':Series,'settle_profit':Series,'future_record':DataFrame,'option_record':DataFrame}
+        """
         self.strategy(self=self)    # 策略运行
-        # plt.plot(self.cash_Dict.keys(),self.cash_Dict.values(),label='cash')
-        plt.plot(self.profit_Dict.keys(),self.profit_Dict.values(),label='profit')
-        plt.plot(self.settle_profit_Dict.keys(),self.settle_profit_Dict.values(),label='settle_profit')
-        plt.legend(frameon=False)
-        plt.show()
+        if plot:
+            plt=get_plt()
+            # plt.plot(self.cash_Dict.keys(),self.cash_Dict.values(),label='cash')
+            plt.plot(self.profit_Dict.keys(),self.profit_Dict.values(),label='profit')
+            plt.plot(self.settle_profit_Dict.keys(),self.settle_profit_Dict.values(),label='settle_profit')
+            plt.legend(frameon=False)
+            plt.show()
+        return {'cash':pd.Series(self.cash_Dict,name='cash'),
+                'profit':pd.Series(self.profit_Dict,name='profit'),
+                'settle_profit':pd.Series(self.settle_profit_Dict,name='settle_profit'),
+                'future_record':self.future_record,
+                'option_record':self.option_record}
 
 
 if __name__=="__main__":
@@ -773,6 +781,7 @@ if __name__=="__main__":
     option_record=S.option_record
     print(future_record)
     future_record.to_csv(f"交易明细{pd.Timestamp.today().strftime('%Y-%m-%d')}.csv",index=None)
+    plt=get_plt()
     plt.plot(S.cash_Dict.keys(),S.cash_Dict.values(),label='cash')
     plt.legend(frameon=False)
     plt.show()
\ No newline at end of file
@@ -1,21 +1,30 @@
-import os,sys
+import os,sys,re
 import time
+import pickle
+import copy
+import hashlib
 import pandas as pd
 import numpy as np
-import dolphindb as ddb
+try:
+    import dolphindb as ddb     # DolphinDB为可选数据源
+except ImportError:
+    ddb=None
 import tqdm
-import matplotlib.pyplot as plt
 from basic import *
 import warnings
+import threading
+import inspect
+import heapq
+import itertools
+from collections import deque,OrderedDict
+from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor
 sys.path.append(r"E:\苗欣奕的东西\行研宝\func\future_cn_func")
 from future_cn_basic import *
 # warnings.filterwarnings("ignore")
 pd.set_option("display.max_columns",None)
-plt.rcParams['font.sans-serif']=['KaiTi'] # 显示中文
-plt.rcParams['axes.unicode_minus']=False # 显示负号
 
 """
-如何设计仓位
+如何设计仓位(LotBook:批次存放于numpy数组,以下为按dict访问时的样式)
 future_long_position={'future_contract':[{'price':1000,'pre_settle':900,'margin':1000*0.1,'min_price':980,'max_price':1300,'max_date':'20240502','vol':5},{...}]}    # 期货多头持仓
 future_short_position={'future_contract':[{'price':1000,'pre_settle':900,'margin':1000*0.1,'min_price':980,'max_price':1300,'max_date':'20240502','vol':5},{...}]}   # 期货空头持仓
 option_buy_C_position={'option':[{'price':100,'pre_settle':90,'strike':60,'margin':0,'min_price':98,'max_price':130,'max_date':'20240502','vol':5},{...}]}          # 
@@ -24,9 +33,1554 @@ option_sell_C_position={'option':[{'price':100,'pre_settle':90,'strike':60,'marg
 option_sell_P_position={'option':[{'price':100,'pre_settle':90,'strike':60,'margin':0,'min_price':98,'max_price':130,'max_date':'20240502','vol':5},{...}]}
 """
 
+class DaySnapshot:
+    """
+    单日行情截面:一次查询当日柜台表中的全部K线,按symbol/contract/option建立索引
+    撮合/监控/盯市/柜台收盘均从截面读取,避免逐合约session.run
+    df可以是DataFrame或pyarrow.Table(LocalColumnarSource.get_table):Table的数值/日期列直接引用Arrow缓冲区,
+    memory_map读取时不复制到进程内存(参数扫描的各子进程共享操作系统页缓存),.df只在被访问时才转换
+    """
+    def __init__(self,date,df,key):
+        self.date=pd.Timestamp(date)    # 截面对应的交易日
+        self.key=key                    # 索引列(symbol/contract/option)
+        if df is None:
+            df=pd.DataFrame({key:[]})
+        if isinstance(df,pd.DataFrame):
+            df=df.drop_duplicates(subset=[key],keep='first').reset_index(drop=True)
+            self.frame=df
+            self.columns={col:df[col].to_numpy() for col in df.columns}  # 列式存储:{'high':np.array,...}
+        else:
+            self.frame=None
+            self.columns=self.arrow_columns(df)
+            duplicated=pd.Index(self.columns[key]).duplicated(keep='first')
+            if duplicated.any():
+                self.columns={col:arr[~duplicated] for col,arr in self.columns.items()}
+        self.index=pd.Index(self.columns[key].tolist())   # 合约→行号
+
+    @staticmethod
+    def arrow_columns(table):
+        """pyarrow.Table→{列名:np.array}:单块且没有缺失值的数值/日期列为Arrow缓冲区上的只读视图(不复制),字符串等其余列转换"""
+        columns={}
+        for name,column in zip(table.column_names,table.columns):
+            chunk=column.chunk(0) if column.num_chunks==1 else column.combine_chunks()
+            try:
+                columns[name]=chunk.to_numpy(zero_copy_only=True)
+            except Exception:   # pyarrow.ArrowInvalid:字符串/布尔/含缺失值的列需要转换
+                columns[name]=chunk.to_numpy(zero_copy_only=False)
+        return columns
+
+    @property
+    def df(self):
+        """截面的DataFrame(由pyarrow.Table构造时在第一次访问时转换)"""
+        if self.frame is None:
+            self.frame=pd.DataFrame(self.columns)
+        return self.frame
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self,symbol):
+        return symbol in self.index
+
+    def loc(self,symbol):
+        """返回symbol所在行号,不存在返回-1"""
+        try:
+            return self.index.get_loc(symbol)
+        except KeyError:
+            return -1
+
+    def locate(self,symbols):
+        """批量返回symbols所在行号(np.array),不存在的为-1"""
+        if len(symbols)==0 or len(self.index)==0:
+            return np.full(len(symbols),-1,dtype=np.int64)
+        return self.index.get_indexer(list(symbols))
+
+    def get(self,symbol):
+        """返回symbol当日的K线{'high':...,'low':...},没有数据返回None"""
+        i=self.loc(symbol)
+        if i<0:
+            return None
+        return {col:arr[i] for col,arr in self.columns.items()}
+
+    def column(self,col):
+        return self.columns[col]
+
+class CounterOrder(dict):
+    """
+    柜台中的订单dict:与柜台数组同步的字段(开平/合约/价格/数量/有效日期/止损/OCO组)只读,需通过OrderCounter.amend修改
+    其余字段(pre_settle/margin/reason等)仍可直接读写
+    """
+    locked=frozenset(['order_state','symbol','contract','option','price','vol','min_order_date','max_order_date','stop','oco'])
+
+    def __setitem__(self,key,value):
+        if key in self.locked:
+            raise TypeError(f"订单字段{key}与柜台数组同步,请使用counter.amend(orderNum,{key}=...)修改")
+        dict.__setitem__(self,key,value)
+
+    def __delitem__(self,key):
+        if key in self.locked:
+            raise TypeError(f"订单字段{key}与柜台数组同步,不能删除")
+        dict.__delitem__(self,key)
+
+    def update(self,*args,**kwargs):
+        for key,value in dict(*args,**kwargs).items():
+            self[key]=value
+
+    def setdefault(self,key,default=None):
+        if key not in self:
+            self[key]=default
+        return self[key]
+
+    def pop(self,key,*default):
+        if key in self.locked:
+            raise TypeError(f"订单字段{key}与柜台数组同步,不能删除")
+        return dict.pop(self,key,*default)
+
+    def __reduce__(self):   # pickle/deepcopy时整体构造,不经过__setitem__
+        return (CounterOrder,(dict(self),))
+
+class OrderCounter:
+    """
+    列式柜台:挂单的订单编号/合约编码/开平/价格/数量/有效日期存放在numpy数组中,撮合时一次性与当日截面的low/high比较
+    其余字段(止盈止损/保证金/reason等)仍保存在订单dict中,兼容原先counter[orderNum]/del counter[orderNum]/items()的用法
+    订单dict中与数组同步的字段只读(见CounterOrder),改价/改量/改有效日期通过amend(orderNum,...)同时更新数组与dict
+    【新增】按日期建立两个小顶堆:pending(min_order_date)与expiry(max_order_date)
+    每日只把到达min_order_date的订单移入active集合、只弹出到达max_order_date的订单,撮合只涉及active中的订单
+    【新增】OCO(二选一)订单组:订单dict中oco相同的订单属于同一组,其中一笔成交后由cancel_oco撤销同组其余订单
+    【新增】止损单:订单dict中stop=-1(卖出止损,low<=price时触发)/1(买入止损,high>=price时触发),其余为限价单(low<=price<=high时成交)
+    """
+    def __init__(self,key,capacity=64):
+        self.key=key            # 合约字段名(symbol/contract/option)
+        self.symbols=[]         # 合约编码→合约
+        self.symbol_code={}     # 合约→合约编码
+        self.slot={}            # 订单编号→数组下标
+        self.orders=[]          # 数组下标→订单dict
+        self.size=0
+        self.pending=[]         # 小顶堆(min_order_date,订单编号,uid):尚未生效的订单(失效记录由prune清理)
+        self.expiry=[]          # 小顶堆(max_order_date,订单编号,uid):全部订单的过期日(失效记录由prune清理)
+        self.active=set()       # 已生效(当前日期位于[min_order_date,max_order_date))的订单编号
+        self.order_uid={}       # 订单编号→uid(同一订单编号被重新挂单时,堆中旧的记录失效)
+        self.uid=0
+        self.oco={}             # OCO组号→组内仍在柜台的订单编号
+        self.alloc(capacity)
+
+    def alloc(self,capacity):
+        self.order_id=np.zeros(capacity,dtype=np.int64)
+        self.code=np.zeros(capacity,dtype=np.int64)
+        self.is_open=np.zeros(capacity,dtype=bool)
+        self.stop=np.zeros(capacity,dtype=np.int8)      # 0:限价单 -1:卖出止损 1:买入止损
+        self.price=np.zeros(capacity,dtype=np.float64)
+        self.vol=np.zeros(capacity,dtype=np.float64)
+        self.min_order_date=np.zeros(capacity,dtype='datetime64[ns]')
+        self.max_order_date=np.zeros(capacity,dtype='datetime64[ns]')
+        self.alive=np.zeros(capacity,dtype=bool)
+
+    def grow(self):
+        n=self.size
+        old=(self.order_id,self.code,self.is_open,self.stop,self.price,self.vol,self.min_order_date,self.max_order_date,self.alive)
+        self.alloc(max(2*len(self.order_id),64))
+        new=(self.order_id,self.code,self.is_open,self.stop,self.price,self.vol,self.min_order_date,self.max_order_date,self.alive)
+        for o,nw in zip(old,new):
+            nw[:n]=o[:n]
+
+    def compact(self):
+        """删除的订单过多时压缩数组"""
+        keep=np.flatnonzero(self.alive[:self.size])
+        for arr in (self.order_id,self.code,self.is_open,self.stop,self.price,self.vol,self.min_order_date,self.max_order_date,self.alive):
+            arr[:len(keep)]=arr[keep]
+        self.alive[len(keep):self.size]=False
+        self.orders=[self.orders[i] for i in keep]
+        self.size=len(keep)
+        self.slot={int(orderNum):i for i,orderNum in enumerate(self.order_id[:self.size])}
+
+    def __setitem__(self,orderNum,orderDict):
+        if orderNum in self.slot:
+            del self[orderNum]
+        if self.size==len(self.order_id):
+            self.grow()
+        symbol=orderDict[self.key]
+        if symbol not in self.symbol_code:
+            self.symbol_code[symbol]=len(self.symbols)
+            self.symbols.append(symbol)
+        i=self.size
+        min_order_date=pd.Timestamp(orderDict['min_order_date'])
+        max_order_date=pd.Timestamp(orderDict['max_order_date'])
+        self.order_id[i]=orderNum
+        self.code[i]=self.symbol_code[symbol]
+        self.is_open[i]=orderDict['order_state']=='open'
+        self.stop[i]=orderDict.get('stop') or 0
+        self.price[i]=orderDict['price']
+        self.vol[i]=orderDict['vol']
+        self.min_order_date[i]=min_order_date.to_datetime64()
+        self.max_order_date[i]=max_order_date.to_datetime64()
+        self.alive[i]=True
+        self.orders.append(CounterOrder(orderDict))
+        self.slot[orderNum]=i
+        self.size+=1
+        self.schedule(orderNum,min_order_date,max_order_date)
+        if orderDict.get('oco') is not None:
+            self.oco.setdefault(orderDict['oco'],set()).add(orderNum)
+
+    def __getitem__(self,orderNum):
+        return self.orders[self.slot[orderNum]]
+
+    def __delitem__(self,orderNum):
+        i=self.slot.pop(orderNum)
+        group=self.orders[i].get('oco')
+        if group in self.oco:
+            self.oco[group].discard(orderNum)
+            if not self.oco[group]:
+                del self.oco[group]
+        self.alive[i]=False
+        self.orders[i]=None
+        self.active.discard(orderNum)
+        del self.order_uid[orderNum]
+        if self.size>=64 and len(self.slot)<self.size//2:
+            self.compact()
+        self.prune()
+
+    def prune(self):
+        """已成交/撤销/改期订单在堆中留下的失效记录超过一半时重建堆,堆的大小与柜台中的订单数同阶"""
+        for name in ('pending','expiry'):
+            heap=getattr(self,name)
+            if len(heap)>=64 and len(heap)>2*len(self.slot):
+                heap=[entry for entry in heap if self.is_valid(entry[1],entry[2])]
+                heapq.heapify(heap)
+                setattr(self,name,heap)
+
+    def schedule(self,orderNum,min_order_date,max_order_date):
+        """订单(重新)进入pending/expiry堆,堆中该订单原有的记录失效"""
+        self.uid+=1
+        self.order_uid[orderNum]=self.uid
+        heapq.heappush(self.pending,(min_order_date.value,orderNum,self.uid))
+        heapq.heappush(self.expiry,(max_order_date.value,orderNum,self.uid))
+        self.prune()
+
+    def amend(self,orderNum,**fields):
+        """
+        修改挂单:price/vol/min_order_date/max_order_date/stop等字段同时写入数组与订单dict(数量变化时保证金按比例调整)
+        修改有效日期后订单重新按日期生效/过期;开平/合约/OCO组不能修改(撤单后重新下单)
+        """
+        i=self.slot[orderNum]
+        orderDict=self.orders[i]
+        for field in ('order_state',self.key,'oco'):
+            if field in fields and fields[field]!=orderDict.get(field):
+                raise ValueError(f"订单{orderNum}的{field}不能修改,请撤单后重新下单")
+        if 'vol' in fields:
+            if fields['vol']<=0:
+                raise ValueError(f"订单{orderNum}的数量必须大于0,撤单请使用del counter[orderNum]")
+            if orderDict.get('margin') and 'margin' not in fields:
+                fields['margin']=orderDict['margin']*fields['vol']/orderDict['vol']
+        dict.update(orderDict,fields)
+        self.stop[i]=orderDict.get('stop') or 0
+        self.price[i]=orderDict['price']
+        self.vol[i]=orderDict['vol']
+        if 'min_order_date' in fields or 'max_order_date' in fields:
+            min_order_date=pd.Timestamp(orderDict['min_order_date'])
+            max_order_date=pd.Timestamp(orderDict['max_order_date'])
+            self.min_order_date[i]=min_order_date.to_datetime64()
+            self.max_order_date[i]=max_order_date.to_datetime64()
+            self.active.discard(orderNum)   # 撮合前由activate按新的min_order_date重新生效
+            self.schedule(orderNum,min_order_date,max_order_date)
+        return orderDict
+
+    def pop(self,orderNum):
+        orderDict=self[orderNum]
+        del self[orderNum]
+        return orderDict
+
+    def __contains__(self,orderNum):
+        return orderNum in self.slot
+
+    def __len__(self):
+        return len(self.slot)
+
+    def __iter__(self):
+        return iter(list(self.slot.keys()))
+
+    def keys(self):
+        return list(self.slot.keys())
+
+    def values(self):
+        return [self.orders[i] for i in self.slot.values()]
+
+    def items(self):
+        return [(orderNum,self.orders[i]) for orderNum,i in self.slot.items()]
+
+    def copy(self):
+        return dict(self.items())
+
+    def cancel_oco(self,orderDict):
+        """订单成交后撤销同一OCO组中的其余订单,return: 被撤销的订单编号"""
+        group=orderDict.get('oco')
+        cancelled=sorted(self.oco.pop(group,()))
+        for orderNum in cancelled:
+            del self[orderNum]
+        return cancelled
+
+    def reduce(self,orderNum,vol):
+        """部分成交:订单剩余数量减少vol(数组与订单dict同步),保证金按比例减少"""
+        i=self.slot[orderNum]
+        orderDict=self.orders[i]
+        ratio=vol/orderDict['vol']
+        if orderDict.get('margin'):
+            orderDict['margin']*=(1-ratio)
+        dict.__setitem__(orderDict,'vol',orderDict['vol']-vol)
+        self.vol[i]=orderDict['vol']
+
+    def reduce_oco(self,orderNum,vol):
+        """OCO订单部分成交时,同组其余订单减少相同数量(减至0时撤销),return: 被撤销的订单编号"""
+        cancelled=[]
+        for other in sorted(self.oco.get(self[orderNum].get('oco'),())):
+            if other==orderNum:
+                continue
+            if self[other]['vol']<=vol:
+                del self[other]
+                cancelled.append(other)
+            else:
+                self.reduce(other,vol)
+        return cancelled
+
+    def is_valid(self,orderNum,uid):
+        """堆中的记录是否仍对应柜台中的订单"""
+        return self.order_uid.get(orderNum)==uid
+
+    def expire(self,date):
+        """弹出max_order_date<=date的订单编号(O(k log n)),并移出active"""
+        date=pd.Timestamp(date).value
+        expired=[]
+        while self.expiry and self.expiry[0][0]<=date:
+            _,orderNum,uid=heapq.heappop(self.expiry)
+            if self.is_valid(orderNum,uid):
+                expired.append(orderNum)
+                self.active.discard(orderNum)
+        return sorted(expired)
+
+    def activate(self,date):
+        """将min_order_date<=date的订单移入active(O(k log n))"""
+        date=pd.Timestamp(date).value
+        while self.pending and self.pending[0][0]<=date:
+            _,orderNum,uid=heapq.heappop(self.pending)
+            if self.is_valid(orderNum,uid):
+                self.active.add(orderNum)
+
+    def match(self,snap,date):
+        """
+        撮合当日有效的挂单:先将生效订单移入active,再弹出过期订单(当日新下且已过期的订单只按过期处理),剩余订单与当日截面的low/high一次性比较
+        return: expired(过期订单编号),filled(可成交订单编号,按订单编号排序),rows(可成交订单在截面中的行号),vols(挂单数量)
+        """
+        empty=np.zeros(0,dtype=np.int64)
+        self.activate(date)
+        expired=np.array(self.expire(date),dtype=np.int64)     # 说明这个订单时间太长了,搞不了
+        if not self.active or len(snap)==0:
+            return expired,empty,empty,np.zeros(0)
+        slots=np.fromiter((self.slot[orderNum] for orderNum in self.active),dtype=np.int64,count=len(self.active))
+        slots=slots[np.argsort(self.order_id[slots])]           # 按订单编号(下单先后)撮合
+        codes=self.code[slots]
+        unique_codes,inverse=np.unique(codes,return_inverse=True)
+        rows=snap.locate([self.symbols[code] for code in unique_codes])[inverse]   # 订单→截面行号
+        has_bar=rows>=0                                         # 这根K线上有该合约的数据
+        r=np.where(has_bar,rows,0)
+        low=snap.column('low').astype(np.float64)[r]
+        high=snap.column('high').astype(np.float64)[r]
+        price=self.price[slots]
+        stop=self.stop[slots]
+        filled=has_bar&np.where(stop==0,(low<=price)&(price<=high),np.where(stop<0,low<=price,high>=price))   # 止损单被穿越即触发
+        slots,rows=slots[filled],rows[filled]
+        vols=self.vol[slots].copy()
+        return expired,self.order_id[slots].copy(),rows,vols
+
+class FillCapacity:
+    """
+    成交量约束:每个合约当日最多成交K线volume*participation,未成交部分继续挂单
+    已用容量按(资产,合约)记录,同一组合(Portfolio)中的各策略共用一份
+    allocate只按成交先后试分配(不占用容量),风控/OCO检查之后由charge对实际成交的数量占用容量
+    """
+    def __init__(self):
+        self.date=None      # used对应的交易日
+        self.used={}        # (资产,合约)→当日已成交数量
+
+    def reset(self,date):
+        date=pd.Timestamp(date)
+        if self.date!=date:     # 新的交易日,容量重置(同一交易日多次撮合时共用容量)
+            self.date=date
+            self.used={}
+
+    def allocate(self,asset,symbols,vols,volume,participation,date):
+        """
+        按当日剩余容量分配成交数量(向量化):同一合约的订单按先后依次占用剩余容量
+        symbols:各订单的合约,vols:各订单的挂单数量,volume:各订单对应K线的成交量
+        return: 各订单可成交数量
+        """
+        self.reset(date)
+        vols=np.asarray(vols,dtype=np.float64)
+        codes,uniques=pd.factorize(np.asarray(symbols,dtype=object))
+        used=np.array([self.used.get((asset,symbol),0.0) for symbol in uniques])[codes]
+        cap=np.nan_to_num(np.floor(np.asarray(volume,dtype=np.float64)*participation),nan=np.inf)-used  # 当日剩余容量(没有成交量数据时不限制)
+        order=np.argsort(codes,kind='stable')   # 按合约分组,组内保持成交先后
+        code,vol,cap=codes[order],vols[order],cap[order]
+        cum=np.cumsum(vol)
+        start=np.flatnonzero(np.r_[True,code[1:]!=code[:-1]])
+        base=np.repeat((cum-vol)[start],np.diff(np.r_[start,len(vol)]))    # 各组之前的累计数量
+        before=cum-vol-base                     # 同一合约中排在前面的订单数量
+        fill=np.empty(len(vol))
+        fill[order]=np.clip(cap-before,0,vol)
+        return fill
+
+    def charge(self,asset,symbols,vols,date):
+        """实际成交的数量占用当日容量"""
+        self.reset(date)
+        for symbol,vol in zip(symbols,vols):
+            self.used[(asset,symbol)]=self.used.get((asset,symbol),0.0)+vol
+
+class TradeLedger:
+    """
+    只追加的列式成交记录:每个字段一个预分配的numpy数组,容量不足时翻倍扩容,append为O(1)
+    只有在读取stock_record/future_record/option_record时才转换为DataFrame
+    """
+    def __init__(self,columns,capacity=256):
+        self.dtypes=dict(columns)   # {'price':np.float64,...}
+        self.size=0
+        self.data={col:np.empty(capacity,dtype=dtype) for col,dtype in self.dtypes.items()}
+        self._frame=None            # to_frame()的缓存,append之后失效
+
+    def __len__(self):
+        return self.size
+
+    def append(self,**row):
+        if self.size==len(next(iter(self.data.values()))):  # 扩容
+            for col,arr in self.data.items():
+                new=np.empty(2*len(arr),dtype=arr.dtype)
+                new[:self.size]=arr[:self.size]
+                self.data[col]=new
+        for col,arr in self.data.items():
+            arr[self.size]=row.get(col)
+        self.size+=1
+        self._frame=None
+
+    def column(self,col):
+        return self.data[col][:self.size]
+
+    def extend(self,other):
+        """追加另一份成交记录的全部行(按列整块复制)"""
+        n=self.size+len(other)
+        if n>len(next(iter(self.data.values()))):
+            for col,arr in self.data.items():
+                new=np.empty(max(n,2*len(arr)),dtype=arr.dtype)
+                new[:self.size]=arr[:self.size]
+                self.data[col]=new
+        for col,arr in self.data.items():
+            arr[self.size:n]=other.column(col)
+        self.size=n
+        self._frame=None
+
+    def to_frame(self):
+        if self._frame is None:
+            self._frame=pd.DataFrame({col:arr[:self.size].copy() for col,arr in self.data.items()})
+        return self._frame
+
+class Lot:
+    """LotBook中单个批次的视图,支持lot['vol']形式读写,兼容原先的持仓dict"""
+    __slots__=('book','row')
+
+    def __init__(self,book,row):
+        self.book=book
+        self.row=row
+
+    def __getitem__(self,key):
+        return self.book.get_field(self.row,key)
+
+    def __setitem__(self,key,value):
+        self.book.set_field(self.row,key,value)
+
+    def keys(self):
+        return list(self.book.fields)
+
+    def to_dict(self):
+        return {key:self[key] for key in self.book.fields}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+def heap_crossed(heap,bound):
+    """
+    在小顶堆中找出全部key<=bound的记录(不出堆)
+    只沿满足条件的节点向下遍历,复杂度O(k),k为满足条件的记录数
+    """
+    found=[]
+    stack=[0] if heap and heap[0][0]<=bound else []
+    while stack:
+        i=stack.pop()
+        found.append(heap[i])
+        for child in (2*i+1,2*i+2):
+            if child<len(heap) and heap[child][0]<=bound:
+                stack.append(child)
+    return found
+
+class LotBook:
+    """
+    列式FIFO持仓簿:全部批次按开仓顺序存放在numpy数组中,每个合约用deque保存该合约的批次下标
+    平仓只修改队首批次(O(1)),监控触发的批次由close_row按批次平仓,合约持仓量增量维护,保证金/持仓量可按合约批量汇总
+    兼容原先的dict接口:book[contract]返回该合约按FIFO排列的批次列表,批次可按lot['vol']读写
+    first_day:开仓当日尚未盯市(替代原先的'FirstDaySettle'标记)
+    【新增】触发价索引:每个合约按min_price(大顶堆)/max_price(小顶堆)/max_date(小顶堆)建立三个堆
+    监控时只取出当日low/high/日期实际穿越阈值的批次,已平仓或阈值被修改的堆记录延迟删除
+    【新增】移动止损:设置trail的批次按(止损价+trail)建立小顶堆,每日只弹出被当日最高价(空头/卖方为最低价)推动的批次并上移止损价
+    sign=1:多头/买方,止损价为min_price;sign=-1:空头/卖方,止损价为max_price
+    """
+    triggers={'min_price':-1,'max_price':1,'max_date':1}   # 堆key的符号:min_price取负数实现大顶堆
+    dtypes={'code':np.int64,'price':np.float64,'pre_settle':np.float64,'margin':np.float64,'strike':np.float64,
+            'min_price':np.float64,'max_price':np.float64,'max_date':'datetime64[ns]','trail':np.float64,'vol':np.float64,'first_day':bool,'alive':bool}
+
+    def __init__(self,key,fields,sign=1,capacity=64):
+        self.key=key                # 合约字段名(symbol/contract/option)
+        self.sign=sign              # 1:多头/买方 -1:空头/卖方
+        self.stop_field='min_price' if sign==1 else 'max_price'     # 移动止损调整的字段
+        self.fields=list(fields)    # 批次对外展示的字段
+        self.symbols=[]             # 合约编码→合约
+        self.symbol_code={}         # 合约→合约编码
+        self.queue={}               # 合约→deque(批次下标),队首为最早开仓的批次
+        self.total_vol={}           # 合约→持仓数量
+        self.size=0                 # 已使用的数组长度(含已平仓批次)
+        self.dead=0                 # 已平仓批次数量
+        self.data={field:np.zeros(capacity,dtype=dtype) for field,dtype in self.dtypes.items()}
+        self.heaps={}               # 合约→{'min_price'/'max_price'/'max_date':堆(key,批次下标)}
+        self.trailing={}            # 合约→移动止损堆(止损价*sign+trail,批次下标)
+
+    # dict接口
+    def __contains__(self,symbol):
+        return symbol in self.queue
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __iter__(self):
+        return iter(list(self.queue.keys()))
+
+    def __getitem__(self,symbol):
+        return [Lot(self,row) for row in self.queue[symbol]]
+
+    def __delitem__(self,symbol):
+        for row in self.queue.pop(symbol):
+            self.data['vol'][row]=0
+            self.data['alive'][row]=False
+            self.dead+=1
+        del self.total_vol[symbol]
+        self.heaps.pop(symbol,None)
+        self.trailing.pop(symbol,None)
+
+    def keys(self):
+        return list(self.queue.keys())
+
+    def values(self):
+        return [self[symbol] for symbol in self.queue]
+
+    def items(self):
+        return [(symbol,self[symbol]) for symbol in self.queue]
+
+    def __repr__(self):
+        return repr({symbol:[lot.to_dict() for lot in lots] for symbol,lots in self.items()})
+
+    # 字段读写
+    def get_field(self,row,key):
+        value=self.data[key][row]
+        if key in ('min_price','max_price','strike','pre_settle','trail') and np.isnan(value):
+            return None
+        if key=='max_date':
+            return None if np.isnat(value) else pd.Timestamp(value)
+        return value.item()
+
+    def set_field(self,row,key,value):
+        if key=='vol':
+            symbol=self.symbols[self.data['code'][row]]
+            self.total_vol[symbol]+=value-self.data['vol'][row]
+        if key=='max_date':
+            value=np.datetime64('NaT') if value is None else pd.Timestamp(value).to_datetime64()
+        elif value is None:
+            value=np.nan
+        self.data[key][row]=value
+        if (key in self.triggers or key=='trail') and self.data['alive'][row]:    # 修改止盈止损后重新入堆,旧记录延迟删除
+            self.index(row,key)
+
+    # 触发价索引
+    def trigger_key(self,row,key):
+        """批次在key对应的堆中的排序值,未设置(None/0)时返回None"""
+        value=self.data[key][row]
+        if key=='max_date':
+            return None if np.isnat(value) else int(value.astype(np.int64))
+        if np.isnan(value) or value==0:
+            return None
+        return self.triggers[key]*float(value)
+
+    def trail_key(self,row):
+        """移动止损批次的堆key:当日最高价*sign超过该值时止损价需要移动,未设置trail时返回None"""
+        trail,stop=self.data['trail'][row],self.data[self.stop_field][row]
+        if np.isnan(trail) or np.isnan(stop):
+            return None
+        return self.sign*float(stop)+float(trail)
+
+    def index(self,row,key=None):
+        symbol=self.symbols[self.data['code'][row]]
+        heaps=self.heaps.setdefault(symbol,{field:[] for field in self.triggers})
+        for field in ([key] if key else self.triggers):
+            value=self.trigger_key(row,field) if field in self.triggers else None
+            if value is not None:
+                heapq.heappush(heaps[field],(value,row))
+        if key in (None,'trail',self.stop_field):
+            value=self.trail_key(row)
+            if value is not None:
+                heapq.heappush(self.trailing.setdefault(symbol,[]),(value,row))
+
+    def reindex(self):
+        self.heaps={}
+        self.trailing={}
+        for q in self.queue.values():
+            for row in q:
+                self.index(row)
+
+    def triggered(self,symbol,low,high,date):
+        """
+        返回该合约中low<=min_price、max_price<=high或max_date<=date的未平仓批次(按开仓顺序)
+        只是候选集合,是否平仓仍由monitor按原先的先后规则判断,monitor按各批次自己的阈值平仓该批次(close_row)
+        """
+        heaps=self.heaps.get(symbol)
+        if not heaps:
+            return []
+        rows=set()
+        bounds={'min_price':-low,'max_price':high,'max_date':pd.Timestamp(date).value}
+        for field,bound in bounds.items():
+            if bound is None or bound!=bound:   # 当日没有对应的价格
+                continue
+            for value,row in heap_crossed(heaps[field],bound):
+                if self.data['alive'][row] and self.trigger_key(row,field)==value:
+                    rows.add(row)
+        return sorted(rows)
+
+    def trail(self,symbol,low,high):
+        """
+        【盘后运行】用当日最高价(空头/卖方为最低价)推动移动止损价:只弹出堆顶被穿越的批次,复杂度O(k log n)
+        return: 止损价发生移动的批次数量
+        """
+        heap=self.trailing.get(symbol)
+        extreme=high if self.sign==1 else low
+        if not heap or extreme is None or extreme!=extreme:
+            return 0
+        moved=0
+        bound=self.sign*extreme
+        while heap and heap[0][0]<bound:
+            value,row=heapq.heappop(heap)
+            if not self.data['alive'][row] or self.trail_key(row)!=value:  # 已平仓或已被移动过的旧记录
+                continue
+            self.set_field(row,self.stop_field,extreme-self.sign*self.data['trail'][row])   # 重新入堆
+            moved+=1
+        return moved
+
+    def add(self,symbol,price,vol,pre_settle=None,margin=0,strike=None,min_price=None,max_price=None,max_date=None,trail=None,first_day=False):
+        """开仓/加仓:在数组末尾追加一个批次,返回批次下标;设置trail但未设置止损价时,以开仓价-trail(空头为+trail)作为初始止损价"""
+        if self.size>=64 and self.dead>=self.size//2:
+            self.compact()
+        if self.size==len(self.data['vol']):
+            for field,arr in self.data.items():
+                new=np.zeros(2*len(arr),dtype=arr.dtype)
+                new[:self.size]=arr[:self.size]
+                self.data[field]=new
+        if symbol not in self.symbol_code:
+            self.symbol_code[symbol]=len(self.symbols)
+            self.symbols.append(symbol)
+        if trail is not None:
+            if self.sign==1 and min_price is None:
+                min_price=price-trail
+            elif self.sign==-1 and max_price is None:
+                max_price=price+trail
+        row=self.size
+        self.size+=1
+        self.data['code'][row]=self.symbol_code[symbol]
+        for field,value in (('price',price),('pre_settle',pre_settle),('margin',margin),('strike',strike),
+                            ('min_price',min_price),('max_price',max_price),('max_date',max_date),('trail',trail)):
+            self.set_field(row,field,value)
+        self.data['vol'][row]=vol
+        self.data['first_day'][row]=first_day
+        self.data['alive'][row]=True
+        self.queue.setdefault(symbol,deque()).append(row)
+        self.total_vol[symbol]=self.total_vol.get(symbol,0)+vol
+        self.index(row)
+        return row
+
+    def close(self,symbol,vol):
+        """
+        FIFO平仓vol数量,队首批次全部平仓时出队,部分平仓时按比例扣减队首批次的数量和保证金
+        return: 各批次平仓数量/开仓价/昨结价/释放的保证金(np.array),开仓当日尚未盯市的批次昨结价按开仓价返回
+        """
+        q=self.queue.get(symbol,())
+        data=self.data
+        rows,vols,margins=[],[],[]
+        while q and vol>0:
+            row=q[0]
+            lot_vol=data['vol'][row]
+            if vol>=lot_vol:    # 当前批次全部平仓
+                q.popleft()
+                rows.append(row);vols.append(lot_vol);margins.append(data['margin'][row])
+                data['vol'][row]=0
+                data['alive'][row]=False
+                self.dead+=1
+                vol-=lot_vol
+            else:               # 当前批次部分平仓
+                ratio=vol/lot_vol
+                rows.append(row);vols.append(vol);margins.append(data['margin'][row]*ratio)
+                data['vol'][row]=lot_vol-vol
+                data['margin'][row]*=(1-ratio)  # 剩余的保证金
+                vol=0
+        vols=np.array(vols,dtype=np.float64)
+        if symbol in self.queue:
+            self.total_vol[symbol]-=vols.sum()
+            if not q:   # 说明全平仓
+                del self.queue[symbol]
+                del self.total_vol[symbol]
+                self.heaps.pop(symbol,None)
+                self.trailing.pop(symbol,None)
+        rows=np.array(rows,dtype=np.int64)
+        pre_settle=np.where(data['first_day'][rows],data['price'][rows],data['pre_settle'][rows])  # 盯市基准价(与mark一致)
+        return vols,data['price'][rows],pre_settle,np.array(margins,dtype=np.float64)
+
+    def close_row(self,row,vol=None):
+        """
+        平仓指定批次(监控中止盈/止损/移动止损被触发的批次,不按FIFO),vol为None时该批次全部平仓,部分平仓时按比例扣减数量和保证金
+        return: 同close
+        """
+        data=self.data
+        symbol=self.symbols[data['code'][row]]
+        lot_vol=data['vol'][row]
+        vol=lot_vol if vol is None else min(vol,lot_vol)
+        margin=data['margin'][row]*vol/lot_vol if lot_vol>0 else 0.0
+        q=self.queue[symbol]
+        if vol>=lot_vol:    # 该批次全部平仓
+            q.remove(row)
+            data['vol'][row]=0
+            data['alive'][row]=False
+            self.dead+=1
+        else:
+            data['vol'][row]=lot_vol-vol
+            data['margin'][row]-=margin
+        self.total_vol[symbol]-=vol
+        if not q:   # 说明全平仓
+            del self.queue[symbol]
+            del self.total_vol[symbol]
+            self.heaps.pop(symbol,None)
+            self.trailing.pop(symbol,None)
+        rows=np.array([row],dtype=np.int64)
+        pre_settle=np.where(data['first_day'][rows],data['price'][rows],data['pre_settle'][rows])
+        return np.array([vol],dtype=np.float64),data['price'][rows],pre_settle,np.array([margin],dtype=np.float64)
+
+    def capital(self,premium=0):
+        """
+        未平仓批次占用的资金:初始保证金(保证金扣除已计入的盯市盈亏)+premium*开仓价*数量
+        premium:股票/期权买方为1(买入成本/权利金),期权卖方为-1(收到的权利金),期货为0
+        """
+        rows=self.rows()
+        if len(rows)==0:
+            return 0.0
+        data=self.data
+        price,vol,pre_settle=data['price'][rows],data['vol'][rows],data['pre_settle'][rows]
+        marks=np.where(data['first_day'][rows]|np.isnan(pre_settle),0.0,(pre_settle-price)*vol*self.sign)
+        return float((data['margin'][rows]-marks+premium*price*vol).sum())
+
+    def compact(self):
+        """已平仓批次过多时压缩数组,重建各合约的批次下标"""
+        keep=np.array([row for q in self.queue.values() for row in q],dtype=np.int64)
+        for field,arr in self.data.items():
+            arr[:len(keep)]=arr[keep]
+        self.data['alive'][len(keep):self.size]=False
+        new_row=dict(zip(keep.tolist(),range(len(keep))))
+        self.queue={symbol:deque(new_row[row] for row in q) for symbol,q in self.queue.items()}
+        self.size=len(keep)
+        self.dead=0
+        self.reindex()
+
+    # 批量查询
+    def rows(self):
+        """全部未平仓批次的下标(np.array,按开仓顺序)"""
+        return np.flatnonzero(self.data['alive'][:self.size])
+
+    def vol_of(self,symbol):
+        return self.total_vol.get(symbol,0)
+
+    def margin_of(self,symbol):
+        if symbol not in self.queue:
+            return 0
+        return self.data['margin'][list(self.queue[symbol])].sum()
+
+    def mark(self,snap,sign):
+        """
+        【盘后运行】全部未平仓批次一次性盯市:按合约关联当日结算价,开仓当日按(结算-开仓)计算,其余按(结算-昨结算)计算
+        盯市盈亏计入各批次保证金,并将pre_settle更新为当日settle
+        sign:多头/买方为1,空头/卖方为-1
+        return: 当日盯市盈亏合计
+        """
+        rows=self.rows()
+        if len(rows)==0 or len(snap)==0:
+            return 0.0
+        data=self.data
+        bar_row=snap.locate(self.symbols)[data['code'][rows]]  # 批次→截面行号
+        settle=np.full(len(rows),np.nan)
+        has_bar=bar_row>=0
+        settle[has_bar]=snap.column('settle').astype(np.float64)[bar_row[has_bar]]
+        has_bar&=~np.isnan(settle)      # 当日没有结算价的合约不盯市
+        rows,settle=rows[has_bar],settle[has_bar]
+        pre_settle=snap.column('pre_settle').astype(np.float64)[bar_row[has_bar]]
+        base=np.where(data['first_day'][rows],data['price'][rows],pre_settle)  # 第一天持仓按开仓价计算
+        settle_profit=(settle-base)*data['vol'][rows]*sign
+        data['margin'][rows]+=settle_profit
+        data['pre_settle'][rows]=settle     # 更新pre_settle为收盘后的settle
+        data['first_day'][rows]=False
+        return settle_profit.sum()
+
+    def valuation(self,snap,col,sign):
+        """
+        全部未平仓批次按当日col(close/settle)估值,当日没有行情时按pre_settle(股票按开仓价)估值
+        sign:多头/买方为1,空头/卖方为-1
+        return: 未实现盈亏合计,名义市值合计
+        """
+        rows=self.rows()
+        if len(rows)==0:
+            return 0.0,0.0
+        data=self.data
+        price,vol=data['price'][rows],data['vol'][rows]
+        mark=np.where(np.isnan(data['pre_settle'][rows]),price,data['pre_settle'][rows])
+        if len(snap)>0:
+            bar_row=snap.locate(self.symbols)[data['code'][rows]]
+            has_bar=bar_row>=0
+            value=snap.column(col).astype(np.float64)[bar_row[has_bar]]
+            mark[has_bar]=np.where(np.isnan(value),mark[has_bar],value)
+        return float(((mark-price)*vol).sum()*sign),float((np.abs(mark)*vol).sum())
+
+    def aggregate(self):
+        """按合约汇总持仓数量与保证金"""
+        rows=self.rows()
+        code=self.data['code'][rows]
+        n=len(self.symbols)
+        vol=np.bincount(code,weights=self.data['vol'][rows],minlength=n)
+        margin=np.bincount(code,weights=self.data['margin'][rows],minlength=n)
+        held=np.flatnonzero(vol>0)
+        return pd.DataFrame({self.key:[self.symbols[i] for i in held],'vol':vol[held],'margin':margin[held]})
+
+class DolphinDBSource:
+    """
+    DolphinDB行情数据源:从柜台表(或K线表)中按交易日读取行情截面
+    tables:{'stock':(database,table),'future':(database,table),'option':(database,table)}
+    columns:{'stock':"date,symbol,...",...}每张表select的字段(默认select *)
+    start_date/end_date:日期窗口,窗口外的交易日不查询
+    """
+    def __init__(self,session,tables,columns=None,start_date=None,end_date=None):
+        self.session=session if isinstance(session,(LockedSession,CountingSession)) else LockedSession(session)
+        self.tables=tables
+        self.columns=columns if columns else {}
+        self.start_date=pd.Timestamp(start_date.replace(".","")) if start_date else None
+        self.end_date=pd.Timestamp(end_date.replace(".","")) if end_date else None
+        self.lock=self.session.lock     # 与该session的全部调用(引擎/策略/预取线程)共用一把锁
+
+    def get_day(self,asset,date):
+        """返回asset在date当日的全部K线(DataFrame)"""
+        date=pd.Timestamp(date)
+        if (self.start_date is not None and date<self.start_date) or (self.end_date is not None and date>self.end_date):
+            return None
+        database,table=self.tables[asset]
+        columns=self.columns.get(asset,"*")
+        dot_date=date.strftime('%Y.%m.%d')
+        with self.lock:
+            return self.session.run(f"""select {columns} from loadTable("{database}","{table}") where date=date({dot_date})""")
+
+    def has_asset(self,asset):
+        database,table=self.tables.get(asset,(None,None))
+        return database is not None and table is not None
+
+    def get_range(self,asset,start_date,end_date):
+        """一次查询asset在[start_date,end_date]内的全部行(DataFrame)"""
+        database,table=self.tables[asset]
+        columns=self.columns.get(asset,"*")
+        start_dot_date,end_dot_date=pd.Timestamp(start_date).strftime('%Y.%m.%d'),pd.Timestamp(end_date).strftime('%Y.%m.%d')
+        with self.lock:
+            return self.session.run(f"""select {columns} from loadTable("{database}","{table}") where date>=date({start_dot_date}) and date<=date({end_dot_date})""")
+
+    def fingerprint(self,asset,start_date,end_date):
+        """
+        asset在[start_date,end_date]内的数据版本,用于回测结果缓存的key
+        按交易日(分区)统计行数与数值列之和(K线表取close/volume,信号表取全部数值列),对结果取sha256:任一交易日的数据被修正都会改变版本
+        """
+        database,table=self.tables[asset]
+        start_dot_date,end_dot_date=pd.Timestamp(start_date).strftime('%Y.%m.%d'),pd.Timestamp(end_date).strftime('%Y.%m.%d')
+        with self.lock:
+            schema=self.session.run(f"""schema(loadTable("{database}","{table}")).colDefs""")
+            numeric=[name for name,dtype in zip(schema['name'],schema['typeString'])
+                     if dtype in ('DOUBLE','FLOAT','INT','LONG','SHORT') and name!='date']
+            columns=['close','volume'] if {'close','volume'}<=set(numeric) else numeric
+            sums="".join(f",sum({name}) as {name}_sum" for name in columns)
+            df=self.session.run(f"""select count(*) as rows{sums} from loadTable("{database}","{table}") where date>=date({start_dot_date}) and date<=date({end_dot_date}) group by date order by date""")
+        checksum=hashlib.sha256(pd.util.hash_pandas_object(df,index=False).values.tobytes()).hexdigest() if len(df)>0 else None
+        return (database,table,len(df),checksum)
+
+    def trading_dates(self,asset,start_date=None,end_date=None):
+        """返回asset在[start_date,end_date]内全部有数据的交易日"""
+        database,table=self.tables[asset]
+        start_date=pd.Timestamp(start_date) if start_date is not None else self.start_date
+        end_date=pd.Timestamp(end_date) if end_date is not None else self.end_date
+        where=[]
+        if start_date is not None:
+            where.append(f"date>=date({start_date.strftime('%Y.%m.%d')})")
+        if end_date is not None:
+            where.append(f"date<=date({end_date.strftime('%Y.%m.%d')})")
+        where=" where "+" and ".join(where) if where else ""
+        with self.lock:
+            dates=self.session.run(f"""exec distinct(date) from loadTable("{database}","{table}"){where}""")
+        return sorted(pd.Timestamp(date) for date in dates)
+
+class LocalColumnarSource:
+    """
+    本地列式行情数据源(离线回测/CI用,不依赖DolphinDB)
+    目录结构:root/{asset}/{YYYYMMDD}.{parquet|feather|arrow},每个文件为该交易日的全部K线,字段与柜台表一致:
+    stock: date,symbol,open,high,low,close,volume
+    future: date,contract,pre_settle,open,high,low,close,settle,volume,start_date,end_date
+    option: date,option,pre_settle,open,high,low,close,settle,volume,start_date,end_date,level
+    信号表保存在root/{asset}_signal/下(stock_signal/future_signal/option_signal),字段与DolphinDB信号表一致
+    读取时使用pyarrow的memory_map,多个进程读取同一文件时共享操作系统页缓存
+    """
+    suffix=['.feather','.arrow','.parquet']
+
+    def __init__(self,root,memory_map=True):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("LocalColumnarSource需要安装pyarrow: pip install pyarrow")
+        self.root=root
+        self.memory_map=memory_map
+
+    def path(self,asset,date):
+        """返回asset在date当日的文件路径,不存在返回None"""
+        str_date=pd.Timestamp(date).strftime('%Y%m%d')
+        for suffix in self.suffix:
+            path=os.path.join(self.root,asset,str_date+suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def read_table(self,path):
+        """读取单个文件为pyarrow.Table"""
+        import pyarrow as pa
+        if path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            return pq.read_table(path,memory_map=self.memory_map)
+        source=pa.memory_map(path,'r') if self.memory_map else pa.OSFile(path,'rb')
+        return pa.ipc.open_file(source).read_all()
+
+    def get_table(self,asset,date):
+        """返回asset在date当日的全部K线(pyarrow.Table,memory_map时不复制),当日没有数据返回None"""
+        path=self.path(asset,date)
+        if path is None:
+            return None
+        return self.read_table(path)
+
+    def get_day(self,asset,date):
+        """返回asset在date当日的全部K线(DataFrame),当日没有数据返回None"""
+        table=self.get_table(asset,date)
+        if table is None:
+            return None
+        return table.to_pandas(split_blocks=True)   # 按列转换,不合并成大块,减少复制
+
+    def has_asset(self,asset):
+        return os.path.exists(os.path.join(self.root,asset))
+
+    def get_range(self,asset,start_date,end_date):
+        """返回asset在[start_date,end_date]内的全部行(DataFrame),区间内没有数据返回None"""
+        dfs=[self.get_day(asset,date) for date in self.trading_dates(asset,start_date=start_date,end_date=end_date)]
+        dfs=[df for df in dfs if df is not None]
+        return pd.concat(dfs,ignore_index=True) if dfs else None
+
+    def fingerprint(self,asset,start_date,end_date):
+        """asset在[start_date,end_date]内的数据版本(各交易日文件的大小/修改时间),用于回测结果缓存的key"""
+        files=[]
+        for date in self.trading_dates(asset,start_date=start_date,end_date=end_date):
+            path=self.path(asset,date)
+            stat=os.stat(path)
+            files.append((os.path.basename(path),stat.st_size,stat.st_mtime_ns))
+        return tuple(files)
+
+    def trading_dates(self,asset,start_date=None,end_date=None):
+        """返回asset在[start_date,end_date]内全部有数据的交易日"""
+        folder=os.path.join(self.root,asset)
+        if not os.path.exists(folder):
+            return []
+        dates={pd.Timestamp(os.path.splitext(name)[0]) for name in os.listdir(folder) if os.path.splitext(name)[1] in self.suffix}
+        if start_date is not None:
+            dates={date for date in dates if date>=pd.Timestamp(start_date)}
+        if end_date is not None:
+            dates={date for date in dates if date<=pd.Timestamp(end_date)}
+        return sorted(dates)
+
+    def save_day(self,asset,date,df,format='feather'):
+        """将asset在date当日的K线写入本地(format:'feather'/'arrow'/'parquet')"""
+        import pyarrow as pa
+        folder=os.path.join(self.root,asset)
+        init_path(self.root)
+        init_path(folder)
+        table=pa.Table.from_pandas(df.reset_index(drop=True),preserve_index=False)
+        path=os.path.join(folder,pd.Timestamp(date).strftime('%Y%m%d')+'.'+format)
+        if format=='parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table,path)
+        else:
+            import pyarrow.feather as feather
+            feather.write_feather(table,path,compression='uncompressed')    # 不压缩才能memory_map零拷贝读取
+
+    def save(self,asset,df,format='feather'):
+        """将asset的K线(DataFrame,含date列)按交易日拆分写入本地"""
+        for date,slice_df in df.groupby('date'):
+            self.save_day(asset,date,slice_df,format=format)
+
+class RollCalendar:
+    """
+    期货主力合约/移仓换月日历:回测开始前由期货K线一次性计算,之后按(品种,交易日)O(1)查询当日主力合约
+    rule='volume':成交量最大的合约;rule='open_interest':持仓量最大的合约;rule='calendar':最近到期的合约
+    只在"下一交易日仍未到最后交易日"的合约中选择(保证在end_date前一个交易日收盘完成移仓),且主力合约只向后换月
+    """
+    rules=('volume','open_interest','calendar')
+
+    def __init__(self,df,rule='volume'):
+        if rule not in self.rules:
+            raise ValueError(f"未知的主力合约规则{rule},可选{self.rules}")
+        if rule!='calendar' and rule not in df.columns:
+            raise ValueError(f"期货K线缺少{rule}列,无法按{rule}计算主力合约")
+        df=df[['date','contract','end_date']+[col for col in ['volume','open_interest'] if col in df.columns]].copy()
+        df['date']=pd.to_datetime(df['date'])
+        df['end_date']=pd.to_datetime(df['end_date'])
+        df['product']=df['contract'].map(self.product)
+        dates=np.sort(df['date'].unique())
+        next_date=pd.Series(np.append(dates[1:],np.datetime64('NaT')),index=dates)
+        df['next_date']=df['date'].map(next_date)
+        df=df[df['end_date']>df['next_date'].fillna(df['date'])]     # 下一交易日仍可交易的合约
+        if rule=='calendar':
+            df=df.sort_values(['product','date','end_date'])
+            best=df.groupby(['product','date'],sort=False).head(1)
+        else:
+            best=df.sort_values(['product','date',rule],ascending=[True,True,False]).groupby(['product','date'],sort=False).head(1)
+        self.rule=rule
+        self.active={}      # (品种,交易日)→主力合约
+        self.dates={}       # 品种→交易日(np.array,用于非交易日的查询)
+        self.contracts={}   # 品种→各交易日的主力合约
+        self.switch={}      # 交易日→[(品种,旧主力合约,新主力合约),...]
+        rows=[]
+        for product,group in best.groupby('product'):
+            current,current_end=None,None
+            contracts=[]
+            for date,contract,end_date in zip(group['date'],group['contract'],group['end_date']):
+                # 新主力合约到期更晚时换月(旧主力合约不再可交易时,可选合约的到期日一定更晚)
+                if current is None or end_date>current_end:
+                    if current is not None:
+                        self.switch.setdefault(date,[]).append((product,current,contract))
+                        rows.append({'product':product,'date':date,'from_contract':current,'to_contract':contract})
+                    current,current_end=contract,end_date
+                self.active[(product,date)]=current
+                contracts.append(current)
+            self.dates[product]=group['date'].to_numpy()
+            self.contracts[product]=contracts
+        self.schedule=pd.DataFrame(rows,columns=['product','date','from_contract','to_contract'])
+
+    @staticmethod
+    def product(contract):
+        """合约代码中的品种(AU2502→AU)"""
+        match=re.match(r"[A-Za-z]+",str(contract))
+        return match.group(0).upper() if match else str(contract)
+
+    def active_contract(self,product,date):
+        """product在date的主力合约:交易日为字典查找,非交易日取之前最近一个交易日"""
+        date=pd.Timestamp(date)
+        contract=self.active.get((product,date))
+        if contract is not None or product not in self.dates:
+            return contract
+        i=np.searchsorted(self.dates[product],date.to_datetime64(),side='right')-1
+        return self.contracts[product][i] if i>=0 else None
+
+    def rolls(self,date):
+        """date当日需要移仓的[(品种,旧主力合约,新主力合约),...]"""
+        return self.switch.get(pd.Timestamp(date),[])
+
+class OptionExpiry:
+    """
+    期权到期日历:回测开始前由期权K线一次性计算 到期日→当日到期的期权,期权→标的期货合约
+    标的合约优先取K线表的underlying/contract列,没有时由期权代码解析(AU2502C500/m2505-C-3000→AU2502/m2505)
+    """
+    def __init__(self,df):
+        cols=['option','end_date']+[col for col in ['underlying','contract'] if col in df.columns]
+        df=df[cols].drop_duplicates('option',keep='last')
+        df=df.assign(end_date=pd.to_datetime(df['end_date'])).dropna(subset=['end_date'])
+        underlying=df['underlying'] if 'underlying' in df.columns else df['contract'] if 'contract' in df.columns else df['option'].map(self.parse)
+        self.underlying=dict(zip(df['option'],underlying))     # 期权→标的期货合约
+        self.expiry={date:group['option'].to_numpy() for date,group in df.groupby('end_date')}  # 到期日→期权(np.array)
+        self.schedule=pd.DataFrame({'option':df['option'].to_numpy(),'end_date':df['end_date'].to_numpy(),'underlying':underlying.to_numpy()}).sort_values(['end_date','option']).reset_index(drop=True)
+
+    @staticmethod
+    def parse(option):
+        """期权代码中的标的合约(AU2502C500→AU2502),无法解析时返回None"""
+        match=re.match(r"([A-Za-z]+\d+)-?[CP]-?\d",str(option))
+        return match.group(1) if match else None
+
+    def expiring(self,date):
+        """date当日到期的期权(np.array)"""
+        return self.expiry.get(pd.Timestamp(date),np.array([],dtype=object))
+
+class SignalCache:
+    """
+    信号表缓存:按日期分块(chunk_days个自然日一块),每块只查询一次信号表,块内按交易日拆分为DaySnapshot
+    (date)/(date,symbol)查询均为字典查找O(1);最多保留max_chunks块(LRU),内存只与块大小有关,与回测区间长度无关
+    loader(start_date,end_date)返回该区间内的信号(DataFrame,含date列)
+    """
+    def __init__(self,loader,key,start_date,chunk_days=30,max_chunks=3):
+        self.loader=loader
+        self.key=key                # 信号表的索引列(symbol/contract/option)
+        self.start_date=pd.Timestamp(start_date)
+        self.chunk_days=chunk_days
+        self.max_chunks=max_chunks
+        self.chunks=OrderedDict()   # 块编号→{交易日:DaySnapshot},按最近使用排序
+        self.lock=threading.Lock()  # 预取线程与主线程可能同时读取同一块
+
+    def chunk_id(self,date):
+        return (pd.Timestamp(date)-self.start_date).days//self.chunk_days
+
+    def load_chunk(self,i):
+        """读取第i块的信号并按交易日拆分"""
+        start_date=self.start_date+pd.Timedelta(days=i*self.chunk_days)
+        end_date=start_date+pd.Timedelta(days=self.chunk_days-1)
+        df=self.loader(start_date,end_date)
+        days={}
+        if df is not None and len(df)>0:
+            for date,slice_df in df.groupby('date',sort=False):
+                days[pd.Timestamp(date)]=DaySnapshot(date=date,df=slice_df,key=self.key)
+        return days
+
+    def chunk(self,date):
+        i=self.chunk_id(date)
+        with self.lock:
+            if i in self.chunks:
+                self.chunks.move_to_end(i)
+                return self.chunks[i]
+            days=self.load_chunk(i)
+            self.chunks[i]=days
+            while len(self.chunks)>self.max_chunks:     # 淘汰最久未使用的块
+                self.chunks.popitem(last=False)
+            return days
+
+    def day(self,date):
+        """date当日的全部信号(DaySnapshot),当日没有信号返回空截面"""
+        date=pd.Timestamp(date)
+        snap=self.chunk(date).get(date)
+        return snap if snap is not None else DaySnapshot(date=date,df=None,key=self.key)
+
+    def get(self,date,symbol):
+        """date当日symbol的信号{'long_signal':...},没有信号返回None"""
+        return self.day(date).get(symbol)
+
+    def prefetch(self,date):
+        """提前读取date所在的块(预取线程中运行)"""
+        self.chunk(date)
+
+class PhaseProfiler:
+    """
+    回测分阶段计时:按交易日记录各阶段(start_counter/*_counter_processing/roll_futures/monitor_*/trail_stops/settle_expiry/
+    calculate_*_profit/risk_mark/close_counter/策略)的
+    耗时、数据查询次数(session.run+数据源get_day)以及传输行数
+    只在Backtest(profile=True)时对相关方法做包装,不开启时没有任何额外开销
+    查询计入发起查询的线程当前正在计时的PhaseProfiler(组合回测中共用的数据源/session的查询计入各自的策略),
+    不在任何阶段中(如预取线程)时计入包装该查询函数的PhaseProfiler
+    """
+    active=threading.local()    # 各线程当前正在计时的PhaseProfiler
+    phases=['start_counter','stock_counter_processing','future_counter_processing','option_counter_processing',
+            'roll_futures','monitor_stock','monitor_future','monitor_option','trail_stops','settle_expiry',
+            'calculate_future_profit','calculate_option_profit','risk_mark','close_counter']
+
+    def __init__(self,date_getter):
+        self.date_getter=date_getter    # 返回当前交易日
+        self.records={}                 # {(date,phase):[seconds,calls,queries,rows]}
+        self.local=threading.local()    # 每个线程当前所处的阶段
+        self.lock=threading.Lock()
+
+    def current_phase(self):
+        stack=getattr(self.local,'stack',None)
+        if stack:
+            return stack[-1][0]
+        return 'prefetch' if threading.current_thread() is not threading.main_thread() else 'other'
+
+    def add(self,phase,seconds=0,calls=0,queries=0,rows=0):
+        key=(self.date_getter(),phase)
+        with self.lock:
+            record=self.records.setdefault(key,[0.0,0,0,0])
+            record[0]+=seconds;record[1]+=calls;record[2]+=queries;record[3]+=rows
+
+    def wrap(self,phase,func):
+        """包装func:嵌套调用的阶段(如monitor_option中的settle_expiry)单独计时,外层阶段只记录扣除嵌套阶段后的耗时"""
+        def wrapper(*args,**kwargs):
+            stack=getattr(self.local,'stack',None)
+            if stack is None:
+                stack=self.local.stack=[]
+            frame=[phase,0.0]   # 阶段,嵌套阶段的耗时
+            stack.append(frame)
+            outer=getattr(PhaseProfiler.active,'profiler',None)
+            PhaseProfiler.active.profiler=self
+            t0=time.perf_counter()
+            try:
+                return func(*args,**kwargs)
+            finally:
+                seconds=time.perf_counter()-t0
+                PhaseProfiler.active.profiler=outer
+                stack.pop()
+                if stack:
+                    stack[-1][1]+=seconds
+                self.add(phase,seconds=seconds-frame[1],calls=1)
+        return wrapper
+
+    def wrap_query(self,func):
+        """包装数据查询函数:查询次数与返回行数计入当前线程正在计时的PhaseProfiler的当前阶段(没有时计入self)"""
+        def wrapper(*args,**kwargs):
+            result=func(*args,**kwargs)
+            profiler=getattr(PhaseProfiler.active,'profiler',None) or self
+            profiler.add(profiler.current_phase(),queries=1,rows=len(result) if hasattr(result,'__len__') else 0)
+            return result
+        return wrapper
+
+    def frame(self):
+        """按交易日&阶段输出:date,phase,seconds,calls,queries,rows"""
+        rows=[(date,phase,*record) for (date,phase),record in self.records.items()]
+        return pd.DataFrame(rows,columns=['date','phase','seconds','calls','queries','rows'])
+
+    def summary(self,width=40):
+        """各阶段的耗时汇总(火焰图式的文本条形图)"""
+        df=self.frame().groupby('phase')[['seconds','calls','queries','rows']].sum().sort_values('seconds',ascending=False)
+        total=df['seconds'].sum()
+        df['share']=df['seconds']/total if total>0 else 0.0
+        lines=[f"{'phase':<28}{'seconds':>10}{'share':>8}{'queries':>9}{'rows':>10}"]
+        for phase,row in df.iterrows():
+            bar='█'*int(round(row['share']*width))
+            lines.append(f"{phase:<28}{row['seconds']:>10.3f}{row['share']:>8.1%}{int(row['queries']):>9}{int(row['rows']):>10} {bar}")
+        return "\n".join(lines)
+
+class LockedSession:
+    """
+    DolphinDB session代理:session的全部方法调用(run/existsTable/dropTable/...)经同一把锁串行,其余属性透传
+    dolphindb的session不是线程安全的,预取线程与主线程(引擎/策略代码/数据源)共用session时必须串行
+    同一个原始session无论被包装多少次(多个Backtest/DolphinDBSource)都共用一把锁(可重入)
+    """
+    locks={}    # id(原始session)→(原始session,锁);保留原始session的引用,避免id被复用
+
+    def __init__(self,session):
+        if isinstance(session,LockedSession):
+            session=session.session
+        self.session=session
+        self.lock=LockedSession.locks.setdefault(id(session),(session,threading.RLock()))[1]
+
+    def run(self,*args,**kwargs):
+        with self.lock:
+            return self.session.run(*args,**kwargs)
+
+    def __getattr__(self,name):
+        value=getattr(self.session,name)
+        if not callable(value):
+            return value
+        def locked(*args,**kwargs):
+            with self.lock:
+                return value(*args,**kwargs)
+        return locked
+
+class CountingSession:
+    """DolphinDB session代理:session.run的次数与返回行数计入PhaseProfiler,其余属性透传(经LockedSession串行)"""
+    def __init__(self,session,profiler):
+        self.session=session if isinstance(session,(LockedSession,CountingSession)) else LockedSession(session)
+        self.run=profiler.wrap_query(self.session.run)
+
+    def __getattr__(self,name):
+        return getattr(self.session,name)
+
+class RiskEngine:
+    """
+    组合层面的事前风控:七个持仓簿(stock/long/short/buycall/sellcall/buyput/sellput)按合约汇总名义市值与保证金
+    成交/平仓时只更新对应(持仓簿,合约)的一条记录,盘后盯市时按持仓簿批量更新,总保证金/总名义市值/单一合约名义市值随之增量维护
+    柜台撮合前对当日将要成交的全部开仓订单一次检查:按订单编号先后占用剩余额度(累计和一次比较),超限的订单被拒绝且不占用额度
+    max_margin:总保证金/权益上限;max_exposure:总名义市值/权益上限;max_concentration:单一合约(各持仓簿合计)名义市值/权益上限
+    min_cash:开仓后可用资金下限(默认0,即买入成本/保证金不能超过可用资金);None表示不限制
+    一个RiskEngine只记录一个Backtest的持仓,不能被多个Backtest共用(Portfolio为每个策略复制一份)
+    """
+    def __init__(self,max_margin=None,max_exposure=None,max_concentration=None,min_cash=0):
+        self.max_margin=max_margin
+        self.max_exposure=max_exposure
+        self.max_concentration=max_concentration
+        self.min_cash=min_cash
+        self.books={}               # 持仓簿→{合约:(名义市值,保证金)}
+        self.symbol_notional={}     # 合约→各持仓簿名义市值合计
+        self.total_notional=0.0
+        self.total_margin=0.0
+        self.rejected=0             # 被拒绝的订单数量
+        self.bound=False            # 是否已被某个Backtest使用
+
+    def cache_token(self):
+        """结果缓存key中代表该风控的内容:只取限额参数(持仓汇总/拒绝计数随回测运行而变化,不参与)"""
+        return {'max_margin':self.max_margin,'max_exposure':self.max_exposure,'max_concentration':self.max_concentration,'min_cash':self.min_cash}
+
+    def set(self,book,symbol,notional,margin):
+        """更新(持仓簿,合约)的名义市值与保证金,同时增量更新合计"""
+        positions=self.books.setdefault(book,{})
+        old_notional,old_margin=positions.pop(symbol,(0.0,0.0))
+        if notional>0 or margin!=0:
+            positions[symbol]=(notional,margin)
+        self.total_notional+=notional-old_notional
+        self.total_margin+=margin-old_margin
+        value=self.symbol_notional.get(symbol,0.0)+notional-old_notional
+        if abs(value)>1e-9:
+            self.symbol_notional[symbol]=value
+        else:
+            self.symbol_notional.pop(symbol,None)
+
+    def mark(self,book,symbols,notionals,margins):
+        """【盘后运行】按持仓簿批量更新:notionals为np.nan的合约(当日没有行情)沿用之前的名义市值,不在symbols中的合约清零"""
+        positions=self.books.get(book,{})
+        for symbol in set(positions)-set(symbols):
+            self.set(book,symbol,0.0,0.0)
+        for symbol,notional,margin in zip(symbols,notionals,margins):
+            if np.isnan(notional):
+                notional=positions.get(symbol,(0.0,0.0))[0]
+            self.set(book,symbol,notional,margin)
+
+    def check(self,cash,equity,symbols,cash_need,notional,margin):
+        """
+        一批开仓订单的事前检查(订单已按订单编号排序)
+        cash_need:各订单占用的资金(买入成本/保证金-卖出权利金),notional:名义市值,margin:保证金
+        各项限制先换算为剩余额度,按订单编号先后占用:通过的订单扣减额度,被拒绝的订单不占用额度(不影响之后的订单)
+        向量化:资金/保证金/名义市值按订单累计和、单一合约名义市值按合约分组累计和,与剩余额度一次比较,
+        第一笔超限订单之前的订单全部通过,该笔拒绝后从下一笔订单继续(比较次数=被拒绝订单数+1,全部通过时只比较一次)
+        return: 各订单是否通过(np.array[bool])
+        """
+        n=len(symbols)
+        ok=np.zeros(n,dtype=bool)
+        if n==0:
+            return ok
+        cash_need,notional,margin=(np.asarray(x,dtype=np.float64) for x in (cash_need,notional,margin))
+        cash_room=cash-self.min_cash if self.min_cash is not None else np.inf
+        margin_room=self.max_margin*equity-self.total_margin if self.max_margin is not None else np.inf
+        exposure_room=self.max_exposure*equity-self.total_notional if self.max_exposure is not None else np.inf
+        codes,uniques=pd.factorize(np.asarray(symbols,dtype=object))
+        if self.max_concentration is not None:  # 各合约的剩余名义市值额度
+            symbol_room=self.max_concentration*equity-np.array([self.symbol_notional.get(symbol,0.0) for symbol in uniques])
+        else:
+            symbol_room=np.full(len(uniques),np.inf)
+        start=0
+        while start<n:
+            code,value=codes[start:],notional[start:]
+            order=np.argsort(code,kind='stable')    # 按合约分组(组内保持订单编号先后)计算各合约的累计名义市值
+            grouped=np.cumsum(value[order])
+            first=np.r_[0,np.flatnonzero(np.diff(code[order]))+1]
+            grouped-=np.repeat(np.r_[0.0,grouped[first[1:]-1]],np.diff(np.r_[first,len(order)]))
+            symbol_cum=np.empty(len(order));symbol_cum[order]=grouped
+            fits=((np.cumsum(cash_need[start:])<=cash_room)&(np.cumsum(margin[start:])<=margin_room)
+                  &(np.cumsum(value)<=exposure_room)&(symbol_cum<=symbol_room[code]))
+            bad=np.flatnonzero(~fits)
+            stop=start+(bad[0] if len(bad) else len(fits))  # 第一笔超限的订单
+            ok[start:stop]=True
+            cash_room-=cash_need[start:stop].sum()
+            margin_room-=margin[start:stop].sum()
+            exposure_room-=notional[start:stop].sum()
+            symbol_room-=np.bincount(codes[start:stop],weights=notional[start:stop],minlength=len(uniques))
+            start=stop+1
+        self.rejected+=int((~ok).sum())
+        return ok
+
+class CostModel:
+    """
+    交易成本模型:在柜台撮合时对当日全部成交一次性计算成交价(含滑点)与手续费
+    fees:{'stock':{'rate':0.0003,'per_unit':0,'min':5},'future':{'rate':0.0001,'per_unit':0},'option':{'per_unit':2}}
+        rate:按成交额(价格*数量*合约乘数)收取的比例;per_unit:每单位数量(股/手/张)固定收取;min:每笔最低手续费
+        订单的commission不为None时,覆盖该笔成交的rate
+    multiplier:{'AU':1000,'AU2502':1000,...}按合约或品种的合约乘数(只用于计算手续费),默认1
+    slippage:{'stock':{'ticks':1,'tick':0.01},'future':{'ticks':1,'tick':0.02},'option':{'range':0.05}}
+        ticks*tick:按最小变动价位的滑点;range:按当日振幅(high-low)比例的滑点;成交价不超出当日[low,high]
+    """
+    def __init__(self,fees=None,multiplier=None,slippage=None):
+        self.fees=fees if fees else {}
+        self.multiplier=multiplier if multiplier else {}
+        self.slippage=slippage if slippage else {}
+        self.multiplier_cache={}    # 合约→合约乘数
+
+    def cache_token(self):
+        """结果缓存key中代表该成本模型的内容:只取构造参数(multiplier_cache随回测运行而填充,不参与)"""
+        return {'fees':self.fees,'multiplier':self.multiplier,'slippage':self.slippage}
+
+    def get_multiplier(self,symbol):
+        value=self.multiplier_cache.get(symbol)
+        if value is None:
+            value=self.multiplier.get(symbol,self.multiplier.get(RollCalendar.product(symbol),1))
+            self.multiplier_cache[symbol]=value
+        return value
+
+    def fill(self,asset,symbols,prices,vols,sides,highs=None,lows=None,rates=None):
+        """
+        批量计算成交价与手续费
+        sides:1为买入(开多/买入开仓/平空),-1为卖出;滑点总是使成交价变差
+        rates:各笔成交的手续费比例(np.nan为使用费率表)
+        return: 成交价(np.array),手续费(np.array)
+        """
+        prices=np.asarray(prices,dtype=np.float64)
+        vols=np.asarray(vols,dtype=np.float64)
+        slippage=self.slippage.get(asset,{})
+        slip=np.full(len(prices),slippage.get('ticks',0)*slippage.get('tick',0),dtype=np.float64)
+        if slippage.get('range') and highs is not None:
+            slip+=slippage['range']*(np.asarray(highs,dtype=np.float64)-np.asarray(lows,dtype=np.float64))
+        prices=prices+np.asarray(sides)*slip
+        if highs is not None:
+            prices=np.clip(prices,np.asarray(lows,dtype=np.float64),np.asarray(highs,dtype=np.float64))
+        fee=self.fees.get(asset,{})
+        rate=np.full(len(prices),fee.get('rate',0),dtype=np.float64)
+        if rates is not None:
+            rate=np.where(np.isnan(rates),rate,rates)
+        multiplier=np.array([self.get_multiplier(symbol) for symbol in symbols],dtype=np.float64)
+        fees=rate*np.abs(prices)*vols*multiplier+fee.get('per_unit',0)*vols
+        fees=np.where(vols>0,np.maximum(fees,fee.get('min',0)),0)
+        return prices,fees
+
+class EquityCurve:
+    """
+    预分配的逐日资金曲线:每个交易日一行,各字段为同一个二维numpy数组中的一列,容量不足时翻倍扩容
+    pnl为累计盈亏(扣除手续费后的已实现+未实现),equity=ori_cash+pnl,exposure为持仓的名义市值(按收盘价/结算价),fee为累计手续费
+    """
+    assets=['stock','future','option']
+    columns=['cash','profit','settle_profit','fee','equity','pnl',
+             'stock_pnl','future_pnl','option_pnl','stock_exposure','future_exposure','option_exposure']
+
+    def __init__(self,ori_cash,capacity=256):
+        self.ori_cash=ori_cash
+        self.size=0
+        self.dates=np.zeros(capacity,dtype='datetime64[ns]')
+        self.data=np.zeros((capacity,len(self.columns)),dtype=np.float64)
+        self.col={col:i for i,col in enumerate(self.columns)}
+        self.realized={asset:0.0 for asset in self.assets}  # 各资产已实现盈亏(成交记录pnl-fee的累计值)
+        self.offset={asset:0 for asset in self.assets}      # 已累计到的成交记录行数
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self,capacity):
+        """按交易日数量一次性分配"""
+        if capacity>len(self.dates):
+            dates=np.zeros(capacity,dtype='datetime64[ns]')
+            data=np.zeros((capacity,len(self.columns)),dtype=np.float64)
+            dates[:self.size]=self.dates[:self.size]
+            data[:self.size]=self.data[:self.size]
+            self.dates,self.data=dates,data
+
+    def add_realized(self,asset,ledger):
+        """增量累计成交记录中新增的已实现盈亏"""
+        n=len(ledger)
+        if n>self.offset[asset]:
+            self.realized[asset]+=np.nansum(ledger.column('pnl')[self.offset[asset]:n])-np.nansum(ledger.column('fee')[self.offset[asset]:n])
+            self.offset[asset]=n
+        return self.realized[asset]
+
+    def append(self,date,**values):
+        if self.size==len(self.dates):
+            self.reserve(max(2*len(self.dates),64))
+        date=pd.Timestamp(date).to_datetime64()
+        if self.size>0 and self.dates[self.size-1]==date:   # 同一交易日重复记录时覆盖
+            self.size-=1
+        row=self.data[self.size]
+        row[:]=0
+        for col,value in values.items():
+            row[self.col[col]]=value
+        if 'pnl' not in values:
+            row[self.col['pnl']]=sum(row[self.col[f"{asset}_pnl"]] for asset in self.assets)
+        row[self.col['equity']]=self.ori_cash+row[self.col['pnl']]
+        self.dates[self.size]=date
+        self.size+=1
+
+    def frame(self):
+        return pd.DataFrame(self.data[:self.size],index=pd.DatetimeIndex(self.dates[:self.size],name='date'),columns=self.columns)
+
+    def performance(self,ledgers,periods=252):
+        """
+        一次性计算总体及各资产的绩效指标(各资产的收益率按总资金计算贡献)
+        ledgers:{'stock':TradeLedger,...}
+        return: DataFrame(index=['total','stock','future','option'])
+        """
+        names=['total']+self.assets
+        pnl=self.data[:self.size][:,[self.col['pnl']]+[self.col[f"{asset}_pnl"] for asset in self.assets]]
+        if len(pnl)==0:
+            pnl=np.zeros((1,len(names)))
+        equity=self.ori_cash+pnl                                # 各列对应的资金曲线
+        ret=np.diff(pnl,axis=0)/(self.ori_cash+pnl[:-1,:1])     # 日收益率(各资产为对前一日总资金的贡献)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            if len(ret)>1:
+                mean,std=ret.mean(axis=0),ret.std(axis=0,ddof=1)
+                downside=np.sqrt((np.minimum(ret,0)**2).mean(axis=0))
+                sharpe=mean/std*np.sqrt(periods)
+                sortino=mean/downside*np.sqrt(periods)
+            else:
+                sharpe=sortino=np.full(len(names),np.nan)
+            peak=np.maximum.accumulate(equity,axis=0)
+            drawdown=equity/peak-1
+        # 最长回撤期:相邻两次创新高之间的最大间隔(交易日数)
+        index=np.arange(len(equity))[:,None]
+        last_peak=np.maximum.accumulate(np.where(equity>=peak,index,0),axis=0)
+        duration=(index-last_peak).max(axis=0)
+        # 换手率(成交额/平均资金)与胜率(盈利的平仓笔数/平仓笔数)
+        notional,wins,closes=[],[],[]
+        for asset in self.assets:
+            ledger=ledgers[asset]
+            notional.append(np.abs(ledger.column('price')*ledger.column('vol')).sum())
+            is_close=ledger.column('state')=='close'
+            wins.append(int((ledger.column('pnl')[is_close]>0).sum()))
+            closes.append(int(is_close.sum()))
+        notional=np.array([sum(notional)]+notional,dtype=np.float64)
+        wins=np.array([sum(wins)]+wins,dtype=np.float64)
+        closes=np.array([sum(closes)]+closes,dtype=np.float64)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            turnover=notional/equity[:,0].mean()
+            hit_rate=wins/closes
+        return pd.DataFrame({'pnl':pnl[-1],
+                             'sharpe':sharpe,
+                             'sortino':sortino,
+                             'max_drawdown':drawdown.min(axis=0),
+                             'max_drawdown_days':duration,
+                             'turnover':turnover,
+                             'hit_rate':hit_rate,
+                             'closed_trades':closes},index=names)
+
+class BacktestResult:
+    """
+    回测结果:资金/盈亏曲线(Series)+成交记录(DataFrame)+统计指标,不依赖matplotlib,可在批量/并行回测中直接返回
+    """
+    def __init__(self,name,cash,profit,settle_profit,stock_record,future_record,option_record,stats,profile=None,curve=None,performance=None):
+        self.name=name
+        self.cash=cash                      # 资金曲线
+        self.profit=profit                  # 逐笔盈亏曲线
+        self.settle_profit=settle_profit    # 盯市盈亏曲线
+        self.stock_record=stock_record
+        self.future_record=future_record
+        self.option_record=option_record
+        self.stats=stats                    # 统计指标
+        self.profile=profile                # 分阶段计时(profile=True时)
+        self.curve=curve                    # 逐日资金/盈亏/持仓市值曲线(EquityCurve.frame())
+        self.performance=performance        # 总体及各资产的绩效指标
+
+    def equity(self):
+        """cash/profit/settle_profit合并为一张表"""
+        return pd.concat([self.cash,self.profit,self.settle_profit],axis=1)
+
+    def plot(self,settle_profit=True):
+        """可视化(此时才导入matplotlib)"""
+        plt=get_plt()
+        # plt.plot(self.cash.index,self.cash.values,label='cash')
+        plt.plot(self.profit.index,self.profit.values,label='profit')
+        if settle_profit:
+            plt.plot(self.settle_profit.index,self.settle_profit.values,label='settle_profit')
+        plt.legend(frameon=False)
+        plt.show()
+
 """
 仿真策略运行时间轴(Day):
-·start_counter:柜台服务启动,更新行情数据
+(策略为实现pre_open/on_bar/post_close的对象时,由Backtest.run_days驱动以下流程,并在后台预取下一交易日行情)
+·start_counter:柜台服务启动,更新行情数据(counter_view=True时柜台为K线表的只读视图,无需复制)
 --------------------------------------------
 ·order_open_future/order_close_future/order_open_option/order_close_option:根据strategy_signal发送每日订单至柜台(开仓/平仓)
 ·future_counter_processing/option_counter_processing:柜台处理订单判断是否能够完成
@@ -35,13 +1589,132 @@ option_sell_P_position={'option':[{'price':100,'pre_settle':90,'strike':60,'marg
 ·[自动执行]execute_future/execute_option/close_future/close_option:执行柜台指令
 --------------------------------------------
 ·calculate_future_profit:计算期货当日盯市收益
-·calculate_option_profit:计算期权当日盯市收益
+·calculate_option_profit:计算期权当日盯市收益(calculate_profit:一次完成全部期货&期权持仓的盯市)
 ·close_counter:柜台服务关闭,更新柜台未执行订单的前结算价
 """
+def stable_repr(value,depth=0):
+    """
+    对象的稳定文本表示(用于计算缓存key):dict按key排序,数组/表按内容哈希,函数/类取源码,自定义对象按类名+属性展开,不含内存地址
+    对象实现cache_token()时只展开其返回值(如CostModel/RiskEngine:运行中填充的缓存/持仓状态不参与key)
+    """
+    if depth>8:
+        return type(value).__qualname__
+    if isinstance(value,dict):
+        items=sorted(value.items(),key=lambda item:repr(item[0]))
+        return '{'+','.join(f"{stable_repr(k,depth+1)}:{stable_repr(v,depth+1)}" for k,v in items)+'}'
+    if isinstance(value,(list,tuple,set,frozenset)):
+        items=[stable_repr(v,depth+1) for v in value]
+        if isinstance(value,(set,frozenset)):
+            items=sorted(items)
+        return f"{type(value).__name__}[{','.join(items)}]"
+    if isinstance(value,(pd.DataFrame,pd.Series,pd.Index)):
+        return f"{type(value).__name__}{value.shape}:{hashlib.sha256(pd.util.hash_pandas_object(value,index=True).values.tobytes()).hexdigest()}"
+    if isinstance(value,np.ndarray):
+        data=repr(value.tolist()).encode() if value.dtype==object else value.tobytes()
+        return f"ndarray{value.dtype}{value.shape}:{hashlib.sha256(data).hexdigest()}"
+    if inspect.isfunction(value) or inspect.isclass(value) or inspect.ismethod(value):
+        try:
+            return inspect.getsource(value)
+        except (OSError,TypeError):
+            return getattr(value,'__qualname__',repr(value))
+    if hasattr(value,'cache_token') and not inspect.ismodule(value):
+        return f"{type(value).__qualname__}({stable_repr(value.cache_token(),depth+1)})"
+    if hasattr(value,'__dict__') and not inspect.ismodule(value):
+        return f"{type(value).__qualname__}({stable_repr(vars(value),depth+1)})"
+    return repr(value)
+
+class ResultCache:
+    """
+    回测结果缓存(本地磁盘):key为策略源码+构造参数+seed+K线/信号表数据版本的哈希,value为pickle后的BacktestResult
+    命中时直接读取成交记录/资金曲线/统计指标,不再查询行情和循环交易日
+    max_bytes:缓存目录的容量上限,超出时按最近访问时间淘汰(LRU,读取时更新文件的访问时间)
+    """
+    suffix='.pkl'
+
+    def __init__(self,root,max_bytes=2**30):
+        self.root=root
+        self.max_bytes=max_bytes
+        self.hits=0
+        self.misses=0
+        os.makedirs(root,exist_ok=True)
+
+    def path(self,key):
+        return os.path.join(self.root,f"{key}{self.suffix}")
+
+    def get(self,key):
+        """返回缓存的BacktestResult,没有时返回None"""
+        path=self.path(key)
+        try:
+            with open(path,'rb') as f:
+                result=pickle.load(f)
+        except (OSError,EOFError,pickle.UnpicklingError):
+            self.misses+=1
+            return None
+        os.utime(path,None)     # 更新访问时间(LRU)
+        self.hits+=1
+        return result
+
+    def put(self,key,result):
+        """保存BacktestResult(先写临时文件再替换,多个进程同时写入同一key时不会读到不完整的文件),之后按容量淘汰"""
+        path=self.path(key)
+        tmp=f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp,'wb') as f:
+            pickle.dump(result,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp,path)
+        self.evict()
+
+    def entries(self):
+        """[(最近访问时间,大小,路径),...]按最近访问时间从旧到新排列"""
+        entries=[]
+        for name in os.listdir(self.root):
+            if name.endswith(self.suffix):
+                path=os.path.join(self.root,name)
+                try:
+                    stat=os.stat(path)
+                except OSError:     # 被其他进程淘汰
+                    continue
+                entries.append((stat.st_mtime_ns,stat.st_size,path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _,size,_ in self.entries())
+
+    def evict(self):
+        """总大小超过max_bytes时从最久未访问的结果开始删除"""
+        entries=self.entries()
+        total=sum(size for _,size,_ in entries)
+        for _,size,path in entries:
+            if total<=self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total-=size
+
+    def clear(self):
+        for _,_,path in self.entries():
+            os.remove(path)
+
 class Backtest:
     """
     股票+期货+期权回测框架
     """
+    checkpoint_fields=[ # 快照中保存的回测状态(行情截面/session/数据源/计时不保存)
+        'current_date','current_str_date','current_dot_date','orderNum','counter_end_date','rng',
+        'stock_counter','future_counter','option_counter',
+        'stock_ledger','future_ledger','option_ledger',
+        'stock_position','long_position','short_position','buycall_position','buyput_position','sellcall_position','sellput_position',
+        'cash','ori_cash','profit','profit_settle','fees','cash_Dict','profit_Dict','settle_profit_Dict','curve','ambiguous_ledger','rejected_orders','risk','fill_capacity',
+    ]
+    config_exclude=(    # 不影响回测结果的构造参数(不计入结果缓存的key)
+        'self','strategy','session','data_source','result_cache','prefetch','profile','checkpoint_dir','checkpoint_every',
+    )
+    counter_columns={   # 柜台(K线表→柜台)的字段
+        'stock':"date,symbol,open,high,low,close,volume",
+        'future':"date,contract,pre_settle,nullFill(open,settle) as open,nullFill(high,settle) as high,nullFill(low,settle) as low,nullFill(close,settle) as close,settle,volume,start_date,end_date",
+        'option':"date,option,pre_settle,nullFill(open,settle) as open,nullFill(high,settle) as high,nullFill(low,settle) as low,nullFill(close,settle) as close,settle,volume,start_date,end_date,level",
+    }
     def __init__(self,start_date,end_date,strategy,
                  run_stock=False,stock_K_database=None,stock_K_table=None,
                  stock_counter_database=None,stock_counter_table=None,
@@ -53,18 +1726,42 @@ class Backtest:
                  run_option=False,option_K_database=None,option_K_table=None,
                  option_counter_database=None,option_counter_table=None,
                  option_signal_database=None,option_signal_table=None,
-                 cash=1000000,name="strategy",session=None,
+                 cash=1000000,name="strategy",session=None,data_source=None,counter_view=True,
+                 order_sequence=None,prefetch=True,profile=False,
+                 checkpoint_dir=None,checkpoint_every=20,signal_chunk_days=30,roll_rule=None,participation=None,cost_model=None,exercise_margin=0.1,risk=None,
+                 result_cache=None,
                  ):
         """
         初始化策略参数
+        data_source:行情数据源(默认为DolphinDBSource,读取DolphinDB柜台表;离线回测可传入LocalColumnarSource)
+        counter_view:True时柜台为K线表上按日期窗口读取的只读视图(不需要柜台表);False时每日向柜台表追加当日切片
+        order_sequence:引擎驱动交易日循环时monitor_*的撮合顺序(True最高价先触发/False最低价先触发/None按seed随机)
+        prefetch:引擎驱动交易日循环时,是否在后台线程预取下一交易日的行情截面
+        profile:是否按交易日记录各阶段耗时/查询次数/传输行数(见profile_frame/profile_summary)
+        checkpoint_dir:引擎驱动交易日循环时,每checkpoint_every个交易日将完整回测状态快照保存到该目录(run(resume=True)从最近的快照继续)
+        signal_chunk_days:get_signal每次从信号表读取的自然日数(按块缓存,最多保留3块)
+        roll_rule:期货自动移仓换月的主力合约规则('volume'/'open_interest'/'calendar'),None时不移仓(到最后交易日平仓)
+        participation:柜台撮合时每个合约当日最多成交K线volume的比例(如0.1),未成交部分继续挂单;None时不限制
+        cost_model:交易成本模型(CostModel),None时按挂单价成交且不收手续费
+        exercise_margin:实值期权到期行权转为期货持仓时的保证金比例(保证金=行权价*数量*exercise_margin)
+        risk:事前风控(RiskEngine),柜台撮合前拒绝超出资金/保证金/敞口/集中度限制的开仓订单;None时不检查
+        result_cache:回测结果缓存(ResultCache),策略源码/构造参数/seed/行情与信号数据均未变化时run()直接返回缓存的结果
+        strategy:函数strategy(self)时由策略自行循环交易日;
+                 对象(实现pre_open/on_bar/post_close中的任意方法)时由引擎循环交易日并在各阶段调用对应方法
         """
         """基本信息"""
+        self.config={key:value for key,value in locals().items() if key not in self.config_exclude}  # 构造参数(用于结果缓存的key)
         self.name=name        # 策略名称(默认为strategy)
-        self.session=session  # DolphinDB的session
+        self.session=LockedSession(session) if session is not None else None  # DolphinDB的session(全部调用加锁,与预取线程串行)
+        self.result_cache=result_cache  # 回测结果缓存(None为不缓存)
 
         """策略模块"""
         self.strategy=strategy  # 传入策略
         self.seed=42
+        self.order_sequence=order_sequence  # 最高价/最低价触发顺序(None为随机)
+        self.prefetch=prefetch              # 是否后台预取下一交易日行情
+        self.checkpoint_dir=checkpoint_dir      # 快照目录(None为不保存)
+        self.checkpoint_every=checkpoint_every  # 每多少个交易日保存一次快照
 
         """回测模块"""
         # 0.时间类
@@ -87,6 +1784,35 @@ class Backtest:
         self.option_counter_database=option_counter_database
         self.option_counter_table=option_counter_table
         self.option_counter_DataFrame=None
+        self.snapshot_key={'stock':'symbol','future':'contract','option':'option'}  # 行情截面的索引列
+        self.snapshot_Dict={}   # 当日行情截面缓存:{'stock':DaySnapshot,'future':DaySnapshot,'option':DaySnapshot}
+        self.counter_view=counter_view  # 柜台是否为K线表上的只读视图
+        self.counter_end_date=None      # 实体柜台表已追加到的交易日
+        if data_source is None and counter_view:    # 直接读取K线表[start_date,end_date]窗口内的数据
+            data_source=DolphinDBSource(session=self.session,tables={'stock':(stock_K_database,stock_K_table),
+                                                                    'future':(future_K_database,future_K_table),
+                                                                    'option':(option_K_database,option_K_table),
+                                                                    'stock_signal':(stock_signal_database,stock_signal_table),
+                                                                    'future_signal':(future_signal_database,future_signal_table),
+                                                                    'option_signal':(option_signal_database,option_signal_table)},
+                                        columns=self.counter_columns,start_date=start_date,end_date=end_date)
+        elif data_source is None:
+            data_source=DolphinDBSource(session=self.session,tables={'stock':(stock_counter_database,stock_counter_table),
+                                                                    'future':(future_counter_database,future_counter_table),
+                                                                    'option':(option_counter_database,option_counter_table),
+                                                                    'stock_signal':(stock_signal_database,stock_signal_table),
+                                                                    'future_signal':(future_signal_database,future_signal_table),
+                                                                    'option_signal':(option_signal_database,option_signal_table)})
+        self.data_source=data_source
+        self.signal_chunk_days=signal_chunk_days
+        self.signal_cache={}    # 信号表缓存:{'stock':SignalCache,...},首次get_signal时创建
+        self.roll_rule=roll_rule    # 主力合约规则(None为不自动移仓)
+        self.roll_calendar=None     # RollCalendar,首次使用时由期货K线一次性计算
+        self.option_expiry=None     # OptionExpiry,首次使用时由期权K线一次性计算
+        self.exercise_margin=exercise_margin
+        self.profiler=None      # 分阶段计时(profile=True时启用)
+        if profile:
+            self.enable_profiler()
 
         # 1.股票类
         self.stock_K_database=stock_K_database
@@ -111,33 +1837,51 @@ class Backtest:
         self.run_stock=run_stock     # 策略中是否包含股票
         self.run_future=run_future   # 策略中是否包含期货
         self.run_option=run_option   # 策略中是否包含期权
-        self.stock_counter={}        # 股票柜台
-        self.future_counter={}       # 期货柜台
-        self.option_counter={}       # 期权柜台
+        self.participation=participation    # 成交量约束(None为不限制)
+        self.fill_capacity=FillCapacity()   # 当日已用成交量容量(Portfolio中各策略共用)
+        self.cost_model=cost_model          # 交易成本模型(None为无成本)
+        if risk is not None:
+            if risk.bound:
+                raise ValueError("RiskEngine已被其他Backtest使用,每个Backtest需要单独的RiskEngine(组合回测由Portfolio为各策略复制)")
+            risk.bound=True
+        self.risk=risk                      # 事前风控(None为不检查)
+        self.stock_counter=OrderCounter(key='symbol')      # 股票柜台
+        self.future_counter=OrderCounter(key='contract')   # 期货柜台
+        self.option_counter=OrderCounter(key='option')     # 期权柜台
 
         # 1.持仓类
-        self.stock_record=pd.DataFrame({'state':[],'reason':[],'date':[],'symbol':[],'price':[],'vol':[],'pnl':[]})
-        self.future_record=pd.DataFrame({'state':[],'reason':[],'date':[],'contract':[],'order_type':[],'price':[],'vol':[],'pnl':[]})
-        self.option_record=pd.DataFrame({'state':[],'reason':[],'date':[],'option':[],'order_type':[],'price':[],'vol':[],'pnl':[]})   # order_type:['BC','SC','BP','SP']
-        self.stock_position={}      # 当前股票持仓情况 format:见开头注释
-        self.long_position={}       # 当前多单期货持仓情况 format:见开头注释
-        self.short_position={}      # 当前空单期货持仓情况
-        self.buycall_position={}    # 当前买入看涨期权持仓情况  format:见开头注释
-        self.buyput_position={}     # 当前买入看跌期权持仓情况
-        self.sellcall_position={}   # 当前卖出看涨期权持仓情况  format:见开头注释
-        self.sellput_position={}    # 当前卖出看跌期权持仓情况
+        self.stock_ledger=TradeLedger({'state':object,'reason':object,'date':'datetime64[ns]','symbol':object,'price':np.float64,'vol':np.float64,'pnl':np.float64,'fee':np.float64})   # 读取self.stock_record时转换为DataFrame
+        self.future_ledger=TradeLedger({'state':object,'reason':object,'date':'datetime64[ns]','contract':object,'order_type':object,'price':np.float64,'vol':np.float64,'pnl':np.float64,'fee':np.float64})
+        self.option_ledger=TradeLedger({'state':object,'reason':object,'date':'datetime64[ns]','option':object,'order_type':object,'price':np.float64,'vol':np.float64,'pnl':np.float64,'fee':np.float64})   # order_type:['BC','SC','BP','SP']
+        stock_fields=['price','min_price','max_price','max_date','trail','vol']
+        future_fields=['price','pre_settle','margin','min_price','max_price','max_date','trail','vol']
+        option_fields=['price','pre_settle','strike','margin','min_price','max_price','max_date','trail','vol']
+        self.stock_position=LotBook(key='symbol',fields=stock_fields)       # 当前股票持仓情况 format:见开头注释
+        self.long_position=LotBook(key='contract',fields=future_fields)     # 当前多单期货持仓情况 format:见开头注释
+        self.short_position=LotBook(key='contract',fields=future_fields,sign=-1)    # 当前空单期货持仓情况
+        self.buycall_position=LotBook(key='option',fields=option_fields)    # 当前买入看涨期权持仓情况  format:见开头注释
+        self.buyput_position=LotBook(key='option',fields=option_fields)     # 当前买入看跌期权持仓情况
+        self.sellcall_position=LotBook(key='option',fields=option_fields,sign=-1)   # 当前卖出看涨期权持仓情况  format:见开头注释
+        self.sellput_position=LotBook(key='option',fields=option_fields,sign=-1)    # 当前卖出看跌期权持仓情况
 
         # 2.利润类【之后需要对不同资产(option/future)的收益进行统计】
         self.cash=cash      # format:1000000 初始资金
         self.ori_cash=cash  # 初始资金(const，用于计算收益率)
         self.profit=0       # format:0 逐笔盈亏(卖出价-买入价)   # 只对已经平仓的合约进行计算
         self.profit_settle=0 # format:0 盯市盈亏(结算价/卖出价-昨结算价)  # 先对当日平仓的合约进行计算,之后对未平仓的合约进行计算
+        self.fees=0         # format:0 累计手续费
         self.cash_Dict={pd.to_datetime(self.start_date):self.ori_cash}  # 用于记录cash的历史波动:{'date':cash}
         self.profit_Dict={pd.to_datetime(self.start_date):0}  # 用于记录profit的历史波动:{'date':profit}
         self.settle_profit_Dict={pd.to_datetime(self.start_date):0} # 用于记录settle_profit的历史波动:{'date':settle_profit}
+        self.curve=EquityCurve(ori_cash=cash)   # 逐日资金/盈亏/持仓市值曲线(numpy预分配)
+        self.curve.append(pd.to_datetime(self.start_date),cash=cash)
+        self.ambiguous_ledger=TradeLedger({'date':'datetime64[ns]','asset':object,'symbol':object,'side':object,'price':np.float64,'alternate':np.float64,'vol':np.float64,'delta':np.float64})   # 止盈止损同日触发的平仓记录
+        self.rejected_orders=[]     # 被风控拒绝的订单:[{'date','asset','orderNum','order'(订单)}]
 
     def init_counter(self):
-        """【回测前运行】期货柜台&期权柜台初始化"""
+        """【回测前运行】期货柜台&期权柜台初始化(仅DolphinDB数据源且counter_view=False时需要)"""
+        if not isinstance(self.data_source,DolphinDBSource) or self.counter_view:
+            return
         if self.run_stock:  # 如果运行股票策略
             if self.session.existsTable(self.stock_counter_database,self.stock_counter_table):
                 self.session.dropTable(self.stock_counter_database,self.stock_counter_table)
@@ -167,34 +1911,71 @@ class Backtest:
             """)
 
     def start_counter(self):
-        """【盘前运行】daily counter start for data receiving"""
-        if self.run_stock:
-            session.run(f"""table=loadTable("{self.stock_counter_database}","{self.stock_counter_table}");
-                        delete from table; // 删除counter表中的所有数据
-                        pt=select date,symbol,open,high,low,close,volume from loadTable("{self.stock_K_database}","{self.stock_K_table}") where date>=date({self.start_dot_date});
+        """
+        【盘前运行】daily counter start for data receiving
+        counter_view=True:柜台为K线表上[start_date,end_date]的只读视图,按交易日直接读取K线表,不复制任何数据
+        counter_view=False:柜台为实体表,每次只追加上次追加日期之后至当前交易日的K线切片
+        """
+        self.snapshot_Dict={}   # 柜台数据已更新,清空行情截面缓存
+        if not isinstance(self.data_source,DolphinDBSource):   # 本地数据源直接按交易日读取文件
+            return
+        if self.counter_view:   # 视图模式不需要复制数据
+            return
+        if self.counter_end_date is not None and pd.Timestamp(self.current_date)<=self.counter_end_date:   # 当日切片已经追加
+            return
+        from_dot_date=self.counter_end_date.strftime('%Y.%m.%d') if self.counter_end_date is not None else None
+        to_dot_date=pd.Timestamp(self.current_date).strftime('%Y.%m.%d')
+        for asset in ['stock','future','option']:
+            if not getattr(self,f"run_{asset}"):
+                continue
+            if from_dot_date is None:   # 第一次启动柜台:清空柜台表
+                where=f"date>=date({self.start_dot_date}) and date<=date({to_dot_date})"
+                self.session.run(f"""delete from loadTable("{getattr(self,f'{asset}_counter_database')}","{getattr(self,f'{asset}_counter_table')}")""")
+            else:
+                where=f"date>date({from_dot_date}) and date<=date({to_dot_date})"
+            self.session.run(f"""table=loadTable("{getattr(self,f'{asset}_counter_database')}","{getattr(self,f'{asset}_counter_table')}");
+                        pt=select {self.counter_columns[asset]} from loadTable("{getattr(self,f'{asset}_K_database')}","{getattr(self,f'{asset}_K_table')}") where {where};
                         table.append!(pt);
                         undef(`pt);
                         """)
+        self.counter_end_date=pd.Timestamp(self.current_date)
 
-        if self.run_future:
-            session.run(f"""table=loadTable("{self.future_counter_database}","{self.future_counter_table}");
-                        delete from table; // 删除counter表中的所有数据
-                        pt=select date,contract,pre_settle,nullFill(open,settle) as open,nullFill(high,settle) as high,nullFill(low,settle) as low,nullFill(close,settle) as close,settle,volume,start_date,end_date from loadTable("{self.future_K_database}","{self.future_K_table}") where date>=date({self.start_dot_date});
-                        table.append!(pt);
-                        undef(`pt);
-                        """)
-        if self.run_option:
-            session.run(f"""table=loadTable('{self.option_counter_database}','{self.option_counter_table}');
-                        delete from table; // 删除counter表中的所有数据
-                        pt=select date,option,pre_settle,nullFill(open,settle) as open,nullFill(high,settle) as high,nullFill(low,settle) as low,nullFill(close,settle) as close,settle,volume,start_date,end_date,level from loadTable("{self.option_K_database}","{self.option_K_table}") where date>=date({self.start_dot_date});                    
-                        for (y in exec distinct(year(date)) from pt){{
-                            slice_pt=select * from pt where year(date)=y;
-                            table.append!(slice_pt);
-                        }};
-                        undef(`pt`slice_pt);
-                        """)
+    def get_snapshot(self,asset):
+        """
+        【盘中运行】获取当前交易日asset('stock'/'future'/'option')的行情截面
+        同一交易日只向数据源发送一次查询,之后的撮合/监控/盯市均复用该截面
+        """
+        snap=self.snapshot_Dict.get(asset)
+        if snap is not None and snap.date==pd.Timestamp(self.current_date):
+            return snap
+        snap=DaySnapshot(date=self.current_date,df=self.read_day(asset,self.current_date),key=self.snapshot_key[asset])
+        self.snapshot_Dict[asset]=snap
+        return snap
+
+    def signal(self,asset):
+        """asset('stock'/'future'/'option')信号表的SignalCache,没有信号表返回None"""
+        cache=self.signal_cache.get(asset)
+        if cache is None and self.data_source.has_asset(f"{asset}_signal"):
+            loader=lambda start_date,end_date:self.data_source.get_range(f"{asset}_signal",start_date,end_date)
+            cache=SignalCache(loader=loader,key=self.snapshot_key[asset],start_date=self.start_date,chunk_days=self.signal_chunk_days)
+            self.signal_cache[asset]=cache
+        return cache
 
-    def order_open_stock(self,symbol,vol,price,min_price=None,max_price=None,max_date=None,min_order_date=None,max_order_date=None,commission=None,reason=None):
+    def get_signal(self,asset,symbol=None,date=None):
+        """
+        【盘中运行】读取信号表(按块批量读取后缓存,策略不需要逐日/逐合约查询信号表)
+        symbol=None:返回date当日全部信号(DaySnapshot,可用.df/.column/.get);否则返回该合约当日的信号dict(没有返回None)
+        date默认为当前交易日
+        """
+        cache=self.signal(asset)
+        date=self.current_date if date is None else date
+        if cache is None:
+            return None
+        if symbol is None:
+            return cache.day(date)
+        return cache.get(date,symbol)
+
+    def order_open_stock(self,symbol,vol,price,min_price=None,max_price=None,max_date=None,trail=None,min_order_date=None,max_order_date=None,commission=None,reason=None,oco=None):
         """【盘中运行】股票订单发送至stock_counter,如果不设置max_order_date,每天都会尝试在min_order_date后发送该订单"""
         if not min_order_date:
             min_order_date=pd.Timestamp(self.start_date)
@@ -211,11 +1992,17 @@ class Backtest:
                                             'min_price':min_price,
                                             'max_price':max_price,
                                             'max_date':max_date,
+                                            'trail':trail,
                                             'commission':commission,
-                                            'reason':reason}
+                                            'reason':reason,
+                                            'oco':oco}
+        return self.orderNum
 
-    def order_close_stock(self,symbol,vol,price,min_order_date=None,max_order_date=None,reason=None):
-        """【盘中运行】股票卖出信号发送至stock_counter,如果不设置max_order_date,每天都会在min_order_date后尝试卖出该股票"""
+    def order_close_stock(self,symbol,vol,price,min_order_date=None,max_order_date=None,reason=None,oco=None,stop=False):
+        """
+        【盘中运行】股票卖出信号发送至stock_counter,如果不设置max_order_date,每天都会在min_order_date后尝试卖出该股票
+        stop=True:止损单,最低价<=price时触发,按price与开盘价中较差的价格成交(跳空低开时按开盘价)
+        """
         if not min_order_date:
             min_order_date=pd.Timestamp(self.start_date)
         if not max_order_date:
@@ -228,9 +2015,12 @@ class Backtest:
                                             'symbol':symbol,
                                             'vol':vol,
                                             'price':price,
-                                            'reason':reason}
+                                            'reason':reason,
+                                            'oco':oco,
+                                            'stop':-1 if stop else 0}
+        return self.orderNum
 
-    def order_open_future(self,order_type,contract,vol,price,pre_settle,margin,min_price=None,max_price=None,max_date=None,min_order_date=None,max_order_date=None,commission=None,reason=None):
+    def order_open_future(self,order_type,contract,vol,price,pre_settle,margin,min_price=None,max_price=None,max_date=None,trail=None,min_order_date=None,max_order_date=None,commission=None,reason=None,oco=None):
         """【盘中运行】期货订单发送至future_counter,如果不设置max_order_date,每天都会尝试在min_order_date后发送该订单"""
         if not min_order_date:
             min_order_date=pd.Timestamp(self.start_date)
@@ -251,11 +2041,17 @@ class Backtest:
                                             'min_price':min_price,
                                             'max_price':max_price,
                                             'max_date':max_date,
+                                            'trail':trail,
                                             'commission':commission,
-                                            'reason':reason}
+                                            'reason':reason,
+                                            'oco':oco}
+        return self.orderNum
 
-    def order_close_future(self,order_type,contract,vol,price,min_order_date=None,max_order_date=None,reason=None):
-        """【盘中运行】期货平仓发送至future_counter,如果不设置max_order_date,每天都会在min_order_date后尝试平仓该订单"""
+    def order_close_future(self,order_type,contract,vol,price,min_order_date=None,max_order_date=None,reason=None,oco=None,stop=False):
+        """
+        【盘中运行】期货平仓发送至future_counter,如果不设置max_order_date,每天都会在min_order_date后尝试平仓该订单
+        stop=True:止损单,多单最低价<=price(空单最高价>=price)时触发,按price与开盘价中较差的价格成交
+        """
         if not min_order_date:
             min_order_date=pd.Timestamp(self.start_date)
         if not max_order_date:
@@ -269,9 +2065,12 @@ class Backtest:
                                             'contract':contract,
                                             'vol':vol,
                                             'price':price,
-                                            'reason':reason}
+                                            'reason':reason,
+                                            'oco':oco,
+                                            'stop':({'long':-1,'short':1}[order_type] if stop else 0)}
+        return self.orderNum
 
-    def order_open_option(self,order_type,order_BS,option,vol,price,pre_settle,strike,margin,min_price=None,max_price=None,max_date=None,min_order_date=None,max_order_date=None,commission=None,reason=None):
+    def order_open_option(self,order_type,order_BS,option,vol,price,pre_settle,strike,margin,min_price=None,max_price=None,max_date=None,trail=None,min_order_date=None,max_order_date=None,commission=None,reason=None,oco=None):
         """【盘中运行】期权买入订单发送至option_counter,如果不设置max_order_date,每天都会尝试发送该订单"""
         if not min_order_date:
             min_order_date=pd.Timestamp(self.start_date)
@@ -296,11 +2095,17 @@ class Backtest:
                                             'min_price':min_price,
                                             'max_price':max_price,
                                             'max_date':max_date,
+                                            'trail':trail,
                                             'commission':commission,
-                                            'reason':reason}
+                                            'reason':reason,
+                                            'oco':oco}
+        return self.orderNum
 
-    def order_close_option(self,order_type,order_BS,option,vol,price,min_order_date=None,max_order_date=None,reason=None):
-        """【盘中运行】期权平仓发送至option_counter,如果不设置max_order_date,每天都会尝试平仓该订单"""
+    def order_close_option(self,order_type,order_BS,option,vol,price,min_order_date=None,max_order_date=None,reason=None,oco=None,stop=False):
+        """
+        【盘中运行】期权平仓发送至option_counter,如果不设置max_order_date,每天都会尝试平仓该订单
+        stop=True:止损单,买方最低价<=price(卖方最高价>=price)时触发,按price与开盘价中较差的价格成交
+        """
         if not min_order_date:
             min_order_date=pd.Timestamp(self.start_date)
         if not max_order_date:
@@ -315,412 +2120,552 @@ class Backtest:
                                             'option':option,
                                             'vol':vol,
                                             'price':price,
-                                            'reason':reason}
+                                            'reason':reason,
+                                            'oco':oco,
+                                            'stop':({'buy':-1,'sell':1}[order_BS] if stop else 0)}
+        return self.orderNum
+
+    def order_bracket_stock(self,symbol,vol,take_profit,stop_loss,min_order_date=None,max_order_date=None):
+        """
+        【盘中运行】股票止盈/止损OCO平仓单:两笔平仓单同时挂在柜台,其中一笔成交后另一笔自动撤销
+        止盈为限价单,止损为止损单(跳空穿越时按开盘价成交);同一根K线两笔都可成交时按order_sequence决定先成交的一笔
+        """
+        oco=self.orderNum+1     # 以第一笔订单编号作为OCO组号
+        self.order_close_stock(symbol=symbol,vol=vol,price=take_profit,min_order_date=min_order_date,max_order_date=max_order_date,reason='take_profit',oco=oco)
+        self.order_close_stock(symbol=symbol,vol=vol,price=stop_loss,min_order_date=min_order_date,max_order_date=max_order_date,reason='stop_loss',oco=oco,stop=True)
+        return oco
+
+    def order_bracket_future(self,order_type,contract,vol,take_profit,stop_loss,min_order_date=None,max_order_date=None):
+        """【盘中运行】期货止盈/止损OCO平仓单(多单take_profit>stop_loss,空单相反)"""
+        oco=self.orderNum+1
+        self.order_close_future(order_type=order_type,contract=contract,vol=vol,price=take_profit,min_order_date=min_order_date,max_order_date=max_order_date,reason='take_profit',oco=oco)
+        self.order_close_future(order_type=order_type,contract=contract,vol=vol,price=stop_loss,min_order_date=min_order_date,max_order_date=max_order_date,reason='stop_loss',oco=oco,stop=True)
+        return oco
 
-    def stock_counter_processing(self):
+    def order_bracket_option(self,order_type,order_BS,option,vol,take_profit,stop_loss,min_order_date=None,max_order_date=None):
+        """【盘中运行】期权止盈/止损OCO平仓单(买方take_profit>stop_loss,卖方相反)"""
+        oco=self.orderNum+1
+        self.order_close_option(order_type=order_type,order_BS=order_BS,option=option,vol=vol,price=take_profit,min_order_date=min_order_date,max_order_date=max_order_date,reason='take_profit',oco=oco)
+        self.order_close_option(order_type=order_type,order_BS=order_BS,option=option,vol=vol,price=stop_loss,min_order_date=min_order_date,max_order_date=max_order_date,reason='stop_loss',oco=oco,stop=True)
+        return oco
+
+    def stock_counter_processing(self,order_sequence=None):
         """【开仓/平仓order处理后运行,可重复运行】柜台判断open/close是否能够执行,若能则执行,并在柜台删除该订单
-        【后续还需要添加volume判断条件,并添加部分成交+剩余继续挂单的情形】
+        【新增】participation不为None时按当日volume限制成交数量,部分成交+剩余继续挂单
         【同时,由于开仓设置时间是合理的,平仓如果时间过了平不了那大概率真的平不了,所以需要考虑流动性的问题进一步地优化代码】
+        【新增】全部挂单与当日截面的low/high一次性比较,只对过期/成交的订单逐笔执行
+        【新增】同一OCO组的订单在同一根K线上都可成交时,按order_sequence(None时取self.order_sequence)决定先成交的一笔
         """
-        stock_counter=self.stock_counter.copy()
-        for i,orderDict in stock_counter.items():   # 订单编号,订单详情
-            order_state,symbol,price,vol,min_order_date,max_order_date=orderDict['order_state'],orderDict['symbol'],orderDict['price'],orderDict['vol'],orderDict['min_order_date'],orderDict['max_order_date']
-            if max_order_date<=self.current_date:   # 说明这个订单时间太长了,搞不了
-                del self.stock_counter[i]
-                print(f"OrderNum{i}:Behavior{order_state}-Symbol{symbol}:Price{price}&Vol{vol} failed[Out of Date]")
-            elif self.current_date>=min_order_date:
-                df=self.session.run(f"""select low,high from loadTable("{self.stock_counter_database}","{self.stock_counter_table}") where symbol="{symbol}" and date=date({self.current_dot_date})""")
-                if not df.empty:    # 说明这根K线上有该股票的数据
-                    if df.loc[0]['low']<=price<=df.loc[0]['high']:  # 说明可以成交
-                        if order_state=='open': # 开仓命令
-                            self.execute_stock(symbol=symbol,vol=vol,price=price,min_price=orderDict['min_price'],max_price=orderDict['max_price'],max_date=orderDict['max_date'],commission=orderDict['commission'],reason=orderDict['reason'])
-                        elif order_state=='close':  # 平仓命令
-                            self.close_stock(symbol=symbol,vol=vol,price=price,reason=orderDict['reason'])
-                        del self.stock_counter[i]  # 删除柜台的订单
-                    else:       # 说明不能在这根K线上成交
-                        pass
-                else:   # 说明当前K线没有该股票的数据
-                    pass
+        snap=self.get_snapshot('stock')    # 当日行情截面
+        expired,filled,rows,fill_vols=self.stock_counter.match(snap=snap,date=self.current_date)
+        for i in expired:   # 说明这个订单时间太长了,搞不了
+            orderDict=self.stock_counter.pop(i)
+            print(f"OrderNum{i}:Behavior{orderDict['order_state']}-Symbol{orderDict['symbol']}:Price{orderDict['price']}&Vol{orderDict['vol']} failed[Out of Date]")
+        filled,rows,fill_vols=self.prepare_fills('stock',self.stock_counter,snap,filled,rows,fill_vols,order_sequence)   # OCO/成交量/风控检查
+        fill_prices,fill_fees=self.fill_costs('stock',self.stock_counter,snap,filled,rows,fill_vols)   # 一次性计算全部成交的成交价与手续费
+        for i,fill_vol,fill_price,fee in zip(filled,fill_vols,fill_prices,fill_fees):    # 说明可以成交
+            if i not in self.stock_counter:    # 已被同组OCO订单撤销
+                continue
+            orderDict,cancelled=self.fill_order(self.stock_counter,i,fill_vol)  # 全部成交时删除柜台的订单
+            for j in cancelled:
+                print(f"OrderNum{j}:Behavior{orderDict['order_state']}-Symbol{orderDict['symbol']} cancelled[OCO]")
+            symbol,price,vol=orderDict['symbol'],fill_price,orderDict['vol']
+            if orderDict['order_state']=='open':    # 开仓命令
+                self.execute_stock(symbol=symbol,vol=vol,price=price,min_price=orderDict['min_price'],max_price=orderDict['max_price'],max_date=orderDict['max_date'],trail=orderDict.get('trail'),commission=orderDict['commission'],reason=orderDict['reason'],fee=fee)
+            elif orderDict['order_state']=='close': # 平仓命令
+                self.close_stock(symbol=symbol,vol=vol,price=price,reason=orderDict['reason'],fee=fee)
 
-    def future_counter_processing(self):
+    def future_counter_processing(self,order_sequence=None):
         """【开仓/平仓order处理后运行,可重复运行】柜台判断open/close是否能够执行,若能则执行,并在柜台删除该订单
-        【后续还需要添加volume判断条件,并添加部分成交+剩余继续挂单的情形】
+        【新增】participation不为None时按当日volume限制成交数量,部分成交+剩余继续挂单
         【同时,由于开仓设置时间是合理的,平仓如果时间过了平不了那大概率真的平不了,所以需要考虑流动性的问题进一步地优化代码】
+        【新增】全部挂单与当日截面的low/high一次性比较,只对过期/成交的订单逐笔执行
         """
-        future_counter=self.future_counter.copy()
-        for i,orderDict in future_counter.items(): # 订单编号,订单详情
-            order_state,order_type,contract,price,vol,min_order_date,max_order_date=orderDict['order_state'],orderDict['order_type'],orderDict['contract'],orderDict['price'],orderDict['vol'],orderDict['min_order_date'],orderDict['max_order_date']
-            if max_order_date<=self.current_date:   # 说明这个订单时间太长了,搞不了
-                del self.future_counter[i]
-                print(f"OrderNum{i}:Behavior{order_state}{order_type}-Contract{contract}:Price{price}&Vol{vol} failed[Out of Date]")
-            elif self.current_date>=min_order_date:
-                df=self.session.run(f"""select low,high,pre_settle from loadTable('{self.future_counter_database}','{self.future_counter_table}') where contract='{contract}' and date=date({self.current_dot_date})""")
-                if not df.empty:    # 说明这根K线上有该合约的数据
-                    if df.loc[0]['low']<=price<=df.loc[0]['high']:  # 说明可以成交
-                        if order_state=='open': # 开仓命令
-                            pre_settle=df.loc[0]['pre_settle']
-                            self.execute_future(order_type=order_type,contract=contract,vol=vol,price=price,pre_settle=pre_settle,margin=orderDict['margin'],min_price=orderDict['min_price'],max_price=orderDict['max_price'],max_date=orderDict['max_date'],commission=orderDict['commission'],reason=orderDict['reason'])
-                        elif order_state=='close':  # 平仓命令
-                            self.close_future(order_type=order_type,contract=contract,vol=vol,price=price,reason=orderDict['reason'])
-                        del self.future_counter[i]  # 删除柜台的订单
-                    else:       # 说明不能在这根K线上成交
-                        pass
-                else:   # 说明这根K线没有该合约的数据
-                    pass
+        snap=self.get_snapshot('future')   # 当日行情截面
+        expired,filled,rows,fill_vols=self.future_counter.match(snap=snap,date=self.current_date)
+        for i in expired:   # 说明这个订单时间太长了,搞不了
+            orderDict=self.future_counter.pop(i)
+            print(f"OrderNum{i}:Behavior{orderDict['order_state']}{orderDict['order_type']}-Contract{orderDict['contract']}:Price{orderDict['price']}&Vol{orderDict['vol']} failed[Out of Date]")
+        filled,rows,fill_vols=self.prepare_fills('future',self.future_counter,snap,filled,rows,fill_vols,order_sequence)
+        pre_settle_list=snap.column('pre_settle')[rows] if len(filled)>0 else []  # 成交合约的昨结价
+        fill_prices,fill_fees=self.fill_costs('future',self.future_counter,snap,filled,rows,fill_vols)
+        for i,pre_settle,fill_vol,fill_price,fee in zip(filled,pre_settle_list,fill_vols,fill_prices,fill_fees):  # 说明可以成交
+            if i not in self.future_counter:    # 已被同组OCO订单撤销
+                continue
+            orderDict,cancelled=self.fill_order(self.future_counter,i,fill_vol)  # 全部成交时删除柜台的订单
+            for j in cancelled:
+                print(f"OrderNum{j}:Behavior{orderDict['order_state']}{orderDict['order_type']}-Contract{orderDict['contract']} cancelled[OCO]")
+            order_type,contract,price,vol=orderDict['order_type'],orderDict['contract'],fill_price,orderDict['vol']
+            if orderDict['order_state']=='open':    # 开仓命令
+                self.execute_future(order_type=order_type,contract=contract,vol=vol,price=price,pre_settle=pre_settle,margin=orderDict['margin'],min_price=orderDict['min_price'],max_price=orderDict['max_price'],max_date=orderDict['max_date'],trail=orderDict.get('trail'),commission=orderDict['commission'],reason=orderDict['reason'],fee=fee)
+            elif orderDict['order_state']=='close': # 平仓命令
+                self.close_future(order_type=order_type,contract=contract,vol=vol,price=price,reason=orderDict['reason'],fee=fee)
 
-    def option_counter_processing(self):
+    def option_counter_processing(self,order_sequence=None):
         """【开仓/平仓order处理后运行,可重复运行】柜台判断open/close是否能够执行,若能则执行,并在柜台删除该订单
-        【后续还需要添加volume判断条件,并添加部分成交+剩余继续挂单的情形】
+        【新增】participation不为None时按当日volume限制成交数量,部分成交+剩余继续挂单
         【同时,由于开仓设置时间是合理的,平仓如果时间过了平不了那大概率真的平不了,所以需要考虑流动性的问题进一步地优化代码】
+        【新增】全部挂单与当日截面的low/high一次性比较,只对过期/成交的订单逐笔执行
         """
-        option_counter=self.option_counter.copy()
-        for i,orderDict in option_counter.items():  # 订单编号,订单详情
-            order_state,order_type,order_BS,option,price,vol,min_order_date,max_order_date=orderDict['order_state'],orderDict['order_type'],orderDict['order_BS'],orderDict['option'],orderDict['price'],orderDict['vol'],orderDict['min_order_date'],orderDict['max_order_date']
-            if max_order_date<=self.current_date:  # 说明这个订单时间太长了,搞不了
-                del self.option_counter[i]
-                print(f"OrderNum{i}:Behavior{order_state}{order_BS}{order_type}-Option{option}:Price{price}&Vol{vol} failed[Out of Date]")
-            elif self.current_date>=min_order_date:
-                df=self.session.run(f"""select low,high,pre_settle from loadTable('{self.option_counter_database}','{self.option_counter_table}') where option='{option}' and date==date({self.current_dot_date}) and low<={price} and high>={price}""")
-                if not df.empty:    # 说明K线上有该合约的数据
-                    if df.loc[0]['low']<=price<=df.loc[0]['high']:  # 说明可以成交
-                        if order_state=='open': # 开仓命令
-                            self.execute_option(order_type=order_type,order_BS=order_BS,option=option,vol=vol,price=price,strike=orderDict['strike'],pre_settle=orderDict['pre_settle'],margin=orderDict['margin'],min_price=orderDict['min_price'],max_price=orderDict['max_price'],max_date=orderDict['max_date'],commission=orderDict['commission'],reason=orderDict['reason'])
-                        elif order_state=='close':  # 平仓命令
-                            self.close_option(order_type=order_type,order_BS=order_BS,option=option,vol=vol,price=price,reason=orderDict['reason'])
-                        del self.option_counter[i]  # 删除柜台的订单
-                    else:  # 说明当日不能成交
-                        pass
-                else:  # 说明当日没有该合约的数据
-                    pass
+        snap=self.get_snapshot('option')   # 当日行情截面
+        expired,filled,rows,fill_vols=self.option_counter.match(snap=snap,date=self.current_date)
+        for i in expired:   # 说明这个订单时间太长了,搞不了
+            orderDict=self.option_counter.pop(i)
+            print(f"OrderNum{i}:Behavior{orderDict['order_state']}{orderDict['order_BS']}{orderDict['order_type']}-Option{orderDict['option']}:Price{orderDict['price']}&Vol{orderDict['vol']} failed[Out of Date]")
+        filled,rows,fill_vols=self.prepare_fills('option',self.option_counter,snap,filled,rows,fill_vols,order_sequence)
+        fill_prices,fill_fees=self.fill_costs('option',self.option_counter,snap,filled,rows,fill_vols)
+        for i,fill_vol,fill_price,fee in zip(filled,fill_vols,fill_prices,fill_fees):    # 说明可以成交
+            if i not in self.option_counter:    # 已被同组OCO订单撤销
+                continue
+            orderDict,cancelled=self.fill_order(self.option_counter,i,fill_vol)  # 全部成交时删除柜台的订单
+            for j in cancelled:
+                print(f"OrderNum{j}:Behavior{orderDict['order_state']}{orderDict['order_BS']}{orderDict['order_type']}-Option{orderDict['option']} cancelled[OCO]")
+            order_type,order_BS,option,price,vol=orderDict['order_type'],orderDict['order_BS'],orderDict['option'],fill_price,orderDict['vol']
+            if orderDict['order_state']=='open':    # 开仓命令
+                self.execute_option(order_type=order_type,order_BS=order_BS,option=option,vol=vol,price=price,strike=orderDict['strike'],pre_settle=orderDict['pre_settle'],margin=orderDict['margin'],min_price=orderDict['min_price'],max_price=orderDict['max_price'],max_date=orderDict['max_date'],trail=orderDict.get('trail'),commission=orderDict['commission'],reason=orderDict['reason'],fee=fee)
+            elif orderDict['order_state']=='close': # 平仓命令
+                self.close_option(order_type=order_type,order_BS=order_BS,option=option,vol=vol,price=price,reason=orderDict['reason'],fee=fee)
 
-    def execute_stock(self,symbol,vol,price,min_price=None,max_price=None,max_date=None,commission=None,reason=None):
+    def risk_check(self,asset,counter,filled,rows,vols):
         """
-        【核心函数】股票开仓/加仓(默认无手续费)
+        【撮合前运行】当日可成交的开仓订单一次向量化风控检查,未通过的订单从柜台删除并记入rejected_orders(平仓订单总是通过)
+        return: 通过检查的filled,rows,vols
+        """
+        if self.risk is None or len(filled)==0:
+            return filled,rows,vols
+        orders=[counter[i] for i in filled]
+        idx=np.flatnonzero([orderDict['order_state']=='open' for orderDict in orders])
+        if len(idx)==0:
+            return filled,rows,vols
+        opens=[orders[k] for k in idx]
+        vol=np.asarray(vols,dtype=np.float64)[idx]
+        notional=np.abs(np.array([orderDict['price'] for orderDict in opens],dtype=np.float64))*vol
+        margin=np.array([orderDict.get('margin') or 0 for orderDict in opens],dtype=np.float64)*vol/np.array([orderDict['vol'] for orderDict in opens],dtype=np.float64)
+        if asset=='stock':
+            cash_need,margin=notional,np.zeros(len(opens))
+        elif asset=='future':
+            cash_need=margin
+        else:   # 期权买方付出权利金,卖方付出保证金并收到权利金
+            sell=np.array([orderDict['order_BS']=='sell' for orderDict in opens])
+            cash_need,margin=np.where(sell,margin-notional,notional),np.where(sell,margin,0)
+        key=self.snapshot_key[asset]
+        ok=self.risk.check(cash=self.cash,equity=self.current_equity(),symbols=[orderDict[key] for orderDict in opens],
+                           cash_need=cash_need,notional=notional,margin=margin)
+        keep=np.ones(len(filled),dtype=bool)
+        keep[idx[~ok]]=False
+        for k in idx[~ok]:
+            orderDict=counter.pop(filled[k])
+            self.rejected_orders.append({'date':self.current_date,'asset':asset,'orderNum':int(filled[k]),'order':orderDict})
+            print(f"OrderNum{filled[k]}:Behavior{orderDict['order_state']}-{key.capitalize()}{orderDict[key]}:Price{orderDict['price']}&Vol{orderDict['vol']} failed[Risk]")
+        return filled[keep],rows[keep],np.asarray(vols)[keep]
+
+    def current_equity(self):
+        """上一交易日收盘的权益(资金曲线最后一行),没有记录时为初始资金"""
+        curve=self.curve
+        if curve.size==0:
+            return self.ori_cash
+        return curve.data[curve.size-1,curve.col['equity']]
+
+    def risk_update(self,book,pos,symbol,price):
+        """【成交后运行】按持仓簿中该合约的当前数量/保证金更新风控记录(名义市值按成交价计算)"""
+        if self.risk is not None:
+            self.risk.set(book,symbol,notional=abs(price)*pos.vol_of(symbol),margin=pos.margin_of(symbol))
+
+    def risk_mark(self):
+        """【盘后运行】各持仓簿按当日收盘价/结算价批量更新风控记录"""
+        if self.risk is None:
+            return
+        books=[('stock',self.stock_position,'stock')] if self.run_stock else []
+        if self.run_future:
+            books+=[(order_type,self.get_future_position(order_type),'future') for order_type in ['long','short']]
+        if self.run_option:
+            books+=[(f"{order_BS}{order_type}",self.get_option_position(order_type,order_BS),'option')
+                    for order_type,order_BS in [('call','buy'),('call','sell'),('put','buy'),('put','sell')]]
+        for book,pos,asset in books:
+            agg=pos.aggregate()
+            snap=self.get_snapshot(asset)
+            price=np.full(len(agg),np.nan)
+            if len(agg)>0 and len(snap)>0:
+                bar_row=snap.locate(agg[pos.key])
+                has_bar=bar_row>=0
+                price[has_bar]=snap.column('close' if asset=='stock' else 'settle').astype(np.float64)[bar_row[has_bar]]
+            self.risk.mark(book,agg[pos.key].tolist(),np.abs(price)*agg['vol'].to_numpy(),agg['margin'].to_numpy())
+
+    def prepare_fills(self,asset,counter,snap,filled,rows,vols,order_sequence=None):
+        """
+        【撮合前运行】价格可成交的订单依次经过:OCO组只保留先成交的一笔→成交量约束试分配→风控检查,
+        最后只对通过检查的成交数量占用当日成交量容量(被撤销/拒绝的订单不占用)
+        return: 实际成交的filled,rows,vols
+        """
+        filled,rows,vols=self.sequence_oco(asset,counter,filled,rows,vols,order_sequence,snap=snap)
+        key=self.snapshot_key[asset]
+        if self.participation is not None and len(filled)>0:
+            vols=self.fill_capacity.allocate(asset,[counter[i][key] for i in filled],vols,snap.column('volume')[rows],self.participation,self.current_date)
+            keep=vols>0
+            filled,rows,vols=filled[keep],rows[keep],vols[keep]
+        filled,rows,vols=self.risk_check(asset,counter,filled,rows,vols)
+        if self.participation is not None and len(filled)>0:
+            self.fill_capacity.charge(asset,[counter[i][key] for i in filled],vols,self.current_date)
+        return filled,rows,vols
+
+    def sequence_oco(self,asset,counter,filled,rows,vols,order_sequence=None,snap=None):
+        """
+        同一OCO组有多笔订单在当日K线上都可成交时只保留先成交的一笔(其余订单留在柜台,由成交后的cancel_oco/reduce_oco撤销或扣减):
+        order_sequence=True(最高价先到)时由最高价触发的订单(卖出限价/买入止损)先成交,False时由最低价触发的订单(买入限价/卖出止损)先成交
+        order_sequence与self.order_sequence均为None时保留订单编号最小的一笔
+        平仓的OCO组(如bracket止盈/止损)最高价侧与最低价侧同时可成交时记入ambiguous_ledger,monte_carlo对其随机选择先后顺序
+        """
+        if order_sequence is None:
+            order_sequence=self.order_sequence
+        if len(filled)<2:
+            return filled,rows,vols
+        orders=[counter[i] for i in filled]
+        groups=[orderDict.get('oco') for orderDict in orders]
+        if len({group for group in groups if group is not None})==sum(group is not None for group in groups):  # 没有同组的多笔订单
+            return filled,rows,vols
+        best={}     # OCO组→(先后,位置)
+        sides={}    # OCO组→{最高价侧:该侧第一笔订单的位置}
+        for k,(group,orderDict) in enumerate(zip(groups,orders)):
+            if group is None:
+                continue
+            priority=0
+            if order_sequence is not None:
+                stop=orderDict.get('stop') or 0
+                high_side=stop>0 if stop else self.order_side(asset,orderDict)<0    # 是否由最高价触发
+                priority=0 if high_side==bool(order_sequence) else 1
+                sides.setdefault(group,{}).setdefault(high_side,k)
+            if group not in best or (priority,k)<best[group]:
+                best[group]=(priority,k)
+        for group,side in sides.items():
+            if len(side)==2 and all(orders[k]['order_state']=='close' for k in side.values()):  # 止盈/止损两侧同一根K线上都可成交
+                high,low=side[True],side[False]
+                opens=snap.column('open').astype(np.float64)[rows[[high,low]]] if snap is not None else (None,None)
+                self.record_ambiguous(asset=asset,symbol=orders[high][self.snapshot_key[asset]],order_sequence=order_sequence,
+                                      high_limit=self.exit_price(orders[high]['price'],opens[0],True),
+                                      low_limit=self.exit_price(orders[low]['price'],opens[1],False),
+                                      vol=float(np.asarray(vols)[best[group][1]]),sign=-self.order_side(asset,orders[high]))
+        keep=np.array([k for k,group in enumerate(groups) if group is None or best[group][1]==k],dtype=np.int64)
+        return filled[keep],rows[keep],np.asarray(vols)[keep]
+
+    def order_side(self,asset,orderDict):
+        """订单的买卖方向:1为买入,-1为卖出"""
+        if asset=='stock':
+            sign=1
+        elif asset=='future':
+            sign={'long':1,'short':-1}[orderDict['order_type']]
+        else:
+            sign={'buy':1,'sell':-1}[orderDict['order_BS']]
+        return sign if orderDict['order_state']=='open' else -sign
+
+    def fill_costs(self,asset,counter,snap,filled,rows,vols):
+        """
+        当日全部成交订单的成交价与手续费(CostModel一次向量化计算)
+        return: 成交价(np.array),手续费(np.array);没有成本模型时为挂单价(止损单为触发后的成交价)与0
+        """
+        orders=[counter[i] for i in filled]
+        prices=np.array([orderDict['price'] for orderDict in orders],dtype=np.float64)
+        stop=np.array([orderDict.get('stop') or 0 for orderDict in orders],dtype=np.int8)
+        if stop.any():  # 止损单按止损价与开盘价中较差的价格成交(跳空穿越止损价时按开盘价)
+            opens=snap.column('open').astype(np.float64)[rows]
+            prices=np.where(stop<0,np.minimum(prices,opens),np.where(stop>0,np.maximum(prices,opens),prices))
+        if self.cost_model is None or len(orders)==0:
+            return prices,np.zeros(len(orders))
+        sides=np.array([self.order_side(asset,orderDict) for orderDict in orders])
+        rates=np.array([np.nan if orderDict.get('commission') is None else orderDict['commission'] for orderDict in orders],dtype=np.float64)
+        return self.cost_model.fill(asset,[orderDict[self.snapshot_key[asset]] for orderDict in orders],prices,vols,sides,
+                                    highs=snap.column('high')[rows],lows=snap.column('low')[rows],rates=rates)
+
+    def trade_cost(self,asset,symbol,price,vol,side,commission=None):
+        """单笔成交(止盈止损/移仓等不经过柜台的成交)的成交价与手续费"""
+        if self.cost_model is None:
+            return price,0.0
+        bar=self.get_snapshot(asset).get(symbol)
+        highs,lows=([bar['high']],[bar['low']]) if bar is not None else (None,None)
+        prices,fees=self.cost_model.fill(asset,[symbol],[price],[vol],[side],highs=highs,lows=lows,
+                                         rates=np.array([np.nan if commission is None else commission],dtype=np.float64))
+        return prices[0],fees[0]
+
+    def fill_order(self,counter,orderNum,vol):
+        """
+        柜台订单成交vol数量:全部成交时删除订单并撤销同组OCO订单;部分成交时剩余数量(及保证金)继续挂单
+        return: 本次成交部分的订单dict,被撤销的OCO订单编号
+        """
+        orderDict=counter[orderNum]
+        if vol>=orderDict['vol']:
+            counter.pop(orderNum)
+            return orderDict,counter.cancel_oco(orderDict)
+        fill=dict(orderDict,vol=vol)
+        if orderDict.get('margin'):
+            fill['margin']=orderDict['margin']*vol/orderDict['vol']
+        cancelled=counter.reduce_oco(orderNum,vol)
+        counter.reduce(orderNum,vol)
+        return fill,cancelled
+
+    def get_future_position(self,order_type):
+        """返回期货多头/空头持仓簿"""
+        if order_type=='long':
+            return self.long_position
+        return self.short_position
+
+    def build_roll_calendar(self):
+        """
+        【回测前运行】一次读取回测区间内的期货K线,计算各品种的主力合约日历
+        DolphinDB数据源直接读取K线表的date/contract/end_date/volume/open_interest(柜台字段中没有open_interest)
+        """
+        rule=self.roll_rule or 'volume'
+        source=self.kline_source()
+        if isinstance(source,DolphinDBSource):
+            columns="date,contract,end_date,volume"+(",open_interest" if rule=='open_interest' else "")
+            source=DolphinDBSource(session=self.session,tables={'future':(self.future_K_database,self.future_K_table)},columns={'future':columns})
+        df=source.get_range('future',self.start_date,self.end_date)
+        if df is None:
+            df=pd.DataFrame({'date':[],'contract':[],'end_date':[],'volume':[],'open_interest':[]})
+        self.roll_calendar=RollCalendar(df,rule=rule)
+        return self.roll_calendar
+
+    def build_option_expiry(self):
+        """【回测前运行】一次读取回测区间内的期权K线,计算到期日→到期期权的索引"""
+        df=self.kline_source().get_range('option',self.start_date,self.end_date)
+        if df is None:
+            df=pd.DataFrame({'date':[],'option':[],'end_date':[]})
+        self.option_expiry=OptionExpiry(df)
+        return self.option_expiry
+
+    def active_contract(self,product,date=None):
+        """product(如'AU')在date(默认当前交易日)的主力合约"""
+        if self.roll_calendar is None:
+            self.build_roll_calendar()
+        return self.roll_calendar.active_contract(product,self.current_date if date is None else date)
+
+    def roll_futures(self):
+        """
+        【监控后运行】按主力合约日历在换月日收盘自动移仓:旧合约按收盘价全部平仓,新合约按收盘价逐批次开仓
+        新批次沿用原批次的数量/保证金/max_date/trail,止盈止损价按新旧合约收盘价差平移
+        """
+        if self.roll_calendar is None:
+            self.build_roll_calendar()
+        rolls=self.roll_calendar.rolls(self.current_date)
+        if not rolls:
+            return
+        snap=self.get_snapshot('future')
+        for product,old,new in rolls:
+            old_bar,new_bar=snap.get(old),snap.get(new)
+            for order_type in ['long','short']:
+                pos=self.get_future_position(order_type)
+                if old not in pos:
+                    continue
+                if old_bar is None or new_bar is None:
+                    print(f"{old}->{new}-{self.current_date}'s data is missed, couldn't roll this contract")
+                    continue
+                spread=new_bar['close']-old_bar['close']
+                lots=[lot.to_dict() for lot in pos[old] if lot['vol']>0]
+                self.close_future(order_type=order_type,contract=old,vol=pos.vol_of(old),price=old_bar['close'],reason='roll')
+                for lot in lots:
+                    self.execute_future(order_type=order_type,contract=new,vol=lot['vol'],price=new_bar['close'],pre_settle=new_bar['pre_settle'],margin=lot['margin'],
+                                        min_price=None if lot['min_price'] is None else lot['min_price']+spread,
+                                        max_price=None if lot['max_price'] is None else lot['max_price']+spread,
+                                        max_date=lot['max_date'],trail=lot['trail'],reason='roll')
+
+    def get_option_position(self,order_type,order_BS):
+        """返回期权买入/卖出看涨/看跌持仓簿"""
+        if order_type=='call' and order_BS=='buy':
+            return self.buycall_position
+        elif order_type=='call' and order_BS=='sell':
+            return self.sellcall_position
+        elif order_type=='put' and order_BS=='buy':
+            return self.buyput_position
+        return self.sellput_position
+
+    def execute_stock(self,symbol,vol,price,min_price=None,max_price=None,max_date=None,trail=None,commission=None,reason=None,fee=None):
+        """
+        【核心函数】股票开仓/加仓(cost_model为None时无手续费)
+        fee:手续费(柜台撮合时已批量计算);None时由cost_model按单笔成交计算滑点与手续费
         min_price:平仓最小价格(止损)
         max_price:平仓最大价格(止盈)
         max_date:平仓最大日期(在该日收盘的时候自动平仓)
+        trail:移动止损距离(止损价=持仓期间最高价-trail)
         """
-        position=self.stock_position
-        current_stock_list=position.keys()
-        if symbol not in current_stock_list:
-            position[symbol]=[{'price':price,
-                               'min_price':min_price,
-                               'max_price':max_price,
-                               'max_date':max_date,
-                               'vol':vol}]
-        else:
-            position[symbol].append({'price':price,
-                                     'min_price':min_price,
-                                     'max_price':max_price,
-                                     'max_date':max_date,
-                                     'vol':vol})
-        self.stock_position=position
+        if fee is None:
+            price,fee=self.trade_cost('stock',symbol,price,vol,side=1,commission=commission)
+        self.stock_position.add(symbol,price=price,vol=vol,min_price=min_price,max_price=max_price,max_date=max_date,trail=trail)
+        self.risk_update('stock',self.stock_position,symbol,price)
         # 记录
-        self.future_record=self.future_record._append({'state':'open',
-                                                       'reason':reason,
-                                                       'date':self.current_date,
-                                                       'symbol':symbol,
-                                                       'price':price,
-                                                       'vol':vol,
-                                                       'pnl':0},ignore_index=True)
+        self.stock_ledger.append(state='open',
+                                 reason=reason,
+                                 date=self.current_date,
+                                 symbol=symbol,
+                                 price=price,
+                                 vol=vol,
+                                 pnl=0,
+                                 fee=fee)
 
         # 结算
-        self.cash-=vol*price  # 减去股票购买成本
+        self.cash-=vol*price+fee    # 减去股票购买成本与手续费
+        self.fees+=fee
 
-    def execute_future(self,order_type,contract,vol,price,pre_settle,margin,min_price=None,max_price=None,max_date=None,commission=None,reason=None):
+    def execute_future(self,order_type,contract,vol,price,pre_settle,margin,min_price=None,max_price=None,max_date=None,trail=None,commission=None,reason=None,fee=None):
         """
-        【核心函数】期货合约开仓/加仓(默认无手续费)
+        【核心函数】期货合约开仓/加仓(cost_model为None时无手续费)
         margin:每笔交易的"初始"保证金[这里是初始保证金]
         min_price:平仓最小价格(多单为止损/空单为止盈)
         max_price:平仓最大价格(多单为止盈/空单为止损)
         max_date: 平仓最大日期(在该日收盘的时候自动平仓)
+        trail:移动止损距离(多单止损价=最高价-trail,空单止损价=最低价+trail)
         【新增】逐日盯市制度回测 pre_settle而不是settle防止未来函数
         """
-        if order_type=='long':
-            position=self.long_position
-        else:
-            position=self.short_position
-        current_contract_list=position.keys()
-        if contract not in current_contract_list:
-            position[contract]=[{'price':price,
-                                 'pre_settle':pre_settle,
-                                 'margin':margin,
-                                 'min_price':min_price,
-                                 'max_price':max_price,
-                                 'max_date':max_date,
-                                 'vol':vol,
-                                 'FirstDaySettle':None}]
-        else:
-            position[contract].append({'price':price,
-                                       'pre_settle':pre_settle,
-                                       'margin':margin,
-                                       'min_price':min_price,
-                                       'max_price':max_price,
-                                       'max_date':max_date,
-                                       'vol':vol,
-                                       'FirstDaySettle':None})
-        # 赋值
-        if order_type=='long':
-            self.long_position=position
-        else:
-            self.short_position=position
+        if fee is None:
+            price,fee=self.trade_cost('future',contract,price,vol,side={'long':1,'short':-1}[order_type],commission=commission)
+        position=self.get_future_position(order_type)
+        position.add(contract,price=price,vol=vol,pre_settle=pre_settle,margin=margin,
+                     min_price=min_price,max_price=max_price,max_date=max_date,trail=trail,first_day=True)
+        self.risk_update(order_type,position,contract,price)
         # 记录
-        self.future_record=self.future_record._append({'state':'open',
-                                                       'reason':reason,
-                                                       'date':self.current_date,
-                                                       'contract':contract,
-                                                       'order_type':order_type,
-                                                       'price':price,
-                                                       'vol':vol,
-                                                       'pnl':0},ignore_index=True)
+        self.future_ledger.append(state='open',
+                                  reason=reason,
+                                  date=self.current_date,
+                                  contract=contract,
+                                  order_type=order_type,
+                                  price=price,
+                                  vol=vol,
+                                  pnl=0,
+                                  fee=fee)
 
         # 结算
-        self.cash-=margin           # 减去初始保证金(该笔合约的全部保证金)
+        self.cash-=margin+fee       # 减去初始保证金(该笔合约的全部保证金)与手续费
+        self.fees+=fee
 
-    def execute_option(self,order_type,order_BS,option,vol,price,strike,pre_settle,margin=None,min_price=None,max_price=None,max_date=None,commission=None,reason=None):
+    def execute_option(self,order_type,order_BS,option,vol,price,strike,pre_settle,margin=None,min_price=None,max_price=None,max_date=None,trail=None,commission=None,reason=None,fee=None):
         """【核心函数】买入看涨(order_type='call')/看跌(order_type='sell')期权"""
-        if order_type=='call' and order_BS=='buy':
-            position=self.buycall_position
-            margin=0
-        elif order_type=='call' and order_BS=='sell':
-            position=self.sellcall_position
-        elif order_type=='put' and order_BS=='buy':
-            position=self.buyput_position
+        if order_BS=='buy':     # 期权买方不用付保证金
             margin=0
-        else:
-            position=self.sellput_position
-        current_option_list=position.keys()
-        if option not in current_option_list:
-            position[option]=[{'price':price,
-                               'pre_settle':pre_settle,
-                               'margin':margin,
-                               'strike':strike,
-                               'min_price':min_price,
-                               'max_price':max_price,
-                               'max_date':max_date,
-                               'vol':vol,
-                               'FirstDaySettle':None}]
-        else:
-            position[option].append([{'price':price,
-                                      'pre_settle':pre_settle,
-                                      'margin':margin,
-                                      'strike':strike,
-                                      'min_price':min_price,
-                                      'max_price':max_price,
-                                      'max_date':max_date,
-                                      'vol':vol,
-                                      'FirstDaySettle':None}])
-        # 赋值
-        if order_type=='call' and order_BS=='buy':
-            self.buycall_position=position
-            self.cash-=(vol*price)  # 减去付出的权利金
-        elif order_type=='call' and order_BS=='sell':
-            self.sellcall_position=position
-            self.cash+=(vol*price-margin)  # 加上得到的权利金减去保证金
-        elif order_type=='put' and order_BS=='buy':
-            self.buyput_position=position
+        if fee is None:
+            price,fee=self.trade_cost('option',option,price,vol,side={'buy':1,'sell':-1}[order_BS],commission=commission)
+        position=self.get_option_position(order_type,order_BS)
+        position.add(option,price=price,vol=vol,pre_settle=pre_settle,margin=margin,strike=strike,
+                     min_price=min_price,max_price=max_price,max_date=max_date,trail=trail,first_day=True)
+        self.risk_update(f"{order_BS}{order_type}",position,option,price)
+        # 结算
+        if order_BS=='buy':
             self.cash-=(vol*price)  # 减去付出的权利金
-        elif order_type=='put' and order_BS=='sell':
-            self.sellput_position=position
+        else:
             self.cash+=(vol*price-margin)  # 加上得到的权利金减去保证金
+        self.cash-=fee
+        self.fees+=fee
         # 记录
-        self.option_record=self.option_record._append({'state':order_BS,
-                                                       'reason':reason,
-                                                       'date':self.current_date,
-                                                       'option':option,
-                                                       'order_type':order_type,
-                                                       'price':price,
-                                                       'vol':vol,
-                                                       'pnl':0},ignore_index=True)
-
-    def close_stock(self,symbol,vol,price,reason=None):
-        """【核心函数】股票平仓"""
-        profit=0    # 该笔交易获得的盈利(实现盈利)
-        position=self.stock_position.copy()
-        if position:    # 如果目前还有持仓的话
-            if symbol not in position.keys():
-                print(f"股票{symbol}未持仓,无法平仓")
-            else:
-                current_vol_list=[i['vol'] for i in position[symbol]]    # 当前的股票持有情况list
-                ori_price_list=[i['price'] for i in position[symbol]]    # 当前股票买入价格情况list
-                current_vol=sum(current_vol_list)   # 当前持股数量
-                max_vol=min(current_vol,vol)        # 现在需要平仓的数量
-                record_vol=max_vol                  # for record
-                if max_vol>=current_vol:  # 说明要全平仓
-                    for i in range(0,len(current_vol_list)):
-                        vol=current_vol_list[i]
-                        ori_price=ori_price_list[i]
-                        profit+=(price-ori_price)*vol  # 逐笔盈亏
-                    del position[symbol]  # 直接去掉这个股票的持有 {'symbol':[(price,vol),...]}
-                elif max_vol<current_vol:  # 说明部分平仓
-                    for i in range(0,len(current_vol_list)):
-                        vol=current_vol_list[i]
-                        ori_price=ori_price_list[i]
-                        if max_vol>=vol:  # 当前订单全部平仓
-                            profit+=(price-ori_price)*vol
-                            del position[symbol][0]  # FIFO原则
-                            max_vol=max_vol-vol
-                        else:  # 当前订单部分平仓
-                            profit+=(price-ori_price)*max_vol
-                            position[symbol][0]['vol']=vol-max_vol
-                            break  # 执行完毕
-                # 记录
-                self.stock_record=self.stock_record._append({'state':'close',
-                                                             'reason':reason,
-                                                             'date':self.current_date,
-                                                             'symbol':symbol,
-                                                             'price':price,
-                                                             'vol':record_vol,
-                                                             'pnl':profit},ignore_index=True)
-                # 结算
-                self.profit+=profit                  # 逐笔盈亏(平仓价-开仓价)
-                self.cash+=profit                    # 获得的利润计入cash
-                self.stock_position=position
-
-    def close_future(self,order_type,contract,vol,price,reason=None):
-        """【核心函数】期货合约平仓"""
-        profit=0    # 该笔交易获得的盈利(实现盈利)
-        settle_profit=0   # 该笔交易获得的盯市盈亏(交易价-昨结价)
-        margin=0    # 该笔交易收回的保证金
-        if order_type=='long':
-            position=self.long_position.copy()
-        else:
-            position=self.short_position.copy()
+        self.option_ledger.append(state=order_BS,
+                                  reason=reason,
+                                  date=self.current_date,
+                                  option=option,
+                                  order_type=order_type,
+                                  price=price,
+                                  vol=vol,
+                                  pnl=0,
+                                  fee=fee)
+
+    def close_stock(self,symbol,vol,price,reason=None,fee=None,row=None):
+        """【核心函数】股票平仓(FIFO原则),fee为None时由cost_model按单笔成交计算滑点与手续费,row不为None时只平仓该批次(监控触发)"""
+        position=self.stock_position
+        if symbol not in position:
+            print(f"股票{symbol}未持仓,无法平仓")
+            return
+        if fee is None:
+            price,fee=self.trade_cost('stock',symbol,price,vol,side=-1)
+        vol_list,ori_price_list,_,_=position.close(symbol,vol) if row is None else position.close_row(row,vol)  # 各批次平仓数量&买入价格
+        self.risk_update('stock',position,symbol,price)
+        record_vol=vol_list.sum()                               # for record
+        profit=((price-ori_price_list)*vol_list).sum()          # 该笔交易获得的盈利(实现盈利)
+        # 记录
+        self.stock_ledger.append(state='close',
+                                 reason=reason,
+                                 date=self.current_date,
+                                 symbol=symbol,
+                                 price=price,
+                                 vol=record_vol,
+                                 pnl=profit,
+                                 fee=fee)
+        # 结算
+        self.profit+=profit                                 # 逐笔盈亏(平仓价-开仓价)
+        self.cash+=(ori_price_list*vol_list).sum()+profit-fee   # 收回买入成本+逐笔盈亏-手续费
+        self.fees+=fee
+
+    def close_future(self,order_type,contract,vol,price,reason=None,fee=None,row=None):
+        """【核心函数】期货合约平仓(FIFO原则),fee为None时由cost_model按单笔成交计算滑点与手续费,row不为None时只平仓该批次(监控触发)"""
+        position=self.get_future_position(order_type)
         LS={'long':1,'short':-1}[order_type]    # 【新增】为了节省代码段加了一个系数,按期货多头的逻辑对期货空头收益进行计算
-        if position:    # 如果目前还有持仓的话
-            current_vol_list=[i['vol'] for i in position[contract]]    # 当前的合约持有情况list
-            ori_price_list=[i['price'] for i in position[contract]]    # 当前合约买入价格情况list
-            pre_margin_list=[i['margin'] for i in position[contract]]  # 当前合约占用的保证金情况
-            pre_settle_list=[i['pre_settle'] for i in position[contract]]   # 当前合约的昨结价情况
-            current_vol=sum(current_vol_list)    # 当前合约持有的数量
-            max_vol=min(current_vol,vol)         # 现在需要平仓的数量
-            record_vol=max_vol                   # for record
-            if current_vol<=0:
-                print(f"合约{contract}未持仓,无法平仓")
-            elif max_vol>=current_vol:  # 说明要全平仓
-                for i in range(0,len(current_vol_list)):
-                    vol=current_vol_list[i]
-                    ori_price=ori_price_list[i]
-                    pre_margin=pre_margin_list[i]
-                    pre_settle=pre_settle_list[i]
-                    profit+=(price-ori_price)*vol*LS            # 逐笔盈亏
-                    settle_profit+=(price-pre_settle)*vol*LS    # 盯市盈亏
-                    margin+=(pre_margin+settle_profit)          # 收回的保证金
-                del position[contract]   # 直接去掉这个合约的持有 {'contract':[(price,vol),...]}
-            elif max_vol<current_vol:    # 说明部分平仓
-                for i in range(0,len(current_vol_list)):
-                    vol=current_vol_list[i]
-                    ori_price=ori_price_list[i]
-                    pre_margin=pre_margin_list[i]   # 当前合约历史订单占用的保证金
-                    pre_settle=pre_settle_list[i]
-                    if max_vol>=vol:    # 当前订单全部平仓
-                        profit+=(price-ori_price)*vol*LS
-                        settle_profit+=(price-pre_settle)*vol*LS
-                        margin+=(pre_margin+settle_profit)  # 收回的保证金
-                        del position[contract][0]    # FIFO原则
-                        max_vol=max_vol-vol
-                    else:               # 当前订单部分平仓
-                        profit+=(price-ori_price)*max_vol*LS
-                        settle_profit+=(price-pre_settle)*max_vol*LS
-                        margin+=(pre_margin*(max_vol/vol)+settle_profit)    # 收回的保证金
-                        position[contract][0]['vol']=vol-max_vol
-                        position[contract][0]['margin']=pre_margin*(1-max_vol/vol)  # 剩余的保证金
-                        break   # 执行完毕
-            # 记录
-            self.future_record=self.future_record._append({'state':'close',
-                                                           'reason':reason,
-                                                           'date':self.current_date,
-                                                           'contract':contract,
-                                                           'order_type':order_type,
-                                                           'price':price,
-                                                           'vol':record_vol,
-                                                           'pnl':profit},ignore_index=True)
-            # 结算
-            self.profit+=profit                  # 逐笔盈亏(平仓价-开仓价)
-            self.profit_settle+=settle_profit    # 结算盈亏(平仓价-昨结算)
-            self.cash+=margin                    # 保证金(pre_margin+结算盈亏)
-            if order_type=='long':
-                self.long_position=position
-            else:
-                self.short_position=position
+        if contract not in position:
+            print(f"合约{contract}未持仓,无法平仓")
+            return
+        if fee is None:
+            price,fee=self.trade_cost('future',contract,price,vol,side=-LS)
+        vol_list,ori_price_list,pre_settle_list,pre_margin_list=position.close(contract,vol) if row is None else position.close_row(row,vol)
+        self.risk_update(order_type,position,contract,price)
+        record_vol=vol_list.sum()                                   # for record
+        profit=((price-ori_price_list)*vol_list).sum()*LS           # 该笔交易获得的盈利(逐笔盈亏)
+        settle_profit_list=(price-pre_settle_list)*vol_list*LS      # 各批次的盯市盈亏(交易价-昨结价)
+        settle_profit=settle_profit_list.sum()
+        margin=(pre_margin_list+settle_profit_list).sum()           # 收回的保证金
+        # 记录
+        self.future_ledger.append(state='close',
+                                  reason=reason,
+                                  date=self.current_date,
+                                  contract=contract,
+                                  order_type=order_type,
+                                  price=price,
+                                  vol=record_vol,
+                                  pnl=profit,
+                                  fee=fee)
+        # 结算
+        self.profit+=profit                  # 逐笔盈亏(平仓价-开仓价)
+        self.profit_settle+=settle_profit    # 结算盈亏(平仓价-昨结算)
+        self.cash+=margin-fee                # 保证金(pre_margin+结算盈亏)-手续费
+        self.fees+=fee
 
-    def close_option(self,order_type,order_BS,option,vol,price,reason=None):
-        """【核心函数】期权合约平仓
-        【需要进行修改】加入期权买方的平仓逻辑
+    def close_option(self,order_type,order_BS,option,vol,price,reason=None,fee=None,row=None):
+        """【核心函数】期权合约平仓(FIFO原则),row不为None时只平仓该批次(监控触发)
+        权利金在开仓时已经收付:买方平仓卖出期权得到price*vol,卖方平仓买回期权付出price*vol,另外收回初始保证金
         """
-        profit=0    # 该笔交易获得的盈利(实现盈利)
-        settle_profit=0   # 该笔交易获得的盯市盈亏(交易价-昨结价)
-        margin=0    # 该笔交易收回的保证金
-        if order_type=='call':
-            position=self.buycall_position.copy()
-        else:
-            position=self.buyput_position.copy()
+        position=self.get_option_position(order_type,order_BS)
         BS={'buy':1,'sell':-1}[order_BS]         # 【新增】为了节省代码段加了一个系数,按买入期权的逻辑对卖出期权收益进行计算
-        if position:    # 如果当前还有持仓的话
-            current_vol_list=[i['vol'] for i in position[option]]    # 当前的合约持有情况list
-            ori_price_list=[i['price'] for i in position[option]]    # 当前合约买入价格情况list
-            pre_margin_list=[i['margin'] for i in position[option]]  # 当前合约买入的保证金情况
-            pre_settle_list=[i['pre_settle'] for i in position[option]]   # 当前合约的昨结价情况
-            current_vol=sum(current_vol_list)    # 当前合约持有的数量
-            max_vol=min(current_vol,vol)   # 现在需要平仓的数量
-            # ??? self.cash+=max_vol*price*BS    # 期权买方(B)平仓需要卖出期权,得到cash&期权卖方(S)平仓需要买入期权,扣除cash
-            record_vol=max_vol  # for record
-            if current_vol<=0:
-                print(f"合约{option}未持仓,无法平仓")
-            elif max_vol>=current_vol:  # 说明要全平仓
-                for i in range(0,len(current_vol_list)):
-                    vol=current_vol_list[i]
-                    ori_price=ori_price_list[i]
-                    pre_margin=pre_margin_list[i]
-                    pre_settle=pre_settle_list[i]
-                    profit+=(price-ori_price)*vol*BS            # 逐笔盈亏(平仓价-开仓价)
-                    settle_profit+=(price-pre_settle)*vol*BS    # 结算盈亏(平仓价-昨结算)
-                    margin+=(pre_margin+settle_profit)
-                del position[option]   # 直接去掉这个合约的持有 {'option':[(price,vol),...]}
-            elif max_vol<current_vol:    # 说明部分平仓
-                for i in range(0,len(current_vol_list)):
-                    vol=current_vol_list[i]
-                    ori_price=ori_price_list[i]
-                    pre_margin=pre_margin_list[i]
-                    pre_settle=pre_settle_list[i]
-                    if max_vol>=vol:
-                        profit+=(price-ori_price)*vol*BS            # 逐笔盈亏(平仓价-开仓价)
-                        settle_profit+=(price-pre_settle)*vol*BS    # 结算盈亏(平仓价-昨结算)
-                        margin+=(pre_margin+settle_profit)          # 结算盈亏(平仓价-昨结算)
-                        del position[option][0]                     # FIFO原则
-                        max_vol=max_vol-vol
-                    else:
-                        profit+=(price-ori_price)*max_vol*BS
-                        settle_profit+=(price-pre_settle)*max_vol*BS
-                        margin+=(pre_margin+settle_profit)
-                        position[option][0]['vol']=vol-max_vol
-                        position[option][0]['margin']=pre_margin*(1-max_vol/vol)  # 剩余的保证金
-                        break   # 执行完毕
-            # 记录
-            self.option_record=self.option_record._append({'state':'close',
-                                                           'reason':reason,
-                                                           'date':self.current_date,
-                                                           'option':option,
-                                                           'order_type':order_type,
-                                                           'price':price,
-                                                           'vol':record_vol,
-                                                           'pnl':profit},ignore_index=True)
-            # 结算
-            self.profit+=profit                 # 逐笔盈亏(平仓价-开仓价)
-            self.profit_settle+=settle_profit   # 结算盈亏(平仓价-昨结算)
-            self.cash+=margin                   # 保证金
-            if order_type=='call' and order_BS=='buy':
-                self.buycall_position=position
-            elif order_type=='call' and order_BS=='sell':
-                self.sellcall_position=position
-            elif order_type=='put' and order_BS=='buy':
-                self.buyput_position=position
-            elif order_type=='put' and order_BS=='sell':
-                self.sellput_position=position
+        if option not in position:
+            print(f"合约{option}未持仓,无法平仓")
+            return
+        if fee is None:     # 由cost_model按单笔成交计算滑点与手续费
+            price,fee=self.trade_cost('option',option,price,vol,side=-BS)
+        vol_list,ori_price_list,pre_settle_list,pre_margin_list=position.close(option,vol) if row is None else position.close_row(row,vol)
+        self.risk_update(f"{order_BS}{order_type}",position,option,price)
+        record_vol=vol_list.sum()                                   # for record
+        profit=((price-ori_price_list)*vol_list).sum()*BS           # 逐笔盈亏(平仓价-开仓价)
+        settle_profit=((price-pre_settle_list)*vol_list*BS).sum()  # 结算盈亏(平仓价-昨结算)
+        marks=(pre_settle_list-ori_price_list)*vol_list*BS          # 已计入保证金的盯市盈亏
+        margin=(pre_margin_list-marks).sum()                        # 收回的初始保证金(买方为0)
+        # 记录
+        self.option_ledger.append(state='close',
+                                  reason=reason,
+                                  date=self.current_date,
+                                  option=option,
+                                  order_type=order_type,
+                                  price=price,
+                                  vol=record_vol,
+                                  pnl=profit,
+                                  fee=fee)
+        # 结算
+        self.profit+=profit                 # 逐笔盈亏(平仓价-开仓价)
+        self.profit_settle+=settle_profit   # 结算盈亏(平仓价-昨结算)
+        self.cash+=margin+price*record_vol*BS-fee   # 初始保证金+买方卖出/卖方买回期权-手续费
+        self.fees+=fee
 
     def clear_option(self,order_type,order_BS,option,vol,reason="clear"):
         """【核心函数】期权到期清仓(卖方&买方通用)"""
-        self.close_option(order_type=order_type,order_BS=order_BS,option=option,vol=vol,price=0,reason=reason)
+        self.close_option(order_type=order_type,order_BS=order_BS,option=option,vol=vol,price=0,reason=reason,fee=0)
+
+    def exit_price(self,level,open_price,high):
+        """
+        监控平仓的成交价:high=True为max_price(价格上行触发),开盘价已在阈值之上(跳空高开)时按开盘价成交;
+        high=False为min_price,开盘价已在阈值之下时按开盘价成交(与柜台止损单的成交价一致)
+        """
+        if not level or open_price is None or open_price!=open_price:
+            return level
+        return max(level,open_price) if high else min(level,open_price)
 
     def monitor_stock(self,order_sequence):
         """
@@ -729,38 +2674,41 @@ class Backtest:
         order_sequence=False 假设min_price先判断
         """
         pos=self.stock_position
-        for symbol,List in pos.items():
-            df=self.session.run(f"""select high,low,close from loadTable('{self.stock_counter_database}','{self.stock_counter_table}') where symbol=="{symbol}" and date==date({self.current_dot_date})""")
-            for Dict in List:
+        snap=self.get_snapshot('stock')
+        for symbol in pos.keys():
+            bar=snap.get(symbol)
+            if bar is None:
+                print(f"{symbol}-{self.current_date}'s data is missed, couldn't close this stock")
+                continue
+            rows=pos.triggered(symbol,low=bar['low'],high=bar['high'],date=self.current_date)   # 只处理阈值被穿越的批次
+            for row in rows:
+                Dict=Lot(pos,row)
                 high_limit,low_limit,last_date,vol=Dict['max_price'],Dict['min_price'],Dict['max_date'],Dict['vol']
-                if not df.empty:
-                    # 【盘中】先处理限价单
-                    slice_df=df.loc[0]
-                    high_price,low_price,close_price=slice_df['high'],slice_df['low'],slice_df['close']
-                    state=0
-                    if order_sequence:  # 【模拟撮合】最高价先被触发
-                        if high_limit:
-                            if high_price>=high_limit:
-                                self.close_stock(symbol=symbol,price=high_limit,vol=vol,reason='high_limit')
-                                state=1
-                        elif low_limit:
-                            if low_price<=low_limit:
-                                self.close_stock(symbol=symbol,price=low_limit,vol=vol,reason='low_limit')
-                                state=1
-                    elif not order_sequence:  # 【模拟撮合】最低价先被触发
-                        if low_limit:
-                            if low_price<=low_limit:
-                                self.close_stock(symbol=symbol,price=low_limit,vol=vol,reason='low_limit')
-                                state=1
-                        elif high_limit:
-                            if high_price>=high_limit:
-                                self.close_stock(symbol=symbol,price=high_limit,vol=vol,reason='high_limit')
-                                state=1
-                    # 【收盘】处理到最大持仓时间的期货持仓
-                    if self.current_date>=pd.Timestamp(last_date) and state==0: # 最长持仓时间的股票持仓
-                        self.close_stock(symbol=symbol,price=close_price,vol=vol,reason='max_date')
-                else:
-                    print(f"{symbol}-{self.current_date}'s data is missed, couldn't close this stock")
+                if vol<=0:  # 说明该批次已经在本轮监控中平仓
+                    continue
+                # 【盘中】先处理限价单
+                high_price,low_price,close_price=bar['high'],bar['low'],bar['close']
+                high_fill,low_fill=self.exit_price(high_limit,bar['open'],True),self.exit_price(low_limit,bar['open'],False)   # 跳空时按开盘价成交
+                if high_limit and low_limit and high_price>=high_limit and low_price<=low_limit:  # 止盈止损同时被触发,记录另一种先后顺序下的平仓价
+                    self.record_ambiguous(asset='stock',symbol=symbol,order_sequence=order_sequence,high_limit=high_fill,low_limit=low_fill,vol=vol,sign=pos.sign)
+                state=0
+                if order_sequence:  # 【模拟撮合】最高价先被触发
+                    if high_limit and high_price>=high_limit:
+                        self.close_stock(symbol=symbol,price=high_fill,vol=vol,reason='high_limit',row=row)
+                        state=1
+                    elif low_limit and low_price<=low_limit:
+                        self.close_stock(symbol=symbol,price=low_fill,vol=vol,reason='low_limit',row=row)
+                        state=1
+                elif not order_sequence:  # 【模拟撮合】最低价先被触发
+                    if low_limit and low_price<=low_limit:
+                        self.close_stock(symbol=symbol,price=low_fill,vol=vol,reason='low_limit',row=row)
+                        state=1
+                    elif high_limit and high_price>=high_limit:
+                        self.close_stock(symbol=symbol,price=high_fill,vol=vol,reason='high_limit',row=row)
+                        state=1
+                # 【收盘】处理到最大持仓时间的期货持仓
+                if self.current_date>=pd.Timestamp(last_date) and state==0: # 最长持仓时间的股票持仓
+                    self.close_stock(symbol=symbol,price=close_price,vol=vol,reason='max_date',row=row)
 
     def monitor_future(self,order_type,order_sequence):
         """
@@ -768,217 +2716,764 @@ class Backtest:
         order_sequence=True 假设max_price先判断
         order_sequence=False 假设min_price先判断
         """
-        if order_type=='long':
-            pos=self.long_position
-        else:
-            pos=self.short_position
-        for contract,List in pos.items():
-            df=self.session.run(f"""select high,low,close,end_date from loadTable('{self.future_counter_database}','{self.future_counter_table}') where contract=='{contract}' and date==date({self.current_dot_date})""")
-            for Dict in List:
+        pos=self.get_future_position(order_type)
+        snap=self.get_snapshot('future')
+        for contract in pos.keys():
+            bar=snap.get(contract)
+            if bar is None:
+                print(f"{contract}-{self.current_date}'s data is missed, couldn't close this contract")
+                continue
+            rows=pos.triggered(contract,low=bar['low'],high=bar['high'],date=self.current_date)   # 只处理阈值被穿越的批次
+            if self.current_date>=pd.Timestamp(bar['end_date']):   # 到最后交易日,该合约全部批次都需要处理
+                rows=list(pos.queue[contract])
+            for row in rows:
+                Dict=Lot(pos,row)
                 high_limit,low_limit,last_date,vol=Dict['max_price'],Dict['min_price'],Dict['max_date'],Dict['vol']
-                if not df.empty:
-                    # 【盘中】先处理限价单
-                    slice_df=df.loc[0]
-                    high_price,low_price,close_price,end_date=slice_df['high'],slice_df['low'],slice_df['close'],slice_df['end_date']
-                    state=0
-                    if order_sequence:  # 【模拟撮合】最高价先被触发
-                        if high_limit:
-                            if high_price>=high_limit:
-                                self.close_future(order_type=order_type,contract=contract,price=high_limit,vol=vol,reason='high_limit')
-                                state=1
-                        elif low_limit:
-                            if low_price<=low_limit:
-                                self.close_future(order_type=order_type,contract=contract,price=low_limit,vol=vol,reason='low_limit')
-                                state=1
-                    elif not order_sequence:  # 【模拟撮合】最低价先被触发
-                        if low_limit:
-                            if low_price<=low_limit:
-                                self.close_future(order_type=order_type,contract=contract,price=low_limit,vol=vol,reason='low_limit')
-                                state=1
-                        elif high_limit:
-                            if high_price>=high_limit:
-                                self.close_future(order_type=order_type,contract=contract,price=high_limit,vol=vol,reason='high_limit')
-                                state=1
-                    # 【收盘】先处理到最后交易日的期货持仓
-                    if self.current_date>=pd.Timestamp(end_date) and state==0:
-                        """这里可以加上移仓换月的逻辑"""
-                        self.close_future(order_type=order_type,contract=contract,price=close_price,vol=vol,reason='end_date')
+                if vol<=0:  # 说明该批次已经在本轮监控中平仓
+                    continue
+                # 【盘中】先处理限价单
+                high_price,low_price,close_price,end_date=bar['high'],bar['low'],bar['close'],bar['end_date']
+                high_fill,low_fill=self.exit_price(high_limit,bar['open'],True),self.exit_price(low_limit,bar['open'],False)   # 跳空时按开盘价成交
+                if high_limit and low_limit and high_price>=high_limit and low_price<=low_limit:  # 止盈止损同时被触发,记录另一种先后顺序下的平仓价
+                    self.record_ambiguous(asset='future',symbol=contract,order_sequence=order_sequence,high_limit=high_fill,low_limit=low_fill,vol=vol,sign=pos.sign)
+                state=0
+                if order_sequence:  # 【模拟撮合】最高价先被触发
+                    if high_limit and high_price>=high_limit:
+                        self.close_future(order_type=order_type,contract=contract,price=high_fill,vol=vol,reason='high_limit',row=row)
+                        state=1
+                    elif low_limit and low_price<=low_limit:
+                        self.close_future(order_type=order_type,contract=contract,price=low_fill,vol=vol,reason='low_limit',row=row)
                         state=1
-                    # 【收盘】再处理到最大持仓时间的期货持仓
-                    if self.current_date>=pd.Timestamp(last_date) and state==0: # 最长持仓时间的期货持仓
-                        self.close_future(order_type=order_type,contract=contract,price=close_price,vol=vol,reason='max_date')
-                else:
-                    print(f"{contract}-{self.current_date}'s data is missed, couldn't close this contract")
+                elif not order_sequence:  # 【模拟撮合】最低价先被触发
+                    if low_limit and low_price<=low_limit:
+                        self.close_future(order_type=order_type,contract=contract,price=low_fill,vol=vol,reason='low_limit',row=row)
+                        state=1
+                    elif high_limit and high_price>=high_limit:
+                        self.close_future(order_type=order_type,contract=contract,price=high_fill,vol=vol,reason='high_limit',row=row)
+                        state=1
+                # 【收盘】先处理到最后交易日的期货持仓
+                if self.current_date>=pd.Timestamp(end_date) and state==0:
+                    # roll_rule不为None时,主力合约已在最后交易日之前由roll_futures移仓
+                    self.close_future(order_type=order_type,contract=contract,price=close_price,vol=vol,reason='end_date',row=row)
+                    state=1
+                # 【收盘】再处理到最大持仓时间的期货持仓
+                if self.current_date>=pd.Timestamp(last_date) and state==0: # 最长持仓时间的期货持仓
+                    self.close_future(order_type=order_type,contract=contract,price=close_price,vol=vol,reason='max_date',row=row)
 
     def monitor_option(self,order_type,order_BS,order_sequence):
         """
         【柜台处理订单后运行,可重复运行】每日盘中运行,负责监控当前持仓是否满足限制平仓要求
         order_sequence=True 假设max_price先判断
         order_sequence=False 假设min_price先判断
-        【新增】买方/卖方到期日未平仓虚值期权自动清算
+        【新增】到期日的期权由settle_expiry按到期日历批量清算(虚值作废/实值行权)
         """
-        if order_type=='call' and order_BS=='buy':
-            pos=self.buycall_position.copy()
-        elif order_type=='call' and order_BS=='sell':
-            pos=self.sellcall_position.copy()
-        elif order_type=='put' and order_BS=='buy':
-            pos=self.buyput_position.copy()
-        else:
-            pos=self.sellput_position.copy()
-        for option,List in pos.items():
-            df=self.session.run(f"""select high,low,close,end_date,level from loadTable('{self.option_counter_database}','{self.option_counter_table}') where option=='{option}' and date==date({self.current_dot_date})""")
-            for Dict in List:
+        pos=self.get_option_position(order_type,order_BS)
+        snap=self.get_snapshot('option')
+        if self.option_expiry is None:
+            self.build_option_expiry()
+        expiring=set(self.option_expiry.expiring(self.current_date))   # 当日到期的期权收盘统一清算,不按max_date平仓
+        for option in pos.keys():
+            bar=snap.get(option)
+            if bar is None:
+                print(f"{option}-{self.current_date}'s data is missed, couldn't close this option")
+                continue
+            rows=pos.triggered(option,low=bar['low'],high=bar['high'],date=self.current_date)   # 只处理阈值被穿越的批次
+            for row in rows:
+                Dict=Lot(pos,row)
                 high_limit,low_limit,last_date,vol=Dict['max_price'],Dict['min_price'],Dict['max_date'],Dict['vol']
-                if not df.empty:
-                    # 说明该日可以交易
-                    # 【盘中】先处理限价单
-                    slice_df=df.loc[0]
-                    high_price,low_price,close_price,end_date,level=slice_df['high'],slice_df['low'],slice_df['close'],slice_df['end_date'],slice_df['level']   # end_date&level用于判断末日期权是否平仓还是等待清算(可能用到未来函数,需要以后进一步确认)
-                    state=0
-                    if order_sequence:  # 【模拟撮合】最高价先被触发
-                        if high_limit:
-                            if high_price>=high_limit:
-                                self.close_option(order_type=order_type,order_BS=order_BS,option=option,price=high_limit,vol=vol,reason='high_limit')
-                                state=1
-                        elif low_limit:
-                            if low_price<=low_limit:
-                                self.close_option(order_type=order_type,order_BS=order_BS,option=option,price=low_limit,vol=vol,reason='low_limit')
-                                state=1
-                    elif not order_sequence:  # 【模拟撮合】最低价先被触发
-                        if low_limit:
-                            if low_price<=low_limit:
-                                self.close_option(order_type=order_type, order_BS=order_BS, option=option, price=low_limit,vol=vol, reason='low_limit')
-                                state=1
-                        elif high_limit:
-                            if high_price>=high_limit:
-                                self.close_option(order_type=order_type,order_BS=order_BS,option=option,price=high_limit,vol=vol,reason='high_limit')
-                                state=1
-                    # 【收盘】先处理到期权到期日的期权(虚值期权)
-                    if self.current_date==end_date and state==0 and level<0: # 注:一定是到期日还是虚值期权的才可以
-                        self.clear_option(order_type=order_type,order_BS=order_BS,option=option,vol=vol,reason='clear')
+                if vol<=0:  # 说明该批次已经在本轮监控中平仓
+                    continue
+                # 说明该日可以交易
+                # 【盘中】先处理限价单
+                high_price,low_price,close_price=bar['high'],bar['low'],bar['close']
+                high_fill,low_fill=self.exit_price(high_limit,bar['open'],True),self.exit_price(low_limit,bar['open'],False)   # 跳空时按开盘价成交
+                if high_limit and low_limit and high_price>=high_limit and low_price<=low_limit:  # 止盈止损同时被触发,记录另一种先后顺序下的平仓价
+                    self.record_ambiguous(asset='option',symbol=option,order_sequence=order_sequence,high_limit=high_fill,low_limit=low_fill,vol=vol,sign=pos.sign)
+                state=0
+                if order_sequence:  # 【模拟撮合】最高价先被触发
+                    if high_limit and high_price>=high_limit:
+                        self.close_option(order_type=order_type,order_BS=order_BS,option=option,price=high_fill,vol=vol,reason='high_limit',row=row)
+                        state=1
+                    elif low_limit and low_price<=low_limit:
+                        self.close_option(order_type=order_type,order_BS=order_BS,option=option,price=low_fill,vol=vol,reason='low_limit',row=row)
+                        state=1
+                elif not order_sequence:  # 【模拟撮合】最低价先被触发
+                    if low_limit and low_price<=low_limit:
+                        self.close_option(order_type=order_type, order_BS=order_BS, option=option, price=low_fill,vol=vol, reason='low_limit',row=row)
                         state=1
-                    # 【收盘】再处理未到期权到期日但到指令到期日的期权(实值期权)
-                    if self.current_date>=pd.Timestamp(last_date) and state==0:
-                        self.close_option(order_type=order_type,order_BS=order_BS,option=option,price=close_price,vol=vol,reason='max_date')
-                else:
-                    print(f"{option}-{self.current_date}'s data is missed, couldn't close this option")
+                    elif high_limit and high_price>=high_limit:
+                        self.close_option(order_type=order_type,order_BS=order_BS,option=option,price=high_fill,vol=vol,reason='high_limit',row=row)
+                        state=1
+                # 【收盘】处理未到期权到期日但到指令到期日的期权
+                if self.current_date>=pd.Timestamp(last_date) and state==0 and option not in expiring:
+                    self.close_option(order_type=order_type,order_BS=order_BS,option=option,price=close_price,vol=vol,reason='max_date',row=row)
+        # 【收盘】到期期权批量清算
+        self.settle_expiry(order_type=order_type,order_BS=order_BS)
+
+    def settle_expiry(self,order_type,order_BS):
+        """
+        【收盘】到期日批量清算:由到期日历取出当日到期且仍有持仓的期权,全部批次一次向量化计算平仓盈亏
+        虚值/平值期权(level<=0)按0价格作废;实值期权(level>0)按0价格了结后按行权价转为标的期货持仓
+        (买入看涨/卖出看跌→期货多头,买入看跌/卖出看涨→期货空头),标的期货当日没有行情时按期权结算价现金了结
+        标的期货当日也到最后交易日时(monitor_future已在本日运行过),行权得到的期货持仓随即按收盘价平仓(reason='end_date')
+        资金按开仓时已收付的权利金清算(与close_option一致):买方得到清算价*数量,卖方收回初始保证金并付出清算价*数量
+        """
+        if self.option_expiry is None:
+            self.build_option_expiry()
+        pos=self.get_option_position(order_type,order_BS)
+        options=[option for option in self.option_expiry.expiring(self.current_date) if option in pos]
+        if not options:
+            return
+        snap=self.get_snapshot('option')
+        future_snap=self.get_snapshot('future') if self.run_future else None
+        bar_row=snap.locate(options)
+        BS={'buy':1,'sell':-1}[order_BS]
+        direction='long' if (order_type=='call')==(order_BS=='buy') else 'short'   # 行权后的期货方向
+        names,prices,reasons,lots,exercise=[],[],[],[],[]
+        for option,row in zip(options,bar_row):
+            if row<0:
+                print(f"{option}-{self.current_date}'s data is missed, couldn't settle this option")
+                continue
+            level,settle=snap.column('level')[row],snap.column('settle')[row]
+            strike=pos.data['strike'][pos.queue[option][0]]
+            underlying=self.option_expiry.underlying.get(option)
+            price,reason=0.0,'clear'
+            if level>0:     # 实值期权
+                if future_snap is not None and underlying in future_snap and not np.isnan(strike):
+                    reason='exercise'
+                else:       # 无法转为期货持仓时按结算价了结
+                    price,reason=settle,'exercise_cash'
+            vols,ori_prices,pre_settles,margins=pos.close(option,pos.vol_of(option))
+            self.risk_update(f"{order_BS}{order_type}",pos,option,price)
+            if reason=='exercise':
+                exercise.append((underlying,vols.sum(),strike))
+            names.append(option);prices.append(price);reasons.append(reason)
+            lots.append((vols,ori_prices,pre_settles,margins))
+        if not names:
+            return
+        # 全部批次一次计算
+        counts=np.array([len(lot[0]) for lot in lots])
+        vols,ori_prices,pre_settles,margins=(np.concatenate([lot[k] for lot in lots]) for k in range(4))
+        price=np.repeat(np.array(prices,dtype=np.float64),counts)
+        profit=(price-ori_prices)*vols*BS                           # 逐笔盈亏(清算价-开仓价)
+        settle_profit=(price-pre_settles)*vols*BS                   # 结算盈亏(清算价-昨结算)
+        initial=margins-(pre_settles-ori_prices)*vols*BS            # 初始保证金(扣除已计入保证金的盯市盈亏,买方为0)
+        starts=np.concatenate([[0],np.cumsum(counts)[:-1]])
+        option_vol,option_profit=np.add.reduceat(vols,starts),np.add.reduceat(profit,starts)
+        for option,p,reason,vol,pnl in zip(names,prices,reasons,option_vol,option_profit):
+            self.option_ledger.append(state='close',reason=reason,date=self.current_date,option=option,order_type=order_type,
+                                      price=p,vol=vol,pnl=pnl,fee=0.0)
+        self.profit+=profit.sum()
+        self.profit_settle+=settle_profit.sum()
+        self.cash+=(initial+price*vols*BS).sum()    # 收回的初始保证金+买方得到/卖方付出的清算价值
+        for contract,vol,strike in exercise:        # 行权:按行权价开仓标的期货
+            self.execute_future(order_type=direction,contract=contract,vol=vol,price=strike,pre_settle=strike,
+                                margin=strike*vol*self.exercise_margin,reason='exercise',fee=0.0)
+            bar=future_snap.get(contract)
+            if self.current_date>=pd.Timestamp(bar['end_date']):   # 标的期货同日到期:不留下无行情的期货持仓
+                self.close_future(order_type=direction,contract=contract,price=bar['close'],vol=vol,reason='end_date')
+        diff=self.reconcile_cash()
+        if abs(diff)>1e-6*max(1.0,abs(self.cash)):
+            print(f"{self.current_date}:到期清算后资金与成交记录相差{diff:.4f}")
+
+    def reconcile_cash(self):
+        """
+        资金与成交记录核对:初始资金+成交记录的已实现盈亏-手续费-未平仓批次占用的资金(股票买入成本/期货初始保证金/期权权利金与初始保证金)
+        return: 当前资金-核对资金(0为一致)
+        """
+        realized=sum(np.nansum(ledger.column('pnl'))-np.nansum(ledger.column('fee'))
+                     for ledger in (self.stock_ledger,self.future_ledger,self.option_ledger))
+        capital=self.stock_position.capital(premium=1)
+        for pos in (self.long_position,self.short_position):
+            capital+=pos.capital()
+        for pos in (self.buycall_position,self.buyput_position,self.sellcall_position,self.sellput_position):
+            capital+=pos.capital(premium=pos.sign)
+        return self.cash-(self.ori_cash+realized-capital)
+
+    def record_ambiguous(self,asset,symbol,order_sequence,high_limit,low_limit,vol,sign):
+        """
+        记录止盈/止损在同一根日K线上同时被触发的平仓:实际按order_sequence选择的价格平仓,另一种顺序下会按另一个价格平仓
+        delta:改用另一种顺序时该笔平仓盈亏的变化
+        """
+        price,alternate=(high_limit,low_limit) if order_sequence else (low_limit,high_limit)
+        self.ambiguous_ledger.append(date=self.current_date,asset=asset,symbol=symbol,side='high' if order_sequence else 'low',
+                                     price=price,alternate=alternate,vol=vol,delta=(alternate-price)*vol*sign)
+
+    def monte_carlo(self,samples=1000,seed=None):
+        """
+        【回测后运行】日内最高价/最低价先后顺序的蒙特卡洛:不重新运行回测,只对止盈止损同日触发的平仓随机选择先后顺序
+        (持仓监控的止盈止损与柜台中bracket/OCO平仓订单两侧同日可成交的情况都记录在ambiguous_ledger中)
+        各样本的累计盈亏=回测的累计盈亏曲线+被翻转平仓的delta(从平仓日起累计),一次矩阵运算得到全部样本的盈亏与最大回撤
+        近似:翻转只改变该笔平仓的成交价,不改变之后的持仓路径(同日同数量平仓,只有平仓价不同,因此一阶近似下路径一致)
+        资金曲线同performance(equity_curve的逐日估值)
+        return: DataFrame(index=['high_first','low_first',0..samples-1],columns=['pnl','max_drawdown'])
+        """
+        curve=self.equity_curve()
+        dates=curve.dates[:curve.size]
+        base=curve.data[:curve.size,curve.col['pnl']]
+        ledger=self.ambiguous_ledger
+        day=np.minimum(np.searchsorted(dates,ledger.column('date')),len(dates)-1)     # 平仓对应的资金曲线行
+        delta=ledger.column('delta')
+        is_high=ledger.column('side')=='high'
+        rng=np.random.default_rng(self.seed if seed is None else seed)
+        flips=np.vstack([~is_high,is_high,rng.random((samples,len(delta)))<0.5])    # 每行一个样本:True表示翻转该笔平仓的先后顺序
+        onehot=np.zeros((len(delta),len(dates)))
+        onehot[np.arange(len(delta)),day]=1
+        pnl=base+np.cumsum((flips*delta)@onehot,axis=1)     # (样本,交易日)的累计盈亏
+        equity=self.ori_cash+pnl
+        drawdown=(equity/np.maximum.accumulate(equity,axis=1)-1).min(axis=1)
+        return pd.DataFrame({'pnl':pnl[:,-1],'max_drawdown':drawdown},index=['high_first','low_first']+list(range(samples)))
+
+    def trail_stops(self):
+        """
+        【监控后运行】用当日最高价/最低价推动各持仓簿的移动止损价(当日先按原止损价监控,再移动止损,避免用到当日最高价之后的信息)
+        只遍历设置了trail的合约,每个合约只弹出止损价需要移动的批次
+        """
+        books=[]
+        if self.run_stock:
+            books.append(('stock',self.stock_position))
+        if self.run_future:
+            books+=[('future',self.long_position),('future',self.short_position)]
+        if self.run_option:
+            books+=[('option',pos) for pos in (self.buycall_position,self.sellcall_position,self.buyput_position,self.sellput_position)]
+        for asset,pos in books:
+            if not pos.trailing:
+                continue
+            snap=self.get_snapshot(asset)
+            for symbol in list(pos.trailing.keys()):
+                bar=snap.get(symbol)
+                if bar is not None:
+                    pos.trail(symbol,low=bar['low'],high=bar['high'])
 
     def calculate_future_profit(self,order_type):
         """
         【盘后运行】计算未平仓合约的盯市盈亏+更新pre_settle为收盘后的settle
         【新增】settle_profit 每日盘后运行,计算浮盈浮亏(结算价-昨日结算价)并计入保证金
-        【补丁】在持仓中增加了FirstDaySettle,仅用来计算第一天收益(结算-开仓)
+        【补丁】持仓批次中的first_day标记仅用来计算第一天收益(结算-开仓)
         profit:逐笔平仓盈亏(平仓-开仓)+profit_settle结算盈亏(开仓-昨日结算)=平仓盈亏(平仓-昨日结算)
         order_type='long':
         order_type='short':
         """
-        if order_type=='long':
-            pos=self.long_position
-        else:
-            pos=self.short_position
+        pos=self.get_future_position(order_type)
         if pos: # 如果有持仓的话
-            POS=pos.copy()
             LS={'long':1,'short':-1}[order_type]  # 【新增】为了节省代码段加了一个系数,按多头的逻辑对空头收益进行计算
-            for contract,List in pos.items():   # 获取当前结算价(waiting)
-                df=self.session.run(f"""select pre_settle,settle from loadTable('{self.future_counter_database}','{self.future_counter_table}') where contract=='{contract}' and date==date({self.current_dot_date})""")
-                L=[]
-                for Dict in List:
-                    if not df.empty: # 计算未平仓合约的盯市盈亏
-                        slice_df=df.loc[0]
-                        pre_settle,settle_price=slice_df['pre_settle'],slice_df['settle'] # 未平仓合约昨日结算价&当日结算价
-                        vol=Dict['vol']
-                        if 'FirstDaySettle' not in Dict.keys(): # 说明已经不是第一天持仓了
-                            settle_profit=(settle_price-pre_settle)*vol*LS
-                        else:       # 说明是第一天持仓
-                            settle_profit=(settle_price-Dict['price'])*vol*LS
-                            del Dict['FirstDaySettle']
-                        self.profit_settle+=settle_profit
-                        Dict['margin']+=settle_profit
-                        Dict['pre_settle']=settle_price # 更新pre_settle为收盘后的settle
-                    L.append(Dict)
-                POS[contract]=L
-            """更新self.long_position/self.short_position"""
-            if order_type=='long':
-                self.long_position=POS
-            else:
-                self.short_position=POS
-        else:
-            pass
+            self.profit_settle+=pos.mark(snap=self.get_snapshot('future'),sign=LS)
 
     def calculate_option_profit(self,order_type,order_BS):
         """【盘后运行】计算期权逐日盈亏&盯市盈亏
-        【补丁】在持仓中增加了FirstDaySettle,仅用来计算第一天收益(结算-开仓)
+        【补丁】持仓批次中的first_day标记仅用来计算第一天收益(结算-开仓)
         """
-        if order_type=='call' and order_BS=='buy':
-            pos=self.buycall_position
-        elif order_type=='call' and order_BS=='sell':
-            pos=self.sellcall_position
-        elif order_type=='put' and order_BS=='buy':
-            pos=self.buyput_position
-        else:
-            pos=self.sellput_position
+        pos=self.get_option_position(order_type,order_BS)
         if pos:
-            POS=pos.copy()
             BS={'buy':1,'sell':-1}[order_BS]
-            for option,List in pos.items():   # 获取当前结算价(waiting)
-                df=self.session.run(f"""select pre_settle,settle from loadTable('{self.option_counter_database}','{self.option_counter_table}') where option=='{option}' and date==date({self.current_dot_date})""")
-                L=[]
-                for Dict in List:
-                    if not df.empty: # 计算未平仓合约的盯市盈亏
-                        slice_df=df.loc[0]
-                        pre_settle,settle_price=slice_df['pre_settle'],slice_df['settle'] # 未平仓合约昨日结算价&当日结算价
-                        vol=Dict['vol']
-                        if 'FirstDaySettle' not in Dict.keys():  # 说明已经不是第一天持仓了
-                            settle_profit=(settle_price-pre_settle)*vol*BS
-                        else:  # 说明是第一天持仓
-                            settle_profit=(settle_price-Dict['price'])*vol*BS
-                            del Dict['FirstDaySettle']
-                        self.profit_settle+=settle_profit
-                        Dict['margin']+=settle_profit
-                        Dict['pre_settle']=settle_price # 更新pre_settle为收盘后的settle
-                    L.append(Dict)
-                POS[option]=L
-            if order_type=='call' and order_BS=='buy':
-                self.buycall_position=POS
-            elif order_type=='call' and order_BS=='sell':
-                self.sellcall_position=POS
-            elif order_type=='put' and order_BS=='buy':
-                self.buyput_position=POS
-            else:
-                self.sellput_position=POS
-        else:
-            pass
+            self.profit_settle+=pos.mark(snap=self.get_snapshot('option'),sign=BS)
+
+    def calculate_profit(self):
+        """【盘后运行】一次完成期货多空+期权四个持仓簿的盯市(每个持仓簿一次向量化计算),并更新风控记录"""
+        if self.run_future:
+            for order_type in ['long','short']:
+                self.calculate_future_profit(order_type=order_type)
+        if self.run_option:
+            for order_type,order_BS in [('call','buy'),('call','sell'),('put','buy'),('put','sell')]:
+                self.calculate_option_profit(order_type=order_type,order_BS=order_BS)
+        self.risk_mark()
 
     def close_counter(self):
-        """【盘后运行】更新counter中未完成订单的pre_settle为当日settle"""
+        """
+        【盘后运行】更新counter中未完成订单的pre_settle为当日settle
+        旧式策略(函数,没有record_day)在此按持仓估值记录当日资金曲线
+        """
         if self.run_future:
             Dict=self.future_counter
             if len(Dict)>0: # 说明有积压的订单
+                snap=self.get_snapshot('future')
                 for orderNum,order in Dict.items():
-                    df=self.session.run(f"""select settle from loadTable('{self.future_counter_database}','{self.future_counter_table}') where contract="{order['contract']}" and date==date({self.current_dot_date})""")
-                    if not df.empty:
-                        self.future_counter[orderNum]['pre_settle']=df.loc[0]['settle']
+                    bar=snap.get(order['contract'])
+                    if bar is not None:
+                        self.future_counter[orderNum]['pre_settle']=bar['settle']
                     else:   # 说明当天future_settle数据缺失
                         pass
         if self.run_option:
             Dict=self.option_counter
             if len(Dict)>0: # 说明有积压的订单
+                snap=self.get_snapshot('option')
                 for orderNum,order in Dict.items():
-                    df=self.session.run(f"""select settle from loadTable('{self.option_counter_database}','{self.option_counter_table}') where option="{order['option']}" and date==date({self.current_dot_date})""")
-                    if not df.empty:
-                        self.option_counter[orderNum]['pre_settle']=df.loc[0]['settle']
+                    bar=snap.get(order['option'])
+                    if bar is not None:
+                        self.option_counter[orderNum]['pre_settle']=bar['settle']
                     else:   # 说明当天option_settle数据缺失
                         pass
+        if not self.is_hook_strategy():
+            self.record_curve()
 
-    def run(self):
-        """运行策略+可视化"""
-        self.strategy(self=self)    # 策略运行
-        # plt.plot(self.cash_Dict.keys(),self.cash_Dict.values(),label='cash')
-        plt.plot(self.profit_Dict.keys(),self.profit_Dict.values(),label='profit')
-        if self.run_future or self.run_option:
-            plt.plot(self.settle_profit_Dict.keys(),self.settle_profit_Dict.values(),label='settle_profit')
-        plt.legend(frameon=False)
-        plt.show()
+    @property
+    def stock_record(self):
+        """股票成交记录(DataFrame)"""
+        return self.stock_ledger.to_frame()
+
+    @property
+    def future_record(self):
+        """期货成交记录(DataFrame)"""
+        return self.future_ledger.to_frame()
+
+    @property
+    def option_record(self):
+        """期权成交记录(DataFrame)"""
+        return self.option_ledger.to_frame()
+
+    def enable_profiler(self):
+        """
+        启用分阶段计时:包装各阶段方法、session.run以及数据源的查询(多个Backtest共用的数据源只包装一次)
+        DolphinDB数据源包装其session(get_day/get_range/trading_dates/fingerprint的每次session.run都计数),
+        其他数据源包装get_table(没有时包装get_day;get_day/get_range经get_table读取,只计数一次)
+        查询计入发起查询的Backtest的计时(见PhaseProfiler),预取线程的查询计入第一个启用计时的Backtest
+        """
+        if self.profiler is not None:
+            return
+        self.profiler=PhaseProfiler(date_getter=lambda:self.current_date)
+        for phase in PhaseProfiler.phases:
+            setattr(self,phase,self.profiler.wrap(phase,getattr(self,phase)))
+        call_strategy=self.call_strategy
+        self.call_strategy=lambda hook:self.profiler.wrap(f"strategy.{hook}",call_strategy)(hook)
+        if self.session is not None:
+            self.session=CountingSession(self.session,self.profiler)
+        if not getattr(self.data_source,'profiled',False):
+            if isinstance(self.data_source,DolphinDBSource):
+                self.data_source.session=CountingSession(self.data_source.session,self.profiler)
+            else:
+                name='get_table' if hasattr(self.data_source,'get_table') else 'get_day'
+                setattr(self.data_source,name,self.profiler.wrap_query(getattr(self.data_source,name)))
+            self.data_source.profiled=True
+
+    def profile_frame(self):
+        """各交易日各阶段的耗时/查询次数/传输行数(DataFrame)"""
+        if self.profiler is None:
+            return None
+        return self.profiler.frame()
+
+    def profile_summary(self):
+        """各阶段耗时汇总(文本)"""
+        if self.profiler is None:
+            return ""
+        return self.profiler.summary()
+
+    def set_date(self,date):
+        """设置当前交易日"""
+        self.current_date=pd.Timestamp(date)
+        self.current_str_date=self.current_date.strftime('%Y%m%d')
+        self.current_dot_date=self.current_date.strftime('%Y.%m.%d')
+
+    def kline_source(self):
+        """
+        读取K线表的数据源(交易日历/主力合约日历/到期日历/数据版本)
+        counter_view=False时实体柜台表在回测开始前还没有数据,改为直接读取K线表(信号表不变)
+        """
+        source=self.data_source
+        if isinstance(source,DolphinDBSource) and not self.counter_view:
+            source=DolphinDBSource(session=self.session,tables=dict(source.tables,
+                                                                    stock=(self.stock_K_database,self.stock_K_table),
+                                                                    future=(self.future_K_database,self.future_K_table),
+                                                                    option=(self.option_K_database,self.option_K_table)),
+                                   columns=self.counter_columns)
+        return source
+
+    def trading_calendar(self):
+        """回测区间内的交易日(各资产K线交易日的并集)"""
+        source=self.kline_source()
+        dates=set()
+        for asset in ['stock','future','option']:
+            if getattr(self,f"run_{asset}"):
+                dates.update(source.trading_dates(asset,start_date=self.start_date,end_date=self.end_date))
+        return sorted(dates)
+
+    def read_day(self,asset,date):
+        """行情截面的数据:数据源支持get_table(LocalColumnarSource)时直接使用pyarrow.Table(不转换为DataFrame)"""
+        if hasattr(self.data_source,'get_table'):
+            return self.data_source.get_table(asset=asset,date=date)
+        return self.data_source.get_day(asset=asset,date=date)
+
+    def load_day(self,date):
+        """读取date当日全部资产的行情截面(预取线程中运行),已创建的信号缓存同时预取date所在的块"""
+        snapshot_Dict={}
+        for asset in ['stock','future','option']:
+            if getattr(self,f"run_{asset}"):
+                snapshot_Dict[asset]=DaySnapshot(date=date,df=self.read_day(asset,date),key=self.snapshot_key[asset])
+        for cache in list(self.signal_cache.values()):
+            cache.prefetch(date)
+        return snapshot_Dict
+
+    def call_strategy(self,hook):
+        """调用策略对象的pre_open/on_bar/post_close(未实现则跳过)"""
+        func=getattr(self.strategy,hook,None)
+        if func is not None:
+            func(self)
+
+    def is_hook_strategy(self):
+        """策略是否为实现了pre_open/on_bar/post_close的对象(由引擎驱动交易日循环)"""
+        return any(hasattr(self.strategy,hook) for hook in ['pre_open','on_bar','post_close'])
+
+    def run_day(self):
+        """
+        【引擎运行】单个交易日的完整流程:
+        pre_open→on_bar(发送订单)→counter_processing→monitor→calculate_profit→close_counter→post_close→记录
+        """
+        self.call_strategy('pre_open')
+        self.on_bar()
+        self.call_strategy('post_close')
+        self.record_day()
+
+    def on_bar(self):
+        """【盘中运行】策略发送订单后,柜台撮合+监控止盈止损+盘后盯市"""
+        self.call_strategy('on_bar')
+        order_sequence=self.order_sequence
+        if order_sequence is None:  # 由于没有日内数据,随机分配最高价/最低价来的顺序
+            order_sequence=bool(self.rng.integers(0,2))
+        if self.run_stock:
+            self.stock_counter_processing(order_sequence=order_sequence)
+            self.monitor_stock(order_sequence=order_sequence)
+        if self.run_future:
+            self.future_counter_processing(order_sequence=order_sequence)
+            for order_type in ['long','short']:
+                self.monitor_future(order_type=order_type,order_sequence=order_sequence)
+            if self.roll_rule is not None:
+                self.roll_futures()
+        if self.run_option:
+            self.option_counter_processing(order_sequence=order_sequence)
+            for order_type,order_BS in [('call','buy'),('call','sell'),('put','buy'),('put','sell')]:
+                self.monitor_option(order_type=order_type,order_BS=order_BS,order_sequence=order_sequence)
+        self.trail_stops()
+        self.calculate_profit()
+        self.close_counter()
+
+    def record_day(self):
+        """【盘后运行】记录当日cash/profit/settle_profit"""
+        self.cash_Dict[self.current_date]=self.cash
+        self.profit_Dict[self.current_date]=self.profit
+        self.settle_profit_Dict[self.current_date]=self.profit_settle
+        self.record_curve()
+
+    def record_curve(self):
+        """【盘后运行】各资产累计盈亏(成交记录中的已实现盈亏+持仓按收盘价/结算价估值的未实现盈亏)与名义市值写入资金曲线"""
+        values={'cash':self.cash,'profit':self.profit,'settle_profit':self.profit_settle,'fee':self.fees}
+        books={'stock':[(self.stock_position,1)],
+               'future':[(self.long_position,1),(self.short_position,-1)],
+               'option':[(self.buycall_position,1),(self.sellcall_position,-1),(self.buyput_position,1),(self.sellput_position,-1)]}
+        ledgers={'stock':self.stock_ledger,'future':self.future_ledger,'option':self.option_ledger}
+        for asset,pos_list in books.items():
+            pnl,exposure=self.curve.add_realized(asset,ledgers[asset]),0.0
+            if getattr(self,f"run_{asset}"):
+                snap=self.get_snapshot(asset)
+                for pos,sign in pos_list:
+                    unrealized,notional=pos.valuation(snap,col='close' if asset=='stock' else 'settle',sign=sign)
+                    pnl+=unrealized
+                    exposure+=notional
+            values[f"{asset}_pnl"]=pnl
+            values[f"{asset}_exposure"]=exposure
+        self.curve.append(self.current_date,**values)
+
+    def equity_curve(self):
+        """
+        逐日资金曲线(record_curve按持仓估值记录,引擎策略由record_day、旧式策略由close_counter记录)
+        没有任何逐日估值记录时报错(cash_Dict只有现金,买入持仓会被当作亏损,不能用来计算绩效)
+        """
+        if len(self.curve)<=1 and len(self.cash_Dict)>1:    # 只有初始资金一行,而策略自行记录了多日cash_Dict
+            raise ValueError("没有逐日估值记录:旧式策略需要每个交易日调用close_counter(或record_day)才能计算绩效")
+        return self.curve
+
+    def performance(self,periods=252):
+        """总体及各资产的绩效指标(DataFrame),按equity_curve的逐日估值计算"""
+        curve=self.equity_curve()
+        return curve.performance({'stock':self.stock_ledger,'future':self.future_ledger,'option':self.option_ledger},periods=periods)
+
+    def save_checkpoint(self,path=None):
+        """
+        保存完整回测状态快照(pickle protocol 5,numpy数组按二进制块写入),先写临时文件再替换,避免中断时损坏快照
+        策略对象可以pickle时一并保存
+        return: 快照路径
+        """
+        if path is None:
+            init_path(self.checkpoint_dir)
+            path=os.path.join(self.checkpoint_dir,f"{self.name}_{self.current_date.strftime('%Y%m%d')}.pkl")
+        state={field:getattr(self,field) for field in self.checkpoint_fields if hasattr(self,field)}
+        try:
+            state['strategy']=pickle.dumps(self.strategy,protocol=5)
+        except Exception:   # 策略(如闭包/lambda)无法pickle时只保存引擎状态
+            pass
+        with open(path+".tmp","wb") as f:
+            pickle.dump(state,f,protocol=5)
+        os.replace(path+".tmp",path)
+        return path
+
+    def load_checkpoint(self,path,restore_strategy=True):
+        """
+        从快照恢复回测状态
+        restore_strategy=False:只恢复引擎状态,保留当前的策略对象(用于多个参数版本共享同一段预热期)
+        """
+        with open(path,"rb") as f:
+            state=pickle.load(f)
+        strategy=state.pop('strategy',None)
+        for field,value in state.items():
+            setattr(self,field,value)
+        if restore_strategy and strategy is not None:
+            self.strategy=pickle.loads(strategy)
+        self.snapshot_Dict={}
+
+    def last_checkpoint(self):
+        """checkpoint_dir中最近交易日的快照路径,没有返回None"""
+        if self.checkpoint_dir is None or not os.path.exists(self.checkpoint_dir):
+            return None
+        L=sorted(name for name in os.listdir(self.checkpoint_dir) if name.startswith(f"{self.name}_") and name.endswith(".pkl"))
+        return os.path.join(self.checkpoint_dir,L[-1]) if L else None
+
+    def run_days(self,resume=False):
+        """
+        【引擎运行】引擎驱动交易日循环
+        处理第t日的同时,在后台线程预取第t+1日的行情截面,隐藏数据源的查询延迟
+        (counter_view=False时柜台表需要在start_counter后才有当日数据,不进行预取)
+        resume=True:从checkpoint_dir中最近的快照继续,跳过快照日期及之前的交易日
+        """
+        self.rng=np.random.default_rng(self.seed)
+        calendar=self.trading_calendar()
+        self.curve.reserve(len(self.curve)+len(calendar))
+        path=self.last_checkpoint() if resume else None
+        if path is not None:
+            self.load_checkpoint(path)
+            calendar=[date for date in calendar if date>self.current_date]
+        prefetch=self.prefetch and (self.counter_view or not isinstance(self.data_source,DolphinDBSource))
+        executor=ThreadPoolExecutor(max_workers=1) if prefetch else None
+        future=None
+        try:
+            for t,date in enumerate(calendar):
+                self.set_date(date)
+                self.start_counter()
+                if future is not None:  # 使用预取的行情截面
+                    self.snapshot_Dict.update(future.result())
+                    future=None
+                if executor is not None and t+1<len(calendar):
+                    future=executor.submit(self.load_day,calendar[t+1])
+                self.run_day()
+                if self.checkpoint_dir is not None and (t+1)%self.checkpoint_every==0:
+                    self.save_checkpoint()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def result(self):
+        """当前回测结果(BacktestResult)"""
+        return BacktestResult(name=self.name,
+                              cash=pd.Series(self.cash_Dict,name='cash',dtype=np.float64),
+                              profit=pd.Series(self.profit_Dict,name='profit',dtype=np.float64),
+                              settle_profit=pd.Series(self.settle_profit_Dict,name='settle_profit',dtype=np.float64),
+                              stock_record=self.stock_record,
+                              future_record=self.future_record,
+                              option_record=self.option_record,
+                              stats=self.stats(),
+                              profile=self.profile_frame(),
+                              curve=self.curve.frame(),
+                              performance=self.performance())
+
+    def stats(self):
+        """回测统计指标"""
+        stats={'ori_cash':self.ori_cash,
+               'final_cash':self.cash,
+               'profit':self.profit,
+               'settle_profit':self.profit_settle,
+               'fees':self.fees,
+               'stock_trades':len(self.stock_ledger),
+               'future_trades':len(self.future_ledger),
+               'option_trades':len(self.option_ledger)}
+        stats.update(self.performance().loc['total'].drop('pnl').to_dict())
+        return stats
+
+    def data_fingerprint(self):
+        """回测区间内K线表与信号表的数据版本{asset:fingerprint}"""
+        source=self.kline_source()
+        assets=[asset for asset in ['stock','future','option'] if getattr(self,f"run_{asset}")]
+        assets+=[f"{asset}_signal" for asset in assets]
+        return {asset:source.fingerprint(asset,self.start_date,self.end_date) for asset in assets if source.has_asset(asset)}
+
+    def cache_key(self):
+        """结果缓存的key:回测引擎源码+策略源码与参数+构造参数+seed+数据版本的sha256"""
+        strategy=self.strategy
+        parts={'engine':hashlib.sha256(inspect.getsource(sys.modules[__name__]).encode()).hexdigest(),
+               'strategy':stable_repr(strategy if inspect.isfunction(strategy) else type(strategy)),
+               'strategy_params':stable_repr(vars(strategy)) if hasattr(strategy,'__dict__') and not inspect.isfunction(strategy) else None,
+               'config':stable_repr(self.config),
+               'seed':self.seed,
+               'data':stable_repr(self.data_fingerprint())}
+        return hashlib.sha256(stable_repr(parts).encode()).hexdigest()
+
+    def run(self,plot=True,resume=False):
+        """
+        运行策略+可视化
+        plot=False:无界面批量运行(不导入matplotlib),只返回回测结果
+        resume=True:从checkpoint_dir中最近的快照继续(仅引擎驱动交易日循环时)
+        result_cache不为None时先按cache_key()查找缓存,命中则直接返回缓存的结果(不运行回测,Backtest自身状态不更新)
+        return: BacktestResult
+        """
+        key=self.cache_key() if self.result_cache is not None else None
+        result=self.result_cache.get(key) if key is not None else None
+        if result is None:
+            if self.is_hook_strategy():     # 引擎驱动交易日循环
+                self.run_days(resume=resume)
+            else:
+                self.strategy(self=self)    # 策略运行
+            if self.profiler is not None:
+                print(self.profile_summary())
+            result=self.result()
+            if key is not None:
+                self.result_cache.put(key,result)
+        if plot:
+            result.plot(settle_profit=self.run_future or self.run_option)
+        return result
+
+
+class Portfolio:
+    """
+    多策略组合回测:一次遍历交易日历,同时驱动多个相互独立的Backtest(各自的资金/柜台/持仓/成交记录)
+    每个交易日只由第一个Backtest启动柜台并读取一次行情截面,其余策略共享同一份截面(DaySnapshot只读)
+    strategies:{策略名:策略对象},策略需实现pre_open/on_bar/post_close
+    cash:各策略的初始资金,可以为{策略名:cash}
+    backtest_kwargs:各策略共用的Backtest参数(start_date/end_date/run_stock/session/data_source/...)
+        risk(RiskEngine)作为限制模板,每个策略使用一份独立的复制(各自的持仓/资金/权益)
+    """
+    def __init__(self,strategies,cash=1000000,**backtest_kwargs):
+        self.backtests={}
+        data_source=backtest_kwargs.pop('data_source',None)
+        risk=backtest_kwargs.pop('risk',None)
+        for name,strategy in strategies.items():
+            if not any(hasattr(strategy,hook) for hook in ['pre_open','on_bar','post_close']):
+                raise ValueError(f"策略{name}需要实现pre_open/on_bar/post_close才能加入组合回测")
+            backtest=Backtest(strategy=strategy,name=name,cash=cash[name] if isinstance(cash,dict) else cash,
+                              data_source=data_source,risk=copy.deepcopy(risk),**backtest_kwargs)
+            data_source=backtest.data_source    # 之后的策略共用第一个策略的数据源
+            self.backtests[name]=backtest
+        self.lead=next(iter(self.backtests.values()))   # 负责启动柜台/读取行情的Backtest
+        for backtest in self.backtests.values():
+            backtest.signal_cache=self.lead.signal_cache    # 共用信号缓存
+            backtest.fill_capacity=self.lead.fill_capacity  # 共用成交量容量(同一合约各策略合计不超过volume*participation)
+        self.results={}
+
+    def run_days(self):
+        """【引擎运行】同一交易日依次运行各策略,行情截面只读取一次,并在后台预取下一交易日"""
+        lead=self.lead
+        calendar=lead.trading_calendar()
+        if lead.run_future and lead.roll_rule is not None:     # 主力合约日历只计算一次
+            roll_calendar=lead.build_roll_calendar()
+            for backtest in self.backtests.values():
+                backtest.roll_calendar=roll_calendar
+        if lead.run_option:     # 期权到期日历只计算一次
+            option_expiry=lead.build_option_expiry()
+            for backtest in self.backtests.values():
+                backtest.option_expiry=option_expiry
+        for backtest in self.backtests.values():
+            backtest.rng=np.random.default_rng(backtest.seed)
+            backtest.curve.reserve(len(backtest.curve)+len(calendar))
+        prefetch=lead.prefetch and (lead.counter_view or not isinstance(lead.data_source,DolphinDBSource))
+        executor=ThreadPoolExecutor(max_workers=1) if prefetch else None
+        future=None
+        try:
+            for t,date in enumerate(calendar):
+                lead.set_date(date)
+                lead.start_counter()
+                if future is not None:
+                    lead.snapshot_Dict.update(future.result())
+                    future=None
+                if executor is not None and t+1<len(calendar):
+                    future=executor.submit(lead.load_day,calendar[t+1])
+                for backtest in self.backtests.values():
+                    backtest.set_date(date)
+                    backtest.snapshot_Dict=lead.snapshot_Dict   # 共享同一个截面缓存(任一策略读取后其余策略直接复用)
+                    backtest.run_day()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def aggregate(self):
+        """组合汇总:资金曲线逐日相加,成交记录合并后计算组合绩效,return: BacktestResult"""
+        backtests=list(self.backtests.values())
+        curve=EquityCurve(ori_cash=sum(backtest.ori_cash for backtest in backtests),capacity=len(self.lead.curve))
+        curve.size=len(self.lead.curve)
+        curve.dates[:curve.size]=self.lead.curve.dates[:curve.size]
+        for backtest in backtests:
+            curve.data[:curve.size]+=backtest.curve.data[:curve.size]
+        ledgers={}
+        for asset in EquityCurve.assets:
+            ledger=TradeLedger(getattr(self.lead,f"{asset}_ledger").dtypes)
+            for backtest in backtests:
+                ledger.extend(getattr(backtest,f"{asset}_ledger"))
+            ledgers[asset]=ledger
+        performance=curve.performance(ledgers)
+        frame=curve.frame()
+        records={asset:pd.concat([getattr(backtest,f"{asset}_record").assign(strategy=name) for name,backtest in self.backtests.items()],ignore_index=True)
+                 for asset in EquityCurve.assets}
+        stats={key:sum(backtest.stats()[key] for backtest in backtests)
+               for key in ['ori_cash','final_cash','profit','settle_profit','fees','stock_trades','future_trades','option_trades']}
+        stats.update(performance.loc['total'].drop('pnl').to_dict())
+        return BacktestResult(name='portfolio',
+                              cash=frame['cash'],
+                              profit=frame['profit'],
+                              settle_profit=frame['settle_profit'],
+                              stock_record=records['stock'],
+                              future_record=records['future'],
+                              option_record=records['option'],
+                              stats=stats,
+                              curve=frame,
+                              performance=performance)
+
+    def summary(self):
+        """各策略及组合的统计指标(每行一个策略)"""
+        rows={name:result.stats for name,result in self.results.items()}
+        return pd.DataFrame(rows).T
+
+    def run(self,plot=False):
+        """
+        运行全部策略
+        return: 组合的BacktestResult,各策略的BacktestResult保存在self.results中
+        """
+        self.run_days()
+        for name,backtest in self.backtests.items():
+            self.results[name]=backtest.result()
+        result=self.aggregate()
+        self.results['portfolio']=result
+        if plot:
+            result.plot(settle_profit=self.lead.run_future or self.lead.run_option)
+        return result
+
+
+def run_sweep_task(strategy,params,backtest_kwargs,data_root):
+    """【参数扫描子进程】按一组参数运行一次无界面回测,返回{参数..,统计指标..}"""
+    backtest_params=set(inspect.signature(Backtest.__init__).parameters)
+    strategy_kwargs={key:value for key,value in params.items() if key not in backtest_params}   # 策略参数
+    kwargs=dict(backtest_kwargs)
+    kwargs.update({key:value for key,value in params.items() if key in backtest_params})       # Backtest参数(如cash/end_date)
+    kwargs['data_source']=LocalColumnarSource(root=data_root,memory_map=True)   # 各进程memory_map同一份本地行情文件
+    kwargs['strategy']=strategy(**strategy_kwargs)
+    result=Backtest(**kwargs).run(plot=False)
+    row=dict(params)
+    row.update({key if key not in params else f"{key}_result":value for key,value in result.stats.items()})   # 统计指标与参数重名时加后缀
+    return row
+
+def sweep(strategy,param_grid,backtest_kwargs,data_root,processes=None):
+    """
+    参数扫描:对param_grid的全部组合并行运行Backtest,汇总为一张表
+    strategy:策略类/工厂函数(需要可pickle,即定义在模块顶层),strategy(**策略参数)返回实现pre_open/on_bar/post_close的策略对象
+    param_grid:{'stop':[0.02,0.05],'max_date':[...],'cash':[...]},与Backtest.__init__同名的参数传给Backtest,其余传给strategy
+    backtest_kwargs:各组共用的Backtest参数(start_date/end_date/run_stock/...)
+    data_root:LocalColumnarSource的目录,各子进程以memory_map方式读取同一份行情文件,行情截面的数值列为Arrow缓冲区上的只读视图
+              (操作系统页缓存共享,不复制);字符串列(symbol/contract/option)与信号表(DataFrame)仍在各子进程中转换
+    processes:进程数(默认cpu数),processes=1时在当前进程依次运行
+    return: DataFrame(参数列+统计指标列),每组参数一行
+    """
+    keys=list(param_grid.keys())
+    params_list=[dict(zip(keys,values)) for values in itertools.product(*[param_grid[key] for key in keys])]
+    if processes==1:
+        rows=[run_sweep_task(strategy,params,backtest_kwargs,data_root) for params in params_list]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures=[executor.submit(run_sweep_task,strategy,params,backtest_kwargs,data_root) for params in params_list]
+            rows=[future.result() for future in futures]
+    return pd.DataFrame(rows)
 
 
 if __name__=="__main__":
@@ -1010,6 +3505,7 @@ if __name__=="__main__":
     stock_record,future_record,option_record=S.stock_record,S.future_record,S.option_record
     print(stock_record)
     stock_record.to_csv(f"交易明细{pd.Timestamp.today().strftime('%Y-%m-%d')}.csv",index=None)
+    plt=get_plt()
     plt.plot(S.cash_Dict.keys(),S.cash_Dict.values(),label='cash')
     plt.legend(frameon=False)
     plt.show()
\ No newline at end of file
@@ -12,6 +12,15 @@ from sys import getsizeof as getsize
 from operator import methodcaller
 from collections import Counter
 
+def get_plt():
+    """
+    绘图时才导入matplotlib并设置中文字体(批量/并行回测不需要绘图,避免导入matplotlib)
+    """
+    import matplotlib.pyplot as plt
+    plt.rcParams['font.sans-serif']=['KaiTi'] # 显示中文
+    plt.rcParams['axes.unicode_minus']=False # 显示负号
+    return plt
+
 def init_path(path_dir):
     "创建当前.py目录下的文件夹"
     if os.path.exists(path=path_dir)==bool(False):
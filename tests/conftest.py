@@ -0,0 +1,65 @@
+import os,sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def stock_bars(dates,symbol='A',close=10.0,spread=0.5,volume=1000.0):
+    """合成股票日K线:close可以是标量或逐日序列,open=close,high/low=close±spread"""
+    close=np.broadcast_to(np.asarray(close,dtype=np.float64),(len(dates),))
+    return pd.DataFrame({'date':pd.to_datetime(dates),'symbol':symbol,'open':close,'high':close+spread,'low':close-spread,
+                         'close':close,'volume':volume})
+
+
+def future_bars(dates,contract='AU2402',settle=400.0,spread=5.0,volume=100.0,end_date=None):
+    """合成期货日K线:pre_settle取前一日settle,end_date默认为最后一个交易日"""
+    dates=pd.to_datetime(dates)
+    settle=np.broadcast_to(np.asarray(settle,dtype=np.float64),(len(dates),))
+    return pd.DataFrame({'date':dates,'product':contract.rstrip('0123456789'),'contract':contract,
+                         'pre_settle':np.r_[settle[0],settle[:-1]],'open':settle,'high':settle+spread,'low':settle-spread,
+                         'close':settle,'settle':settle,'volume':volume,'start_date':dates[0],
+                         'end_date':pd.Timestamp(end_date) if end_date is not None else dates[-1]})
+
+
+def option_bars(dates,option='AU2402C400',contract='AU2402',settle=10.0,spread=1.0,level=1.0,volume=30.0,end_date=None):
+    """合成期权日K线:pre_settle取前一日settle,level>0为实值"""
+    dates=pd.to_datetime(dates)
+    settle=np.broadcast_to(np.asarray(settle,dtype=np.float64),(len(dates),))
+    return pd.DataFrame({'date':dates,'product':contract.rstrip('0123456789'),'contract':contract,'option':option,
+                         'pre_settle':np.r_[settle[0],settle[:-1]],'open':settle,'high':settle+spread,'low':np.maximum(settle-spread,0),
+                         'close':settle,'settle':settle,'volume':volume,'start_date':dates[0],
+                         'end_date':pd.Timestamp(end_date) if end_date is not None else dates[-1],'level':level})
+
+
+class HookStrategy:
+    """按交易日调用actions中对应的函数(bt)下单"""
+    def __init__(self,actions=None):
+        self.actions=actions or {}
+
+    def on_bar(self,bt):
+        action=self.actions.get(bt.current_date)
+        if action is not None:
+            action(bt)
+
+
+@pytest.fixture
+def BT():
+    return pytest.importorskip("BackTest3")
+
+
+@pytest.fixture
+def make_backtest(tmp_path,BT):
+    """把合成K线写入LocalColumnarSource并构造Backtest(不需要DolphinDB)"""
+    def make(strategy,stock=None,future=None,option=None,**kwargs):
+        source=BT.LocalColumnarSource(str(tmp_path/'bars'))
+        for asset,df in (('stock',stock),('future',future),('option',option)):
+            if df is not None:
+                source.save(asset,df)
+        dates=pd.concat([df['date'] for df in (stock,future,option) if df is not None])
+        kwargs.setdefault('order_sequence',True)
+        return BT.Backtest(start_date=dates.min().strftime('%Y.%m.%d'),end_date=dates.max().strftime('%Y.%m.%d'),strategy=strategy,
+                           data_source=source,run_stock=stock is not None,run_future=future is not None,run_option=option is not None,
+                           prefetch=False,**kwargs)
+    return make
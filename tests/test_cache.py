@@ -0,0 +1,31 @@
+import pandas as pd
+
+from conftest import HookStrategy,stock_bars
+
+DATES=pd.bdate_range('2025-01-06',periods=4)
+
+
+def buy(bt):
+    bt.order_open_stock('A',100,10.0)
+
+
+def test_reused_cost_model_hits_the_result_cache(tmp_path,BT):
+    """同一CostModel对象重复使用:运行中填充的multiplier_cache不改变key,第二次运行直接命中缓存;修改费率则不命中"""
+    source=BT.LocalColumnarSource(str(tmp_path/'bars'))
+    source.save('stock',stock_bars(DATES))
+    cache=BT.ResultCache(str(tmp_path/'cache'))
+    cost=BT.CostModel(fees={'stock':{'rate':0.0003,'min':5}})
+
+    def run(cost_model):
+        bt=BT.Backtest(start_date='2025.01.06',end_date='2025.01.09',strategy=HookStrategy({DATES[0]:buy}),data_source=source,
+                       run_stock=True,prefetch=False,order_sequence=True,cost_model=cost_model,
+                       risk=BT.RiskEngine(max_exposure=1.0),result_cache=cache)
+        return bt.run(plot=False)
+
+    first=run(cost)
+    assert cost.multiplier_cache    # 运行中已填充
+    second=run(cost)
+    assert (cache.hits,cache.misses)==(1,1)
+    assert second.curve.equals(first.curve)
+    run(BT.CostModel(fees={'stock':{'rate':0.0005,'min':5}}))
+    assert (cache.hits,cache.misses)==(1,2)
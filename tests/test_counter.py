@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+
+
+def order(symbol='A',price=10.0,vol=5,min_order_date='2025-01-06',max_order_date='2025-01-10',**extra):
+    return dict({'order_state':'open','symbol':symbol,'price':price,'vol':vol,
+                 'min_order_date':min_order_date,'max_order_date':max_order_date},**extra)
+
+
+def test_order_dict_fields_synced_with_arrays_are_read_only(BT):
+    counter=BT.OrderCounter(key='symbol')
+    counter[1]=order()
+    with pytest.raises(TypeError):
+        counter[1]['price']=11.0
+    with pytest.raises(TypeError):
+        counter[1]['vol']=1
+    counter[1]['reason']='signal'   # 其余字段仍可直接修改
+    assert counter[1]['reason']=='signal'
+
+
+def test_amend_updates_arrays_and_dict(BT):
+    counter=BT.OrderCounter(key='symbol')
+    counter[1]=order(margin=4.0)
+    counter.amend(1,price=11.0,vol=10,max_order_date='2025-01-20')
+    i=counter.slot[1]
+    assert (counter.price[i],counter.vol[i])==(11.0,10.0)
+    assert counter[1]['margin']==8.0
+    assert counter.expire('2025-01-12')==[]     # 原有的过期记录已失效
+    assert counter.expire('2025-01-20')==[1]
+    with pytest.raises(ValueError):
+        counter.amend(1,symbol='B')
+
+
+def test_heaps_drop_entries_of_filled_and_cancelled_orders(BT):
+    counter=BT.OrderCounter(key='symbol')
+    for orderNum in range(1000):
+        counter[orderNum]=order(max_order_date='2030-01-01')
+        if orderNum>=10:
+            del counter[orderNum-10]     # 成交/撤单
+    assert len(counter)==10
+    assert len(counter.pending)<=max(64,2*len(counter))
+    assert len(counter.expiry)<=max(64,2*len(counter))
+    counter.activate('2025-01-06')
+    assert counter.active==set(range(990,1000))
@@ -0,0 +1,24 @@
+import pandas as pd
+
+from conftest import HookStrategy,future_bars,option_bars,stock_bars
+
+DATES=pd.bdate_range('2024-02-14','2024-02-20')
+AFTER=pd.bdate_range('2024-02-14','2024-02-22')
+
+
+def test_exercise_into_a_future_expiring_the_same_day(make_backtest,capsys):
+    """AU2402C400与AU2402同在2024-02-20到期:行权得到的期货当日按收盘价平仓,之后不再有期货持仓"""
+    def buy(bt):
+        bt.order_open_option('call','buy','AU2402C400',2,price=10.0,pre_settle=10.0,strike=400.0,margin=0)
+    bt=make_backtest(HookStrategy({DATES[0]:buy}),stock=stock_bars(AFTER),
+                     future=future_bars(DATES,settle=[400.0,402.0,405.0,408.0,410.0]),
+                     option=option_bars(DATES,settle=[10.0,10.0,10.0,10.0,10.0]))
+    result=bt.run(plot=False)
+    trades=bt.future_ledger.to_frame()
+    assert trades[['date','state','reason','price','vol']].values.tolist()==[[DATES[-1],'open','exercise',400.0,2.0],
+                                                                              [DATES[-1],'close','end_date',410.0,2.0]]
+    assert trades['pnl'].sum()==20.0
+    assert len(bt.long_position.keys())==0
+    assert "data is missed" not in capsys.readouterr().out
+    assert abs(bt.reconcile_cash())<1e-6
+    assert result.curve['future_exposure'].iloc[-1]==0.0
@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+
+from conftest import HookStrategy,stock_bars
+
+DATES=pd.bdate_range('2025-01-06',periods=3)
+
+
+def test_snapshot_numeric_columns_are_zero_copy_views(make_backtest):
+    """本地数据源的行情截面:数值/日期列直接引用memory_map的Arrow缓冲区,字符串列转换;.df按需构造"""
+    bars=pd.concat([stock_bars(DATES,symbol='A',close=10.0),stock_bars(DATES,symbol='B',close=20.0)]).sort_values('date')
+    bt=make_backtest(HookStrategy(),stock=bars)
+    bt.set_date(DATES[1])
+    snap=bt.get_snapshot('stock')
+    close=snap.column('close')
+    assert not close.flags.writeable and not close.flags.owndata     # Arrow缓冲区上的只读视图
+    assert snap.column('date').dtype==np.dtype('datetime64[ns]')
+    assert snap.get('B')['close']==20.0 and snap.loc('C')==-1
+    assert snap.df[['symbol','close']].values.tolist()==[['A',10.0],['B',20.0]]
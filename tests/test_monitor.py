@@ -0,0 +1,51 @@
+import pandas as pd
+
+from conftest import HookStrategy,stock_bars
+
+DATES=pd.bdate_range('2025-01-06',periods=4)
+
+
+def test_monitor_closes_the_lot_whose_own_stop_fired(make_backtest):
+    """同一股票两个批次:只有第二个批次的止损被触发,平仓的应是第二个批次而不是FIFO队首批次"""
+    def buy(bt):
+        bt.order_open_stock('A',100,10.0,min_price=8.0,max_price=13.0)
+        bt.order_open_stock('A',100,10.0,min_price=9.4)
+    bt=make_backtest(HookStrategy({DATES[0]:buy}),stock=stock_bars(DATES,close=[10.0,9.6,10.0,10.0]))
+    bt.run(plot=False)
+    trades=bt.stock_ledger.to_frame()
+    closes=trades[trades['state']=='close']
+    assert closes[['price','vol','reason']].values.tolist()==[[9.4,100.0,'low_limit']]
+    lots=bt.stock_position['A']
+    assert len(lots)==1 and (lots[0]['min_price'],lots[0]['max_price'])==(8.0,13.0)
+
+
+def test_trailing_stop_closes_its_own_lot_at_the_gap_open(make_backtest):
+    """移动止损被触发:只平仓设置trail的批次(固定止盈止损的批次保留),跳空低开时按开盘价成交"""
+    def buy(bt):
+        bt.order_open_stock('A',100,10.0,min_price=9.5,max_price=11.0)
+        bt.order_open_stock('A',100,10.0,trail=0.5)
+    bt=make_backtest(HookStrategy({DATES[0]:buy}),stock=stock_bars(DATES,close=[10.0,10.6,10.0,10.0],spread=0.2))
+    bt.run(plot=False)
+    trades=bt.stock_ledger.to_frame()
+    closes=trades[trades['state']=='close']
+    assert closes[['date','price','vol','reason']].values.tolist()==[[DATES[2],10.0,100.0,'low_limit']]    # 止损价10.3,开盘价10.0
+    lots=bt.stock_position['A']
+    assert len(lots)==1 and (lots[0]['min_price'],lots[0]['max_price'])==(9.5,11.0)
+
+
+def test_same_bar_bracket_is_recorded_and_resampled(make_backtest):
+    """bracket止盈/止损在同一根K线上都可成交:按order_sequence成交一侧,另一侧记入ambiguous_ledger,monte_carlo两种顺序的盈亏不同"""
+    def buy(bt):
+        bt.order_open_stock('A',100,10.0)
+    def bracket(bt):
+        bt.order_bracket_stock('A',100,take_profit=10.5,stop_loss=9.5)
+    bt=make_backtest(HookStrategy({DATES[0]:buy,DATES[1]:bracket}),stock=stock_bars(DATES,spread=[0.2,0.2,1.0,0.2]))
+    bt.run(plot=False)
+    trades=bt.stock_ledger.to_frame()
+    closes=trades[trades['state']=='close']
+    assert closes[['date','price','vol']].values.tolist()==[[DATES[2],10.5,100.0]]
+    ledger=bt.ambiguous_ledger.to_frame()
+    assert ledger[['side','price','alternate','delta']].values.tolist()==[['high',10.5,9.5,-100.0]]
+    mc=bt.monte_carlo(samples=20,seed=0)
+    assert mc.loc['high_first','pnl']-mc.loc['low_first','pnl']==100.0
+    assert mc['pnl'].iloc[2:].nunique()==2
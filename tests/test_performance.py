@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import stock_bars
+
+DATES=pd.bdate_range('2025-01-06',periods=4)
+
+
+def legacy_strategy(self):
+    """旧式函数策略:自行循环交易日并记录cash_Dict"""
+    for date in DATES:
+        self.set_date(date)
+        if date==DATES[0]:
+            self.order_open_stock('A',1000,10.0)
+        self.stock_counter_processing()
+        self.monitor_stock(True)
+        self.close_counter()
+        self.cash_Dict[date]=self.cash
+
+
+def test_legacy_strategy_curve_values_positions(make_backtest):
+    """旧式策略买入约1万元股票:资金曲线按持仓估值(不把买入成本当作亏损),回撤等于真实亏损"""
+    bt=make_backtest(legacy_strategy,stock=stock_bars(DATES,close=[10.0,9.8,9.6,9.7]))
+    result=bt.run(plot=False)
+    curve=result.curve
+    assert curve['stock_pnl'].tolist()==pytest.approx([0.0,-200.0,-400.0,-300.0])
+    assert curve['stock_exposure'].tolist()==pytest.approx([10000.0,9800.0,9600.0,9700.0])
+    assert result.performance.loc['total','max_drawdown']==pytest.approx(-400.0/1000000)
+
+
+def test_performance_without_daily_valuation_raises(make_backtest):
+    def no_record(self):    # 只记录cash_Dict,没有调用close_counter
+        for date in DATES:
+            self.set_date(date)
+            self.stock_counter_processing()
+            self.cash_Dict[date]=self.cash
+    bt=make_backtest(no_record,stock=stock_bars(DATES))
+    with pytest.raises(ValueError):
+        bt.run(plot=False)
@@ -0,0 +1,40 @@
+import pandas as pd
+
+from conftest import HookStrategy,stock_bars
+
+DATES=pd.bdate_range('2025-01-06',periods=4)
+
+
+class FakeSession:
+    def run(self,script):
+        return []
+
+
+def queries(bt,phase=None):
+    frame=bt.profile_frame()
+    return int(frame.loc[frame['phase']==phase,'queries'].sum()) if phase else int(frame['queries'].sum())
+
+
+def test_dolphindb_source_queries_are_counted(BT):
+    """数据源在启用计时前构造:get_range/trading_dates/fingerprint的session.run仍计入计时"""
+    source=BT.DolphinDBSource(session=FakeSession(),tables={'stock':('dfs://db','base'),'stock_signal':('dfs://db','signal')})
+    bt=BT.Backtest(start_date='2025.01.06',end_date='2025.01.09',strategy=HookStrategy(),data_source=source,run_stock=True,
+                   prefetch=False,profile=True)
+    source.trading_dates('stock')
+    source.get_range('stock_signal','2025-01-06','2025-01-09')
+    assert queries(bt,'other')==2
+
+
+def test_portfolio_member_queries_land_in_its_own_profiler(tmp_path,BT):
+    """组合回测共用第一个策略的数据源:第二个策略在on_bar中的查询计入它自己的计时"""
+    source=BT.LocalColumnarSource(str(tmp_path/'bars'))
+    source.save('stock',stock_bars(DATES))
+    read=lambda bt:bt.data_source.get_day('stock',bt.current_date)
+    portfolio=BT.Portfolio({'lead':HookStrategy(),'reader':HookStrategy({date:read for date in DATES})},
+                           start_date='2025.01.06',end_date='2025.01.09',data_source=source,run_stock=True,
+                           prefetch=False,order_sequence=True,profile=True)
+    portfolio.run(plot=False)
+    lead,reader=portfolio.backtests['lead'],portfolio.backtests['reader']
+    assert queries(reader,'strategy.on_bar')==len(DATES)
+    assert queries(lead,'strategy.on_bar')==0
+    assert queries(lead)==len(DATES)    # 每个交易日只由lead读取一次截面
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+from conftest import HookStrategy,stock_bars
+
+DATES=pd.bdate_range('2025-01-06',periods=3)
+
+
+def greedy(cash_room,exposure_room,symbol_room,symbols,cash_need,notional):
+    """逐笔占用额度的参考实现"""
+    room=dict(symbol_room)
+    ok=[]
+    for symbol,need,value in zip(symbols,cash_need,notional):
+        passed=need<=cash_room and value<=exposure_room and value<=room[symbol]
+        if passed:
+            cash_room-=need;exposure_room-=value;room[symbol]-=value
+        ok.append(passed)
+    return ok
+
+
+def test_check_matches_order_by_order_allocation(BT):
+    rng=np.random.default_rng(0)
+    for _ in range(50):
+        risk=BT.RiskEngine(max_exposure=0.5,max_concentration=0.2,min_cash=0)
+        symbols=list(rng.choice(['A','B','C'],size=30))
+        notional=rng.uniform(0,0.1,size=30)
+        ok=risk.check(cash=1.0,equity=1.0,symbols=symbols,cash_need=notional,notional=notional,margin=np.zeros(30))
+        assert ok.tolist()==greedy(1.0,0.5,{'A':0.2,'B':0.2,'C':0.2},symbols,notional,notional)
+        assert risk.rejected==int((~ok).sum())
+
+
+def test_rejected_orders_are_kept(make_backtest,BT):
+    """超出单一股票集中度的订单被拒绝:从柜台删除,但保留在rejected_orders中"""
+    def buy(bt):
+        bt.order_open_stock('A',1000,10.0)
+        bt.order_open_stock('A',20000,10.0)
+    bt=make_backtest(HookStrategy({DATES[0]:buy}),stock=stock_bars(DATES),risk=BT.RiskEngine(max_concentration=0.1))
+    bt.run(plot=False)
+    assert [(row['date'],row['asset'],row['order']['vol']) for row in bt.rejected_orders]==[(DATES[0],'stock',20000)]
+    assert len(bt.stock_counter)==0
+    assert bt.stock_position.vol_of('A')==1000
@@ -0,0 +1,33 @@
+import threading
+import time
+
+import pandas as pd
+
+
+class SlowSession:
+    """记录同时进入run的线程数(dolphindb的session不是线程安全的)"""
+    def __init__(self):
+        self.inside=0
+        self.max_inside=0
+
+    def run(self,script):
+        self.inside+=1
+        self.max_inside=max(self.max_inside,self.inside)
+        time.sleep(0.01)
+        self.inside-=1
+        return pd.DataFrame({'date':[]})
+
+
+def test_source_and_strategy_calls_share_one_lock(BT):
+    """数据源(预取线程)与策略/CountingSession经各自的包装调用同一个session时仍然串行"""
+    session=SlowSession()
+    source=BT.DolphinDBSource(session=session,tables={'stock':('dfs://db','base')})
+    strategy_session=BT.CountingSession(session,BT.PhaseProfiler(date_getter=lambda:None))
+    assert source.lock is BT.LockedSession(session).lock
+    threads=[threading.Thread(target=source.get_range,args=('stock','2025-01-06','2025-01-10')) for _ in range(4)]
+    threads+=[threading.Thread(target=strategy_session.run,args=("select 1",)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert session.max_inside==1